@@ -0,0 +1,104 @@
+"""
+Amenity names and the packed amenity bitmask.
+
+Besides one 0/1 column per amenity, each listing has an amenity_mask integer in which bit i
+is set if the listing has AMENITIES[i].  The bit of an amenity never changes: new amenities
+must be appended to AMENITIES, never inserted or reordered, or masks stored earlier would
+change meaning.
+
+Set filters work on the mask with one bitwise AND, in SQL (sql_filter) or NumPy (match):
+
+    clause, params = sql_filter(all_of=["doorman", "gym", "pets allowed"])
+    con.execute("SELECT data_id FROM all_data WHERE " + clause, params)
+"""
+import numpy as np
+
+
+# amenity names as they appear on streeteasy.com, in bit order
+AMENITIES = ["bike room", "board approval required", "cats and dogs allowed", "central air conditioning",
+             "concierge", "cold storage", "community recreation facilities", "children's playroom",
+             "deck", "dishwasher", "doorman", "elevator", "full-time doorman", "furnished", "garage parking",
+             "green building", "gym", "garden", "guarantors accepted", "laundry in building", "live-in super",
+             "loft", "package room", "parking available", "patio", "pets allowed", "roof deck", "smoke-free",
+             "storage available", "sublet", "terrace", "virtual doorman", "washer/dryer in-unit", "waterview",
+             "waterfront"]
+
+
+def column_name(amenity):
+    """Return the table column of an amenity, as renamed by csv2sql: "children's playroom"
+    becomes "children_playroom", "washer/dryer in-unit" becomes "washer_dryer_in_unit".
+    """
+    name = amenity.replace("'s", "")
+    for c in " -/":
+        name = name.replace(c, "_")
+    return name
+
+# table columns, in bit order
+COLUMNS = [column_name(a) for a in AMENITIES]
+
+# bit of each amenity, by name or by table column
+BITS = dict((a, i) for i, a in enumerate(AMENITIES))
+BITS.update((c, i) for i, c in enumerate(COLUMNS))
+
+
+def mask(names):
+    """Return the mask with the bits of the given amenity names or columns set."""
+    m = 0
+    for name in names:
+        if name not in BITS:
+            raise KeyError("unknown amenity: %r" % (name))
+        m |= 1 << BITS[name]
+    return m
+
+
+def mask_of(flags):
+    """Return the mask of one listing from a dict of 0/1 flags keyed by amenity name or
+    column, such as the output of streeteasy_scrape_public.parse_amenities.
+    """
+    return mask(a for a, v in flags.items() if a in BITS and v == 1)
+
+
+def pack(df, columns=COLUMNS):
+    """Return the masks of a DataFrame with one 0/1 column per amenity as an int64 array.
+    Missing flags (NaN or -1) leave the bit unset.
+    """
+    masks = np.zeros(len(df), dtype=np.int64)
+    for col in columns:
+        if col in df:
+            masks |= (df[col].values == 1).astype(np.int64) << BITS[col]
+    return masks
+
+
+def unpack(masks, n_bits=len(AMENITIES)):
+    """Return an (n listings, n_bits) int8 feature matrix of 0/1 flags from an array of
+    masks, columns in bit order.
+    """
+    masks = np.asarray(masks, dtype=np.int64)
+    return ((masks[:, None] >> np.arange(n_bits)) & 1).astype(np.int8)
+
+
+def sql_filter(all_of=(), any_of=(), column='amenity_mask'):
+    """Return (clause, params) selecting the listings that have every amenity in all_of and
+    at least one in any_of.  The clause is "1" if both are empty.
+    """
+    clauses, params = [], []
+    if all_of:
+        # no bit of the wanted mask is missing from the listing's mask
+        clauses.append("(~%s & ?) = 0" % (column))
+        params.append(mask(all_of))
+    if any_of:
+        clauses.append("(%s & ?) != 0" % (column))
+        params.append(mask(any_of))
+    return " AND ".join(clauses) or "1", tuple(params)
+
+
+def match(masks, all_of=(), any_of=()):
+    """NumPy version of sql_filter: return a boolean array over an array of masks."""
+    masks = np.asarray(masks, dtype=np.int64)
+    keep = np.ones(len(masks), dtype=bool)
+    if all_of:
+        m = mask(all_of)
+        keep &= (masks & m) == m
+    if any_of:
+        keep &= (masks & mask(any_of)) != 0
+    return keep
@@ -0,0 +1,722 @@
+"""
+Offline benchmarks for streeteasy_scrape_public.py.  No requests are sent to streeteasy.com.
+
+A corpus of synthetic listings and detail pages, laid out like the streeteasy.com pages the
+scraper reads and using the neighborhoods in Data/neighborhood_borough.csv, is written to
+disk and served by a local HTTP stand-in (FixtureServer).  The suite reports:
+
+    - amenity/transit extraction and tree-building cost per listing
+    - parse_listing p50/p99 time and listings/sec
+    - end-to-end crawl throughput at several fetch concurrency levels
+    - crawl throughput and lost listings against a server that throttles (429), delays
+      and fails (503) requests, unpaced and with the adaptive scheduler of scheduler.py
+    - sharded crawl throughput with 1, 2 and 4 worker processes sharing the work queue of
+      work_queue.py
+    - requests per listing and crawl throughput of a day-later crawl that compares the listing
+      cards with the previous snapshot, against one that downloads every listing
+    - peak RSS growth per 10k listings
+    - query.py latency per query shape on a synthetic merged table: full scan, indexed,
+      and served from the result cache
+    - amenity set filters: one column per amenity vs the packed amenity_mask, in SQLite
+      and NumPy
+    - feature loading from SQLite vs the columnar export of export.py (needs pyarrow)
+
+Run "python benchmark.py --save-baseline" to store the results in bench_baseline.json, and
+"python benchmark.py" to compare a later run against it.
+"""
+from bs4 import BeautifulSoup
+import BaseHTTPServer
+import SocketServer
+import threading
+import multiprocessing
+import resource
+import tempfile
+import shutil
+import hashlib
+import timeit
+import json
+import time
+import gzip
+import StringIO
+import sys
+import os
+import re
+import random
+import numpy as np
+import pandas as pd
+import sqlite3
+import streeteasy_scrape_public as scrape
+import csv2sql
+import query
+import export
+import amenities
+import transit
+import work_queue
+
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_baseline.json')
+BOROUGH_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Data', 'neighborhood_borough.csv')
+NEIGHBORHOODS = list(pd.read_csv(BOROUGH_FILE)['Name'].drop_duplicates())
+UNIT_TYPES = ["Rental Unit", "Condo", "Multi-family", "Town house", "Co-op", "House"]
+REALTORS = ["Acme Realty", "Citi Habitats", "Corcoran", "Douglas Elliman", "Town Residential", "Halstead"]
+LISTINGS_PER_PAGE = 14
+AMENITY_QUERY = ["doorman", "gym", "pets_allowed"]
+TRANSIT_QUERY = ["A", "C", "E"]
+ERROR_PAGE = '<html><body><div class="error-message">Sorry, this page does not exist.</div></body></html>'
+
+
+#########
+#Synthetic pages
+#########
+
+def filler(n):
+    """Return n blocks of page furniture (navigation, scripts, similar-listing cards) that the
+    scraper does not read, to bring synthetic pages closer to the size of real ones.
+    """
+    return ''.join('''<div class="nav_block"><ul><li><a href="/nav/%d">Link %d</a></li><li><a href="/x">More</a></li></ul>
+<script type="text/javascript">var block_%d = {"id": %d, "tracking": true};</script>
+<div class="similar_listing"><a href="/rental/9%d"><img src="/img/%d.jpg"/></a><span class="similar_price">$3,000</span></div></div>
+''' % (j, j, j, j, j, j) for j in range(n))
+
+
+def listing_price(i, day=0):
+    """Return the rent of listing i on a given day.  Each day 5% of the listings change
+    price.
+    """
+    return 1200 + (i * 7919) % 7800 + 50 * int((np.random.RandomState(i).rand(day) < 0.05).sum())
+
+
+def detail_page(i, n_filler=150, day=0):
+    """Return a synthetic listing detail page laid out like a streeteasy.com detail page.
+    The price, size, neighborhood, amenities and subway lines vary with i, and the price also
+    with day (see listing_price).  n_filler blocks of unread markup are added around the
+    listing (see filler).
+    """
+    rng = np.random.RandomState(i)
+    beds = rng.randint(0, 5)
+    cells = ['<span class="detail_cell">%d rooms</span>' % (beds + 2)]
+    if beds:
+        cells.append('<span class="detail_cell">%d bed%s</span>' % (beds, 's' if beds > 1 else ''))
+    cells.append('<span class="detail_cell">%d bath</span>' % (rng.randint(1, 3)))
+    if rng.rand() < 0.4:
+        cells.append('<span class="detail_cell">%s ft&sup2</span>' % ('{:,}'.format(rng.randint(300, 2500))))
+    amenities = [a.title() for a in scrape.AMENITIES if rng.rand() < 0.3]
+    stops = []
+    for j in range(rng.randint(1, 6)):
+        lines = rng.choice(scrape.TRANSPORT, rng.randint(1, 4), replace=False)
+        if rng.rand() < 0.5:
+            distance = "%d feet" % (rng.randint(50, 1000))
+        else:
+            distance = "%.2f miles" % (rng.rand() * 1.5 + 0.2)
+        stops.append('<p>%s at Stop %d <b>%s</b></p>' %
+                     (''.join('<span class="sub_icon line_%s"></span>' % (l) for l in lines), j, distance))
+    return '''<html><body>%s
+<h1><a class="incognito">%d Main St #%d</a></h1>
+<div class="price">%s<span class="price_arrow">v</span><span class="secondary_text">FOR RENT</span></div>
+<div class="details_info">%s</div>
+<span class="nobreak">%s</span> <span class="nobreak">in %s</span>
+<div class="vitals top_spacer"><h6>%d days on StreetEasy</h6></div>
+<div id="agent-promo"><a>%s</a></div>
+<div class="amenities big_separator"><ul>%s</ul></div>
+<div class="transportation">%s</div>%s
+</body></html>''' % (filler(n_filler // 2), i % 997, i, '${:,}'.format(listing_price(i, day)), ''.join(cells),
+                       UNIT_TYPES[rng.randint(len(UNIT_TYPES))], NEIGHBORHOODS[rng.randint(len(NEIGHBORHOODS))],
+                       rng.randint(0, 120), REALTORS[rng.randint(len(REALTORS))],
+                       ''.join('<li>%s</li>' % (a) for a in amenities), ''.join(stops),
+                       filler(n_filler - n_filler // 2))
+
+
+def index_page(data_ids, n_filler=30, day=0):
+    """Return a synthetic listings page with one card per data_id, showing its price on day."""
+    cards = ''.join('<div class="item" data-id="%d"><a href="/rental/%d">Listing %d</a>'
+                    '<span class="price">%s</span></div>\n' % (i, i, i, '${:,}'.format(listing_price(i, day)))
+                    for i in data_ids)
+    return '<html><body>%s<div class="listings">%s</div>%s</body></html>' % (filler(n_filler), cards, filler(n_filler))
+
+
+def write_corpus(directory, n_pages=20, per_page=LISTINGS_PER_PAGE, n_filler=150, day=0):
+    """Write a corpus of n_pages listings pages and their detail pages to directory:
+    index/<page>.html and detail/<data_id>.html.  Prices are those of day, so writing the
+    corpus again with the next day changes 5% of them.  Returns the list of data_ids.
+    """
+    for sub in ['index', 'detail']:
+        if not os.path.isdir(os.path.join(directory, sub)):
+            os.makedirs(os.path.join(directory, sub))
+    data_ids = []
+    for page in range(1, n_pages + 1):
+        ids = [1000000 + page * 100 + k for k in range(per_page)]
+        with open(os.path.join(directory, 'index', '%d.html' % (page)), 'w') as f:
+            f.write(index_page(ids, day=day))
+        for i in ids:
+            with open(os.path.join(directory, 'detail', '%d.html' % (i)), 'w') as f:
+                f.write(detail_page(i, n_filler, day))
+        data_ids.extend(ids)
+    return data_ids
+
+
+def merged_table(con, n_rows, table_name='all_data'):
+    """Write a synthetic merged table of n_rows listings with the columns of csv2sql.
+    Returns the DataFrame.
+    """
+    rng = np.random.RandomState(0)
+    boroughs = pd.read_csv(BOROUGH_FILE).groupby('Name')['Borough'].max()
+    df = pd.DataFrame({'data_id': np.arange(n_rows) + 1000000})
+    for col in csv2sql.TABLE_COLUMNS[1:]:
+        df[col] = rng.randint(0, 2, n_rows)
+    df['scrape_date'] = '2017-01-11'
+    df['neighborhood'] = np.array(NEIGHBORHOODS)[rng.randint(len(NEIGHBORHOODS), size=n_rows)]
+    df['borough'] = df['neighborhood'].map(boroughs)
+    df['unit_type'] = np.array(UNIT_TYPES)[rng.randint(len(UNIT_TYPES), size=n_rows)]
+    df['realtor'] = np.array(REALTORS)[rng.randint(len(REALTORS), size=n_rows)]
+    df['address'] = ['%d Main St' % (i) for i in range(n_rows)]
+    df['link'] = ['http://streeteasy.com/rental/%d' % (i) for i in df['data_id']]
+    df['price'] = rng.randint(1200, 9000, n_rows).astype(float)
+    df['beds'] = rng.randint(0, 5, n_rows)
+    df['sq_ft'] = rng.randint(300, 2500, n_rows).astype(float)
+    df['amenity_mask'] = amenities.pack(df)
+    #about one listing in five is within 1.5 miles of each line
+    for col in transit.COLUMNS:
+        df[col] = np.where(rng.rand(n_rows) < 0.2, rng.uniform(0.01, 1.5, n_rows), 0)
+    features = transit.features(df)
+    for col in transit.FEATURE_COLUMNS:
+        df[col] = features[col]
+    csv2sql.bulk_load(con, table_name, df)
+    return df
+
+
+#########
+#Local HTTP stand-in
+#########
+
+class FixtureServer(object):
+    """Serve a corpus written by write_corpus over HTTP/1.1 on localhost, with keep-alive,
+    ETag/If-None-Match and gzip.  /for-rent/nyc?page=N returns index/N.html, or the error
+    page past the last page, and /rental/<data_id> returns detail/<data_id>.html.
+
+    Parameters
+    ----------
+      corpus_dir: str
+        - directory written by write_corpus.
+      latency: float, default 0
+        - seconds to wait before answering a detail page request, to simulate the network.
+      throttle_rate: float, default None
+        - requests per second above which the server answers 429 with Retry-After: 1, like
+          a rate-limiting front end.  None for no limit.
+      slow_prob: float, default 0
+        - probability that a request is answered slow_latency seconds late.
+      slow_latency: float, default 1
+        - delay of slow responses in seconds.
+      error_prob: float, default 0
+        - probability that a request is answered 503.
+    """
+
+    def __init__(self, corpus_dir, latency=0, throttle_rate=None, slow_prob=0, slow_latency=1, error_prob=0):
+        self.corpus_dir = corpus_dir
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.slow_prob = slow_prob
+        self.slow_latency = slow_latency
+        self.error_prob = error_prob
+        self.requests = 0
+        self.throttled = 0
+        self.errors = 0
+        self._tokens = throttle_rate
+        self._refilled = time.time()
+        self._random = random.Random(0)
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                server.requests += 1
+                fault = server.fault()
+                if fault:
+                    status, body = fault
+                else:
+                    status, body = server.page(self.path)
+                server.respond(self, status, body)
+
+        class HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+        self.httpd = HTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d' % (self.httpd.server_address[1])
+
+    def fault(self):
+        """Return (status, body) of an injected 429 or 503, or None to serve the page.  Slow
+        responses are delayed here.
+        """
+        with self._lock:
+            if self.throttle_rate is not None:
+                now = time.time()
+                self._tokens = min(self.throttle_rate, self._tokens + (now - self._refilled) * self.throttle_rate)
+                self._refilled = now
+                if self._tokens < 1:
+                    self.throttled += 1
+                    return 429, ''
+                self._tokens -= 1
+            slow = self._random.random() < self.slow_prob
+            error = self._random.random() < self.error_prob
+            if error:
+                self.errors += 1
+        if slow:
+            time.sleep(self.slow_latency)
+        if error:
+            return 503, ''
+        return None
+
+    def page(self, path):
+        """Return (status, body) for a request path."""
+        match = re.search(r'page=(\d+)', path)
+        if match:
+            name = os.path.join(self.corpus_dir, 'index', '%s.html' % (match.group(1)))
+            if not os.path.isfile(name):
+                return 404, ERROR_PAGE
+        else:
+            if self.latency:
+                time.sleep(self.latency)
+            name = os.path.join(self.corpus_dir, 'detail', '%s.html' % (path.rstrip('/').split('/')[-1]))
+            if not os.path.isfile(name):
+                return 404, ''
+        with open(name) as f:
+            return 200, f.read()
+
+    def respond(self, handler, status, body):
+        """Send a response, honoring If-None-Match and Accept-Encoding: gzip."""
+        etag = '"%s"' % (hashlib.md5(body).hexdigest())
+        if status == 200 and handler.headers.get('If-None-Match') == etag:
+            handler.send_response(304)
+            handler.send_header('ETag', etag)
+            handler.send_header('Content-Length', '0')
+            handler.end_headers()
+            return
+        gzipped = 'gzip' in handler.headers.get('Accept-Encoding', '')
+        if gzipped:
+            buf = StringIO.StringIO()
+            f = gzip.GzipFile(fileobj=buf, mode='wb')
+            f.write(body)
+            f.close()
+            body = buf.getvalue()
+        handler.send_response(status)
+        if status in (429, 503):
+            handler.send_header('Retry-After', '1')
+        handler.send_header('Content-Type', 'text/html')
+        handler.send_header('ETag', etag)
+        if gzipped:
+            handler.send_header('Content-Encoding', 'gzip')
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def start(self):
+        thread = threading.Thread(target=self.httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class _Quiet(object):
+    """Context manager that silences the scraper's print output."""
+
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def __exit__(self, *args):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+
+def _crawl(corpus_dir, n_pages, workers, latency, faults=None, **kwargs):
+    """Run streeteasy_scrape_public.main against a FixtureServer in a scratch directory.
+    faults are FixtureServer keyword arguments, kwargs are passed to the scraper, which by
+    default does not pace its requests.  Returns (DataFrame of the listings, seconds, server).
+    """
+    server = FixtureServer(corpus_dir, latency, **(faults or {})).start()
+    options = dict(rate=None, adaptive=False)
+    options.update(kwargs)
+    cwd = os.getcwd()
+    tmp = tempfile.mkdtemp()
+    try:
+        os.chdir(tmp)
+        with _Quiet():
+            start = time.time()
+            df = scrape.main(max_pages=n_pages + 2, partial_save=2, workers=workers, base_url=server.url, **options)
+            seconds = time.time() - start
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp)
+        server.stop()
+    return df, seconds, server
+
+
+#########
+#Benchmarks
+#########
+
+def legacy_amenities_transport(soup):
+    """Amenity and transit extraction as it was done before AMENITY_RE and parse_transport,
+    kept as the baseline for bench_parse.
+    """
+    d = {}
+    amenities_str = str(soup.findAll(class_="amenities big_separator"))
+    for a in scrape.AMENITIES:
+        match = re.search(a, amenities_str, re.IGNORECASE)
+        if match:
+            d[a] = 1
+        else:
+            d[a] = 0
+    sub = soup.find(class_="transportation")
+    for s in sub:
+        for l in scrape.TRANSPORT:
+            match = re.search('"sub_icon line_%s"' % (l), str(s))
+            if match:
+                distance = re.search(r'<b>(.+)</b>', str(s)).group(1)
+                dist_num = float(re.search(r'([0-9]+.[0-9]+|[0-9]+)', distance).group(1))
+                ft_check = re.search(r'feet', distance)
+                if ft_check:
+                    dist_num = dist_num * 0.000189394
+                if (l not in d) or (dist_num < d[l]):
+                    d[l] = dist_num
+    return d
+
+
+def amenities_transport(soup):
+    """Amenity and transit extraction as done by streeteasy_scrape_public.parse_listing."""
+    d = scrape.parse_amenities(str(soup.findAll(class_="amenities big_separator")))
+    d.update(scrape.parse_transport(soup.find(class_="transportation")))
+    return d
+
+
+def bench_parse(n_pages=200, repeat=3):
+    """Time amenity and transit extraction per listing, before and after the compiled
+    matcher, on n_pages synthetic detail pages without filler.  Returns microseconds per
+    listing for each.
+    """
+    soups = [BeautifulSoup(detail_page(i, n_filler=0), "lxml") for i in range(n_pages)]
+    for soup in soups:
+        if legacy_amenities_transport(soup) != amenities_transport(soup):
+            raise AssertionError("compiled matcher disagrees with the legacy parser")
+    results = {}
+    for name, func in [("legacy", legacy_amenities_transport), ("compiled", amenities_transport)]:
+        t = min(timeit.repeat(lambda: [func(s) for s in soups], number=1, repeat=repeat))
+        results['amenities_transport_%s_us' % (name)] = 1e6 * t / n_pages
+    return results
+
+
+def bench_soup(n_pages=100, repeat=3):
+    """Time building the BeautifulSoup tree of a detail page with and without DETAIL_STRAINER.
+    Returns milliseconds per listing for each.
+    """
+    pages = [detail_page(i) for i in range(n_pages)]
+    timings = [("full", lambda: [BeautifulSoup(p, "lxml") for p in pages]),
+               ("strained", lambda: [BeautifulSoup(p, "lxml", parse_only=scrape.DETAIL_STRAINER) for p in pages])]
+    results = {}
+    for name, func in timings:
+        t = min(timeit.repeat(func, number=1, repeat=repeat))
+        results['soup_%s_ms' % (name)] = 1e3 * t / n_pages
+    return results
+
+
+def bench_parse_corpus(corpus_dir):
+    """Time parse_listing on every detail page of the corpus, read from disk.  Returns
+    p50/p99 milliseconds per listing and listings/sec.
+    """
+    detail_dir = os.path.join(corpus_dir, 'detail')
+    pages = []
+    for name in sorted(os.listdir(detail_dir)):
+        with open(os.path.join(detail_dir, name)) as f:
+            pages.append(f.read())
+    times = []
+    for html in pages:
+        start = timeit.default_timer()
+        scrape.parse_listing(html, scrape.new_record(0, '', ''))
+        times.append(timeit.default_timer() - start)
+    times = np.array(times) * 1e3
+    return {'parse_p50_ms': np.percentile(times, 50), 'parse_p99_ms': np.percentile(times, 99),
+            'parse_listings_per_sec': len(times) / (times.sum() / 1e3)}
+
+
+def bench_fetch(corpus_dir, n_pages, concurrency=(1, 4, 16), latency=0.02):
+    """Crawl the corpus end to end through the local server, which waits latency seconds
+    per detail page, at each fetch concurrency level.  Returns listings/sec for each level.
+    """
+    results = {}
+    for workers in concurrency:
+        df, seconds, server = _crawl(corpus_dir, n_pages, workers, latency)
+        results['crawl_workers_%d_listings_per_sec' % (workers)] = len(df) / seconds
+    return results
+
+
+def bench_throttle(corpus_dir, n_pages, workers=16, throttle_rate=10, latency=0.02):
+    """Crawl the corpus through a local server that answers 429 above throttle_rate requests
+    per second, delays 2% of the responses by 0.5 s and answers 1% with 503, with workers
+    fetch threads: unpaced with no retries, unpaced with retries, and with the adaptive
+    scheduler.  Returns listings/sec, the share of listings lost and 429s per 100 requests
+    for each.
+    """
+    faults = dict(throttle_rate=throttle_rate, slow_prob=0.02, slow_latency=0.5, error_prob=0.01)
+    variants = [
+        ('unpaced', dict(adaptive=False, retries=0)),
+        ('retry', dict(adaptive=False, retries=3)),
+        ('adaptive', dict(adaptive=True, retries=3)),
+    ]
+    expected = n_pages * LISTINGS_PER_PAGE
+    results = {}
+    for name, options in variants:
+        df, seconds, server = _crawl(corpus_dir, n_pages, workers, latency, faults, **options)
+        n = len(df)
+        results['throttle_%s_listings_per_sec' % (name)] = n / seconds
+        results['throttle_%s_lost_pct' % (name)] = 100. * (expected - n) / expected
+        results['throttle_%s_429_per_100_requests' % (name)] = 100. * server.throttled / server.requests
+    return results
+
+
+def bench_sharded(corpus_dir, n_pages, n_workers=(1, 2, 4), threads=2, latency=0.05):
+    """Crawl the corpus with work_queue.main and n_workers worker processes of threads fetch
+    threads each, two listings pages per task.  Returns listings/sec for each number of
+    workers, and the share of listings missing from the merged csv.
+    """
+    expected = n_pages * LISTINGS_PER_PAGE
+    results = {}
+    for n in n_workers:
+        server = FixtureServer(corpus_dir, latency).start()
+        cwd = os.getcwd()
+        tmp = tempfile.mkdtemp()
+        try:
+            os.chdir(tmp)
+            with _Quiet():
+                start = time.time()
+                df = work_queue.main('queue.db', n, max_pages=n_pages + 2, pages_per_task=2, workers=threads,
+                                     base_url=server.url, rate=None, adaptive=False)
+                seconds = time.time() - start
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(tmp)
+            server.stop()
+        results['sharded_workers_%d_listings_per_sec' % (n)] = len(df) / seconds
+        results['sharded_workers_%d_lost_pct' % (n)] = 100. * (expected - len(df)) / expected
+    return results
+
+
+def bench_snapshot(n_pages, workers=4, latency=0.02):
+    """Crawl a corpus, write it again for the next day (5% of the prices change) and crawl
+    it again, once downloading every listing and once comparing the cards with the first
+    crawl (see snapshot.py).  Returns listings/sec and requests per listing of both, and the
+    number of listings in which the two crawls differ.  The snapshot crawl is repeated with a
+    snapshot written before amenity_mask existed, which must give the same listings.
+    """
+    corpus_dir = tempfile.mkdtemp()
+    try:
+        write_corpus(corpus_dir, n_pages)
+        before, seconds, server = _crawl(corpus_dir, n_pages, workers, latency)
+        snapshot_file = os.path.join(corpus_dir, 'snapshot.csv')
+        before.to_csv(snapshot_file)
+        legacy_file = os.path.join(corpus_dir, 'legacy.csv')
+        before.drop('amenity_mask', axis=1).to_csv(legacy_file)
+        write_corpus(corpus_dir, n_pages, day=1)
+        results = {}
+        crawls = {}
+        for name, options in [('full', {}), ('snapshot', dict(snapshot=snapshot_file)),
+                              ('legacy', dict(snapshot=legacy_file))]:
+            crawls[name], seconds, server = _crawl(corpus_dir, n_pages, workers, latency, **options)
+            results['snapshot_%s_listings_per_sec' % (name)] = len(crawls[name]) / seconds
+            results['snapshot_%s_requests_per_listing' % (name)] = float(server.requests) / len(crawls[name])
+    finally:
+        shutil.rmtree(corpus_dir)
+    #the links differ in the port of the local server
+    full = crawls['full'].set_index('data_id').sort_index().drop('link', axis=1)
+    for name, key in [('snapshot', 'snapshot_listings_differing'), ('legacy', 'snapshot_legacy_listings_differing')]:
+        carried = crawls[name].set_index('data_id').sort_index().reindex(full.index)[full.columns]
+        same = (full == carried) | (full.isnull() & carried.isnull())
+        #distances go through the csv once more when carried forward
+        numeric = full.select_dtypes(include=[np.number]).columns
+        same[numeric] |= np.isclose(full[numeric].astype(float), carried[numeric].astype(float))
+        results[key] = float(len(full) - same.all(axis=1).sum())
+    return results
+
+
+def _rss_child(corpus_dir, n_pages, q):
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    df, seconds, server = _crawl(corpus_dir, n_pages, 8, 0)
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    q.put((len(df), before, after))
+
+
+def bench_rss(corpus_dir, n_pages):
+    """Crawl the corpus in a fresh process and return its peak RSS growth in MB per 10k
+    listings (ru_maxrss, Linux units).
+    """
+    q = multiprocessing.Queue()
+    p = multiprocessing.Process(target=_rss_child, args=(corpus_dir, n_pages, q))
+    p.start()
+    n, before, after = q.get()
+    p.join()
+    return {'peak_rss_mb_per_10k_listings': (after - before) / 1024. * 10000 / max(n, 1)}
+
+
+def bench_queries(n_rows=63000, n_queries=200):
+    """Time each query shape of query.ListingQueries on a synthetic merged table of n_rows
+    listings: without indexes, with the indexes of query.INDEXES, and with the result cache
+    (the same n_queries // 10 parameter sets repeated).  Returns p50 milliseconds per query
+    for each shape and variant.
+    """
+    rng = np.random.RandomState(1)
+    db_dir = tempfile.mkdtemp()
+    db_name = os.path.join(db_dir, 'bench.db')
+    try:
+        con = sqlite3.connect(db_name)
+        df = merged_table(con, n_rows)
+        con.close()
+        nhoods = df['neighborhood'].unique()
+        boroughs = df['borough'].dropna().unique()
+        params = [(nhoods[rng.randint(len(nhoods))], boroughs[rng.randint(len(boroughs))], rng.randint(0, 5),
+                   rng.randint(1200, 6000)) for i in range(n_queries // 10)]
+        shapes = [
+            ('listings_nhood_beds', lambda q, (n, b, beds, p): q.listings(neighborhood=n, beds=beds)),
+            ('listings_borough_price', lambda q, (n, b, beds, p): q.listings(borough=b, min_price=p, max_price=p + 500)),
+            ('count_beds_price', lambda q, (n, b, beds, p): q.count(beds=beds, min_price=p)),
+            ('median_price', lambda q, (n, b, beds, p): q.median_price(n, beds)),
+            ('median_price_by_nhood', lambda q, (n, b, beds, p): q.median_price_by('neighborhood')),
+            ('listings_amenities', lambda q, (n, b, beds, p): q.listings(amenities_all=AMENITY_QUERY, max_price=p)),
+            ('near_lines', lambda q, (n, b, beds, p): q.near_lines(TRANSIT_QUERY, 0.25, max_price=p)),
+        ]
+        results = {}
+        for variant in ['scan', 'indexed', 'cached']:
+            q = query.ListingQueries(db_name, cache_size=256 if variant == 'cached' else 0)
+            if variant == 'indexed':
+                query.create_indexes(q.con, q.table_name)
+            for name, func in shapes:
+                n = n_queries if variant != 'scan' or not name.startswith('median_price_by') else 10
+                times = []
+                for i in range(n):
+                    start = timeit.default_timer()
+                    func(q, params[i % len(params)])
+                    times.append(timeit.default_timer() - start)
+                results['query_%s_%s_p50_ms' % (name, variant)] = 1e3 * np.percentile(times, 50)
+            q.close()
+    finally:
+        shutil.rmtree(db_dir)
+    return results
+
+
+def bench_amenities(n_rows=63000, repeat=5):
+    """Time the filter "doorman AND gym AND pets allowed" on a synthetic table of n_rows
+    listings, with one predicate per amenity column and with the packed mask, in SQLite
+    (also with the indexes of query.py) and in NumPy.  Also times building the amenity
+    feature matrix from the columns and from the masks.  Returns milliseconds for each.
+    """
+    db_dir = tempfile.mkdtemp()
+    try:
+        con = sqlite3.connect(os.path.join(db_dir, 'bench.db'))
+        df = merged_table(con, n_rows)
+        masks = df['amenity_mask'].values
+        columns_sql = "SELECT COUNT(*) FROM all_data WHERE %s;" % (" AND ".join("%s = 1" % (a) for a in AMENITY_QUERY))
+        clause, params = amenities.sql_filter(all_of=AMENITY_QUERY)
+        mask_sql = "SELECT COUNT(*) FROM all_data WHERE %s;" % (clause)
+        if con.execute(columns_sql).fetchone() != con.execute(mask_sql, params).fetchone():
+            raise AssertionError("amenity_mask filter disagrees with the amenity columns")
+        timings = [
+            ('sql_columns', lambda: con.execute(columns_sql).fetchone()),
+            ('sql_mask', lambda: con.execute(mask_sql, params).fetchone()),
+            ('numpy_columns', lambda: np.logical_and.reduce([df[a].values == 1 for a in AMENITY_QUERY])),
+            ('numpy_mask', lambda: amenities.match(masks, all_of=AMENITY_QUERY)),
+            ('matrix_columns', lambda: df[amenities.COLUMNS].values.astype(np.int8)),
+            ('matrix_mask', lambda: amenities.unpack(masks)),
+        ]
+        results = {}
+        for name, func in timings:
+            t = min(timeit.repeat(func, number=1, repeat=repeat))
+            results['amenity_filter_%s_ms' % (name)] = 1e3 * t
+        #with the indexes of query.py the mask filter scans the small amenity_mask index
+        query.create_indexes(con, 'all_data')
+        t = min(timeit.repeat(lambda: con.execute(mask_sql, params).fetchone(), number=1, repeat=repeat))
+        results['amenity_filter_sql_mask_indexed_ms'] = 1e3 * t
+        con.close()
+    finally:
+        shutil.rmtree(db_dir)
+    return results
+
+
+def bench_export(n_rows=63000, columns=('price', 'beds', 'baths', 'sq_ft', 'borough', 'doorman', 'gym', 'line_A')):
+    """Time loading a synthetic daily table of n_rows listings with pandas.read_sql, and
+    loading the given feature columns from its columnar export.  Returns seconds and
+    DataFrame MB for each.  Empty if pyarrow is not installed.
+    """
+    if export.pa is None:
+        return {}
+    work_dir = tempfile.mkdtemp()
+    try:
+        db_name = os.path.join(work_dir, 'bench.db')
+        con = sqlite3.connect(db_name)
+        merged_table(con, n_rows, 't20170111')
+        con.close()
+        export.main(db_name, os.path.join(work_dir, 'columnar'))
+        loads = [('sqlite', lambda: pd.read_sql("SELECT * FROM v_t20170111;", sqlite3.connect(db_name))),
+                 ('columnar', lambda: export.read_features(os.path.join(work_dir, 'columnar'), list(columns)))]
+        results = {}
+        for name, func in loads:
+            start = timeit.default_timer()
+            df = func()
+            results['features_%s_s' % (name)] = timeit.default_timer() - start
+            results['features_%s_mb' % (name)] = df.memory_usage(deep=True).sum() / 1e6
+    finally:
+        shutil.rmtree(work_dir)
+    return results
+
+
+def run(n_pages=20):
+    """Run the whole suite on a fresh corpus of n_pages listings pages.  Returns a dict of
+    results.
+    """
+    corpus_dir = tempfile.mkdtemp()
+    try:
+        write_corpus(corpus_dir, n_pages)
+        results = {}
+        results.update(bench_parse())
+        results.update(bench_soup())
+        results.update(bench_parse_corpus(corpus_dir))
+        results.update(bench_fetch(corpus_dir, n_pages))
+        results.update(bench_throttle(corpus_dir, n_pages))
+        results.update(bench_sharded(corpus_dir, n_pages))
+        results.update(bench_snapshot(n_pages))
+        results.update(bench_rss(corpus_dir, n_pages))
+        results.update(bench_queries())
+        results.update(bench_amenities())
+        results.update(bench_export())
+    finally:
+        shutil.rmtree(corpus_dir)
+    return results
+
+
+def main(save_baseline=False):
+    """Run the suite and print each result next to the stored baseline, if any.  With
+    save_baseline the results replace the stored baseline.
+    """
+    results = run()
+    baseline = {}
+    if os.path.isfile(BASELINE_FILE):
+        with open(BASELINE_FILE) as f:
+            baseline = json.load(f)
+    print "%-42s %12s %12s %8s" % ("benchmark", "result", "baseline", "ratio")
+    for key in sorted(results):
+        if key in baseline:
+            print "%-42s %12.2f %12.2f %8.2f" % (key, results[key], baseline[key], results[key] / baseline[key])
+        else:
+            print "%-42s %12.2f %12s %8s" % (key, results[key], "-", "-")
+    if save_baseline:
+        with open(BASELINE_FILE, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+        print "Saved baseline to %s" % (BASELINE_FILE)
+
+if __name__ == '__main__':
+    main(save_baseline='--save-baseline' in sys.argv)
@@ -0,0 +1,130 @@
+"""
+Append-only partial saves for streeteasy_scrape_public.py.
+
+Each partial save writes only the listings scraped since the previous save to a new
+numbered shard file and records it in a small JSON manifest, so the cost of a save depends
+on the new rows only.  At the end of a run the shards are joined into the daily .csv.
+"""
+import os
+import json
+import numpy as np
+import pandas as pd
+
+
+class PartialSaver(object):
+    """Write scraped listings to numbered shard files with a checkpoint manifest.
+
+    The directory holds shard_00000.csv, shard_00001.csv, ... and manifest.json:
+
+        {"last_page": 4,
+         "rows": 80,
+         "shards": [{"file": "shard_00000.csv", "page": 2, "rows": 40},
+                    {"file": "shard_00001.csv", "page": 4, "rows": 40}]}
+
+    where "page" is the last listings page included in the shard.  A shard is written to a
+    temporary file and renamed before the manifest is updated, so the manifest only ever
+    lists complete shards.
+
+    Parameters
+    ----------
+      directory: str
+        - directory for the shards and manifest.  Created if it does not exist.  Shards from
+          an earlier run in the same directory are removed unless resume is True.
+      columns: list of str
+        - column names, used to write the header when no listings were saved.
+      resume: bool, default False
+        - if True and a manifest exists, keep its shards and continue adding new ones after
+          them.  Use last_page and seen_ids() to pick up where the earlier run stopped.
+    """
+
+    def __init__(self, directory, columns, resume=False):
+        self.directory = directory
+        self.columns = list(columns)
+        self.manifest_file = os.path.join(directory, 'manifest.json')
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        #continue from the checkpoint of an earlier run
+        if resume and os.path.isfile(self.manifest_file):
+            self.manifest = self.read_manifest()
+            return
+        #start over, removing the shards of an earlier run
+        if os.path.isfile(self.manifest_file):
+            for shard in self.read_manifest()['shards']:
+                path = os.path.join(directory, shard['file'])
+                if os.path.isfile(path):
+                    os.remove(path)
+        self.manifest = {'last_page': 0, 'rows': 0, 'shards': []}
+        self._write_manifest()
+
+    def read_manifest(self):
+        """Return the manifest stored on disk."""
+        with open(self.manifest_file) as f:
+            return json.load(f)
+
+    @property
+    def last_page(self):
+        """Last listings page included in a saved shard."""
+        return self.manifest['last_page']
+
+    def seen_ids(self):
+        """Return the set of data_ids already saved in the shards."""
+        ids = set()
+        for shard in self.manifest['shards']:
+            path = os.path.join(self.directory, shard['file'])
+            ids.update(pd.read_csv(path, usecols=['data_id'])['data_id'])
+        return ids
+
+    def _write_manifest(self):
+        tmp = self.manifest_file + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.manifest, f, indent=1)
+        if os.path.isfile(self.manifest_file):
+            os.remove(self.manifest_file)
+        os.rename(tmp, self.manifest_file)
+
+    def save(self, df, page):
+        """Append the listings in df as a new shard.
+
+        Parameters
+        ----------
+          df: DataFrame
+            - listings scraped since the last save.  Its index is replaced with the running
+              row number so that the compacted csv is numbered 0..n-1.
+          page: int
+            - last listings page included in df.
+        """
+        if len(df):
+            name = 'shard_%05d.csv' % (len(self.manifest['shards']))
+            path = os.path.join(self.directory, name)
+            df.index = np.arange(self.manifest['rows'], self.manifest['rows'] + len(df))
+            df.to_csv(path + '.tmp')
+            os.rename(path + '.tmp', path)
+            self.manifest['shards'].append({'file': name, 'page': int(page), 'rows': len(df)})
+            self.manifest['rows'] += len(df)
+        self.manifest['last_page'] = int(page)
+        self._write_manifest()
+
+    def compact(self, csv_file):
+        """Join all shards into a single csv, keeping one header line.  The shards are
+        streamed line by line and are not loaded into memory.
+
+        Parameters
+        ----------
+          csv_file: str
+            - name and path of the output csv.
+        """
+        shards = self.manifest['shards']
+        if not shards:
+            pd.DataFrame(columns=self.columns).to_csv(csv_file)
+            return
+        with open(csv_file + '.tmp', 'w') as out:
+            for i, shard in enumerate(shards):
+                with open(os.path.join(self.directory, shard['file'])) as f:
+                    header = f.readline()
+                    if i == 0:
+                        out.write(header)
+                    for line in f:
+                        out.write(line)
+        if os.path.isfile(csv_file):
+            os.remove(csv_file)
+        os.rename(csv_file + '.tmp', csv_file)
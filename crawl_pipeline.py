@@ -0,0 +1,337 @@
+"""
+Staged version of streeteasy_scrape_public.main.
+
+The crawl is split into four stages connected by bounded queues:
+
+    discovery  (1 thread)       fetch listings pages, read the listing cards
+    fetch      (fetch_workers)  download detail pages
+    parse      (parse_workers)  parse detail pages, in a process pool if parse_processes is true
+    sink       (main thread)    put listings back in page order, partial saves, final csv
+
+Each queue holds at most queue_size items, so a slow stage holds back the stages before it
+(backpressure) without stalling them on every item.  Output, partial saves and resume
+behave as in streeteasy_scrape_public.main.
+"""
+import os
+import sys
+import datetime
+import heapq
+import threading
+import Queue
+import multiprocessing
+import pandas as pd
+from streeteasy_scrape_public import (COL_LIST, COL_DTYPES, RecordBuffer, index_url, parse_index, plan_cards,
+                                      new_record, parse_listing, print_err, record_http_metrics)
+from checkpoint import PartialSaver
+from http_client import HTTPClient
+from scheduler import Scheduler, BudgetExhausted
+from html_archive import HTMLArchive
+import snapshot
+import metrics
+from metrics import log, DEBUG, INFO, ERROR
+
+
+# queue sentinel marking the end of a stage's input
+DONE = None
+
+
+def parse_detail(args):
+    """Parse one detail page.  Runs in a parse thread or a worker process.
+
+    Parameters
+    ----------
+      args: tuple (data_id, link, scrape_date, html)
+
+    Returns the listing dict, or None if the page could not be parsed (the error is printed).
+    """
+    data_id, link, scrape_date, html = args
+    try:
+        return parse_listing(html, new_record(data_id, link, scrape_date))
+    except:
+        log(ERROR, "Error parsing data_id %d", data_id)
+        print_err()
+        return None
+
+
+class _Stage(object):
+    """A group of worker threads that take items from an input queue and put results on an
+    output queue.  When every worker has seen the DONE sentinel, n_next sentinels are put on
+    the output queue for the next stage.  If func raises, the error is printed and the item
+    is passed on as a listing that could not be scraped, (seq, "listing", None).
+    """
+
+    def __init__(self, name, func, q_in, q_out, workers, n_next):
+        self.func = func
+        self.q_in = q_in
+        self.q_out = q_out
+        self.n_next = n_next
+        self._running = workers
+        self._lock = threading.Lock()
+        self.threads = [threading.Thread(target=self._run, name='%s-%d' % (name, i)) for i in range(workers)]
+        for t in self.threads:
+            t.daemon = True
+            t.start()
+
+    def _run(self):
+        try:
+            while True:
+                item = self.q_in.get()
+                if item is DONE:
+                    break
+                try:
+                    result = self.func(item)
+                except:
+                    #pass on the seq as a lost listing, or the sink would wait for it forever
+                    log(ERROR, "Error in %s", threading.current_thread().name)
+                    print_err()
+                    result = item[0], 'listing', None
+                self.q_out.put(result)
+        finally:
+            with self._lock:
+                self._running -= 1
+                last = self._running == 0
+            if last:
+                for i in range(self.n_next):
+                    self.q_out.put(DONE)
+
+
+def main(**kwargs):
+    """Loop over all rental listings on streeteasy.com with a staged pipeline and save them
+    in a csv.  Errors on a page or listing are printed and the crawl continues.
+
+    Keyword arguments:
+        max_pages, verbose, partial_save, resume, cache_dir, cache_max_age, archive_dir, base_url,
+        rate, adaptive, retries, max_requests, log_level, metrics_file, snapshot, snapshot_db,
+        snapshot_table, refresh_days
+            As in streeteasy_scrape_public.main.
+        fetch_workers: int, default 8
+            Number of threads downloading detail pages.
+        parse_workers: int, default 2
+            Number of threads parsing detail pages, or of worker processes if parse_processes
+            is true.
+        parse_processes: logical, default True
+            If true, parse in a process pool so that parsing uses more than one CPU.
+        queue_size: int, default 200
+            Maximum number of items waiting between two stages.
+    """
+    #Default keyword arguments
+    max_pages = kwargs.get("max_pages",3000)
+    verbose = kwargs.get("verbose",False)
+    partial_save = kwargs.get("partial_save",2)
+    resume = kwargs.get("resume",False)
+    cache_dir = kwargs.get("cache_dir",None)
+    cache_max_age = kwargs.get("cache_max_age",0)
+    archive_dir = kwargs.get("archive_dir",None)
+    prefix = kwargs.get("base_url","http://streeteasy.com")
+    fetch_workers = kwargs.get("fetch_workers",8)
+    parse_workers = kwargs.get("parse_workers",2)
+    parse_processes = kwargs.get("parse_processes",True)
+    queue_size = kwargs.get("queue_size",200)
+    rate = kwargs.get("rate",5)
+    adaptive = kwargs.get("adaptive",True)
+    retries = kwargs.get("retries",3)
+    max_requests = kwargs.get("max_requests",None)
+    log_level = kwargs.get("log_level","debug" if verbose else "info")
+
+    today = str(datetime.date.today())
+    metrics_file = kwargs.get("metrics_file",today + "_metrics")
+    metrics.reset()
+    metrics.set_level(log_level)
+    scheduler = Scheduler(rate=rate, max_concurrency=fetch_workers, adaptive=adaptive, retries=retries,
+                          max_requests=max_requests)
+    client = HTTPClient(cache_dir=cache_dir, max_age=cache_max_age, pool_size=fetch_workers, scheduler=scheduler)
+    archive = HTMLArchive(archive_dir) if archive_dir else None
+    saver = PartialSaver(os.path.join('partial_save', today), COL_LIST, resume=resume) if partial_save > 0 else None
+    first_page = 1
+    seen = set()
+    if resume and saver:
+        first_page = saver.last_page + 1
+        seen = saver.seen_ids()
+        log(INFO, "Resuming after page %d, %d listings already saved.", saver.last_page, len(seen))
+    snap = snapshot.load(kwargs.get("snapshot",None), kwargs.get("snapshot_db",None),
+                         kwargs.get("snapshot_table","all_data"), kwargs.get("refresh_days",30))
+
+    # Items are (seq, kind, payload) tuples.  seq numbers every item in discovery order so the
+    # sink can restore page order.  kind is "listing", "carried", "budget" or "page".  A
+    # "listing" item carries (data_id, link, page) to the fetch stage, which adds the html,
+    # and the parse stage passes on ((data_id, link, page, html), listing dict) so that the sink
+    # archives the pages in page order.  A
+    # "carried" item is a listing copied from the snapshot, which the fetch and parse stages
+    # pass through and the sink adds to the archive.  A "budget" item replaces a listing dropped because the request budget was
+    # used up; from then on no page is complete.  A "page" item follows the listings of its
+    # page and tells the sink that the page is complete.
+    fetch_q = Queue.Queue(queue_size)
+    parse_q = Queue.Queue(queue_size)
+    sink_q = Queue.Queue(queue_size)
+    budget_out = threading.Event()
+
+    def discover():
+        seq = 0
+        try:
+            for page in range(first_page, max_pages):
+                if budget_out.is_set():
+                    log(INFO, "Request budget used up.  Stopping.")
+                    break
+                try:
+                    log(INFO, "Page %d", page)
+                    url = index_url(prefix, page)
+                    with metrics.timed('index_fetch'):
+                        r = client.get(url).body
+                    if archive:
+                        archive.add(today, url, r, 'index', page=page)
+                    cards = parse_index(r, prefix, prices=True)
+                    if cards is None:
+                        log(INFO, "Page does not exist.  Stopping.")
+                        break
+                    for data_id, link, row in plan_cards(cards, snap, today, seen):
+                        if row is not None:
+                            fetch_q.put((seq, 'carried', row))
+                        else:
+                            fetch_q.put((seq, 'listing', (data_id, link, page)))
+                        seq += 1
+                except BudgetExhausted:
+                    log(INFO, "Request budget used up.  Stopping.")
+                    break
+                except:
+                    log(ERROR, "Error on page %d", page)
+                    print_err()
+                fetch_q.put((seq, 'page', page))
+                seq += 1
+        finally:
+            for i in range(fetch_workers):
+                fetch_q.put(DONE)
+
+    def fetch(item):
+        seq, kind, payload = item
+        if kind != 'listing':
+            return item
+        data_id, link, page = payload
+        try:
+            with metrics.timed('detail_fetch'):
+                html = client.get(link).body
+        except BudgetExhausted:
+            budget_out.set()
+            return seq, 'budget', None
+        except:
+            log(ERROR, "Error fetching data_id %d", data_id)
+            print_err()
+            html = None
+        return seq, kind, (data_id, link, page, html)
+
+    pool = multiprocessing.Pool(parse_workers) if parse_processes else None
+
+    def parse(item):
+        seq, kind, payload = item
+        if kind != 'listing':
+            return item
+        data_id, link, page, html = payload
+        if html is None:
+            return seq, kind, (payload, None)
+        args = (data_id, link, str(datetime.date.today()), html)
+        # each parse thread waits on its own task, so at most parse_workers pages are in the pool
+        try:
+            with metrics.timed('parse'):
+                d = pool.apply(parse_detail, (args,)) if pool else parse_detail(args)
+        except:
+            log(ERROR, "Error parsing data_id %d", data_id)
+            print_err()
+            d = None
+        else:
+            if d is None and pool:
+                #the worker process printed the error, but its metrics are not ours
+                metrics.count('errors', type='parse')
+        return seq, kind, (payload, d)
+
+    discovery = threading.Thread(target=discover, name='discovery')
+    discovery.daemon = True
+    discovery.start()
+    _Stage('fetch', fetch, fetch_q, parse_q, fetch_workers, parse_workers)
+    _Stage('parse', parse, parse_q, sink_q, parse_workers, 1)
+
+    # sink: restore discovery order with a heap keyed on seq, then append and save
+    df_temp = RecordBuffer(COL_LIST, COL_DTYPES)
+    last_page = first_page - 1
+    pending = []
+    next_seq = 0
+    budget_hit = False  #a listing was dropped for the budget: later pages are not complete
+    try:
+        while True:
+            item = sink_q.get()
+            if item is DONE:
+                break
+            heapq.heappush(pending, item)
+            while pending and pending[0][0] == next_seq:
+                seq, kind, payload = heapq.heappop(pending)
+                next_seq += 1
+                if kind == 'budget':
+                    budget_hit = True
+                    continue
+                if kind == 'carried':
+                    if archive:
+                        archive.add(today, payload['link'], snapshot.dumps(payload), 'carried',
+                                    data_id=payload['data_id'])
+                    with metrics.timed('accumulate'):
+                        df_temp.append(payload)
+                    metrics.count('listings')
+                    continue
+                if kind == 'listing':
+                    if payload is None:
+                        continue  #lost in a stage that raised
+                    (data_id, link, page, html), d = payload
+                    try:
+                        if archive and html is not None:
+                            archive.add(today, link, html, 'detail', data_id=data_id, page=page)
+                    except:
+                        #as in streeteasy_scrape_public.main, a listing that was not archived is dropped
+                        log(ERROR, "Error archiving data_id %d", data_id)
+                        print_err()
+                        continue
+                    if d is not None:
+                        with metrics.timed('accumulate'):
+                            df_temp.append(d)
+                        metrics.count('listings')
+                        log(DEBUG, "data_id: %d", data_id)
+                    continue
+                if budget_hit:
+                    continue
+                last_page = payload
+                metrics.count('pages')
+                if saver and last_page % partial_save == 0:
+                    log(INFO, "*****Partial save*****")
+                    try:
+                        with metrics.timed('partial_save'):
+                            saver.save(df_temp.to_frame(), last_page)
+                    except:
+                        log(ERROR, "Error saving df_temp.  Discarding recent data.")
+                        print_err()
+                    df_temp.clear()
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+        client.report()
+        record_http_metrics(client)
+        client.close()
+        if archive:
+            archive.close()
+
+    #save final df
+    log(INFO, "DONE.  Saving...")
+    df = df_temp.to_frame()
+    try:
+        with metrics.timed('final_save'):
+            if saver:
+                saver.save(df, last_page)
+                saver.compact(today + '.csv')
+                df = pd.read_csv(today + '.csv', index_col=0)
+            else:
+                df.to_csv(today + '.csv')
+    except:
+        log(ERROR, "Error saving df.")
+        print_err()
+    if metrics_file:
+        metrics.write(metrics_file)
+    return df
+
+if __name__ == '__main__':
+    main(max_pages=int(sys.argv[1]) if len(sys.argv) > 1 else 3000)
@@ -7,44 +7,145 @@ Upload to the rentnyc_db database.
 import pandas as pd
 import sqlite3
 import numpy as np
+import multiprocessing
+import datetime
+import time
+import os
+import dimensions
+import amenities
+import transit
+import metrics
+from metrics import log, INFO, ERROR
+
+
+#columns of the daily tables, in order
+TABLE_COLUMNS = ["data_id", "scrape_date", "link", "address", "price", "sq_ft",
+                 "rooms", "beds", "baths", "unit_type", "neighborhood", "days_on_streeteasy", "realtor",
+                 "bike_room", "board_approval_required", "cats_and_dogs_allowed",
+                 "central_air_conditioning", "concierge", "cold_storage", "community_recreation_facilities",
+                 "children_playroom", "deck", "dishwasher", "doorman", "elevator", "full_time_doorman",
+                 "furnished", "garage_parking", "green_building", "gym", "garden", "guarantors_accepted",
+                 "laundry_in_building", "live_in_super", "loft", "package_room", "parking_available",
+                 "patio", "pets_allowed", "roof_deck", "smoke_free", "storage_available", "sublet",
+                 "terrace", "virtual_doorman", "washer_dryer_in_unit", "waterview", "waterfront"] + \
+                transit.COLUMNS + ["amenity_mask"] + transit.FEATURE_COLUMNS + ["borough"]
+
+#columns of the daily tables: the text columns in dimensions.DIMENSIONS are stored as integer keys
+FACT_COLUMNS = [c + '_id' if c in dimensions.DIMENSIONS else c for c in TABLE_COLUMNS]
+
+
+def bulk_pragmas(con):
+    """Set connection pragmas for bulk loading: keep the rollback journal in memory, do not
+    wait for fsync, and use a 200 MB page cache.  A crash during the load can leave the
+    database inconsistent, so only use this for tables that can be rebuilt from the csv files.
+    Returns the previous settings, to be set back with restore_pragmas.
+    """
+    previous = [(p, con.execute("PRAGMA %s;" % (p)).fetchone()[0]) for p in ['journal_mode', 'synchronous', 'cache_size']]
+    con.execute("PRAGMA journal_mode = MEMORY;")
+    con.execute("PRAGMA synchronous = OFF;")
+    con.execute("PRAGMA cache_size = -200000;")
+    return previous
 
 
-def main(db_name, data_directory, csv_file, borough_file):
-    """Will load a .csv produced from the streeteasy_scrape_public.py function, perform some additional formatting
-    that was not handled in the web scraper function, and save the results in a local SQLite database.  
-    
+def restore_pragmas(con, previous):
+    """Set back the pragmas returned by bulk_pragmas."""
+    for pragma, value in previous:
+        con.execute("PRAGMA %s = %s;" % (pragma, value))
+
+
+def bulk_load(con, table_name, df, chunk_size=5000):
+    """Create a daily table with data_id as the primary key and insert the rows of df with
+    chunked executemany calls, all in one transaction.  An existing table of the same name is
+    replaced.  df must already be cleaned and free of duplicate data_ids.
+
+    The text columns in dimensions.DIMENSIONS are stored as keys into the dimension tables
+    (see dimensions.py), and the view v_<table_name> shows them as text.  The load runs with
+    bulk_pragmas, and the connection's own pragmas are set back when it is done, so later
+    writes on the connection are journaled and synced as before.
+
+    Parameters
+    ----------
+      con: sqlite3.Connection
+        - database connection.
+      table_name: str
+        - name of the table to create.
+      df: DataFrame
+        - cleaned data with the columns in TABLE_COLUMNS.
+      chunk_size: int, default 5000
+        - number of rows converted and inserted per executemany call.
+    """
+    previous = bulk_pragmas(con)
+    isolation_level = con.isolation_level
+    con.isolation_level = None  #manage the transaction explicitly so the DDL is part of it
+    c = con.cursor()
+    c.execute("BEGIN;")
+    try:
+        #replace neighborhood, realtor, etc. by their keys in the dimension tables
+        df = dimensions.encode(con, df)
+        #drop the table if it already exists
+        c.execute("""
+        DROP TABLE IF EXISTS %s;
+        """ % (table_name))
+        #create the table
+        c.execute("""
+        CREATE TABLE %s (
+            data_id INTEGER PRIMARY KEY, scrape_date TEXT, link_id INTEGER, address_id INTEGER, price REAL, sq_ft REAL,
+            rooms INTEGER, beds INTEGER, baths INTEGER, unit_type_id INTEGER, neighborhood_id INTEGER, days_on_streeteasy INTEGER,
+            realtor_id INTEGER, bike_room INTEGER, board_approval_required INTEGER, cats_and_dogs_allowed INTEGER,
+            central_air_conditioning INTEGER, concierge INTEGER, cold_storage INTEGER, community_recreation_facilities INTEGER,
+            children_playroom INTEGER, deck INTEGER, dishwasher INTEGER, doorman INTEGER, elevator INTEGER, full_time_doorman INTEGER,
+            furnished INTEGER, garage_parking INTEGER, green_building INTEGER, gym INTEGER, garden INTEGER, guarantors_accepted INTEGER,
+            laundry_in_building INTEGER, live_in_super INTEGER, loft INTEGER, package_room INTEGER, parking_available INTEGER,
+            patio INTEGER, pets_allowed INTEGER, roof_deck INTEGER, smoke_free INTEGER, storage_available INTEGER, sublet INTEGER,
+            terrace INTEGER, virtual_doorman INTEGER, washer_dryer_in_unit INTEGER, waterview INTEGER, waterfront INTEGER,
+            %s, amenity_mask INTEGER,
+            nearest_line TEXT, nearest_distance REAL, lines_within_0_25 INTEGER, lines_within_0_5 INTEGER,
+            lines_within_1 INTEGER, borough_id INTEGER)
+        """ % (table_name, ", ".join("%s REAL" % (c) for c in transit.COLUMNS)))
+        #insert the rows.  astype(object) turns numpy scalars into python values for sqlite3.
+        insert = "INSERT INTO %s (%s) VALUES (%s);" % (table_name, ", ".join(FACT_COLUMNS),
+                                                       ", ".join(["?"] * len(FACT_COLUMNS)))
+        for i in range(0, len(df), chunk_size):
+            c.executemany(insert, df[FACT_COLUMNS].iloc[i:i + chunk_size].astype(object).values.tolist())
+        dimensions.create_view(con, table_name)
+        c.execute("COMMIT;")
+    except:
+        c.execute("ROLLBACK;")
+        raise
+    finally:
+        restore_pragmas(con, previous)
+        con.isolation_level = isolation_level
+
+
+def clean(df, borough_file):
+    """Clean one day of data produced from the streeteasy_scrape_public.py function.  Returns
+    the cleaned DataFrame with the columns in TABLE_COLUMNS.
+
     The following operations are performed:
         - The "per_sq_ft" column is eliminated.  It is a linear combination of price and sq_ft.
         - Missing values are encoded as -1.
         - The "data_id" column will be set as the primary key.
         - Blank rows of the 'beds' column will be converted to 0 to imply a studio apartment.
         - Missing transportation values (subway lines/trains) are changed to 0 to imply absence.
-        - A new column for borough is created based on the neighborhood_borough.csv file.
+        - The amenity flags are packed into the "amenity_mask" column (see amenities.py).
+        - The nearest line, its distance and the number of lines within 0.25, 0.5 and 1 mile are
+          added (see transit.py).
+        - A new column for borough is created based on the neighborhood_borough.csv file (-1 if the
+          neighborhood is not listed).
         - The apostrophe in Hell's Kitchen is removed for simpler string calling.
         - Prices that are listed with "Last listed as ..." are converted to actual prices.
         - Realtors listed as "View original listing" is changed to a missing value.
         - Duplicated data_ids are removed.
         - Some outliers are dropped (>12 rooms and price <20000, listings with >8 beds).
-        
+
     Parameters
     ----------
-      db_name: str
-        - name of the database in which to save the table.  If it exists, the table will be added.
-          If it does not exist, it will be created.
-      data_directory: str
-        - directory in which to find the .csv data file.
-      csv_file: str
-        - name of the csv file to be loaded.
+      df: DataFrame
+        - data read from a scraped .csv file.
       borough_file: str
         - name and path of the csv file containing the borough associated with each neighborhood.
-        
     """
 
-    #import as dataframe
-    print "Reading csv from %s" % (data_directory + csv_file)
-    df = pd.read_csv(data_directory + csv_file)
-    print "Done.\n"
-
     #check for missing columns, if found, pad with nans
     col_list = ["data_id", "scrape_date", "link", "address", "price", "sq_ft", "per_sq_ft",
                 "rooms", "beds", "baths", "unit_type", "neighborhood", "days_on_streeteasy", "tor",
@@ -54,29 +155,14 @@ def main(db_name, data_directory, csv_file, borough_file):
                 "green building", "gym", "garden", "guarantors accepted", "laundry in building", "live-in super",
                 "loft", "package room", "parking available", "patio", "pets allowed", "roof deck", "smoke-free",
                 "storage available", "sublet", "terrace", "virtual doorman", "washer/dryer in-unit", "waterview",
-                "waterfront", "A", "C", "E", "B", "D", "F", "M", "G", "L", "J", "Z",
-                "N", "Q", "R", "1", "2", "3", "4", "5", "6", "7", "S",
-                "LIRR", "PATH"]
+                "waterfront"] + transit.LINES
     for col in col_list:
         if col not in df.columns:
             df[col] = np.nan
 
-    #rename columns to remove spaces and special characters
-    old_col = ["bike room","board approval required","cats and dogs allowed","central air conditioning","cold storage",
-               "community recreation facilities", "children's playroom", "full-time doorman", "garage parking",
-               "green building","guarantors accepted", "laundry in building", "live-in super", "package room",
-               "parking available", "pets allowed","roof deck","smoke-free","storage available","virtual doorman",
-               "washer/dryer in-unit", "A", "C", "E", "B", "D", "F", "M", "G", "L", "J", "Z",
-                "N", "Q", "R", "1", "2", "3", "4", "5", "6", "7", "S"]
-    new_col = ["bike_room","board_approval_required","cats_and_dogs_allowed","central_air_conditioning","cold_storage",
-               "community_recreation_facilities","children_playroom","full_time_doorman","garage_parking",
-               "green_building","guarantors_accepted","laundry_in_building","live_in_super","package_room",
-               "parking_available","pets_allowed","roof_deck","smoke_free","storage_available","virtual_doorman",
-               "washer_dryer_in_unit","line_A","line_C","line_E","line_B","line_D","line_F","line_M","line_G","line_L",
-               "line_J","line_Z","line_N","line_Q","line_R","line_1","line_2","line_3","line_4","line_5","line_6",
-               "line_7","line_S"]
-    for i in range(len(new_col)):
-        df.rename(columns = {old_col[i]: new_col[i]}, inplace = True)
+    #rename columns to remove spaces and special characters, and prefix the subway lines
+    df = df.rename(columns=dict(zip(amenities.AMENITIES, amenities.COLUMNS)))
+    df = df.rename(columns=dict(zip(transit.LINES, transit.COLUMNS)))
 
 
     #########
@@ -94,12 +180,18 @@ def main(db_name, data_directory, csv_file, borough_file):
     df.loc[df['beds'].isnull(),'beds'] = 0
 
     #change missing subway lines values to zero to imply line is absent.
-    sub_list = ["line_A","line_C","line_E","line_B","line_D","line_F","line_M","line_G","line_L",
-               "line_J","line_Z","line_N","line_Q","line_R","line_1","line_2","line_3","line_4","line_5","line_6",
-               "line_7","line_S","LIRR","PATH"]
-    for s in sub_list:
+    for s in transit.COLUMNS:
         df.loc[df[s].isnull(),s] = 0
 
+    #pack the amenity flags into one integer.  recomputed here so that files scraped before
+    #the mask existed get one too.
+    df['amenity_mask'] = amenities.pack(df)
+
+    #precompute the transit features from the distances
+    features = transit.features(df)
+    for col in transit.FEATURE_COLUMNS:
+        df[col] = features[col]
+
     #replace remaining missing values with a code
     df = df.fillna(value=-1)
 
@@ -114,10 +206,57 @@ def main(db_name, data_directory, csv_file, borough_file):
     #drop listings with >=8 beds
     df = df.loc[df['beds'] < 8]
 
+    #convert prices listed as "Last listed at $..." to actual prices
+    last_listed = df['price'].astype(str).str.startswith('Last listed')
+    if last_listed.any():
+        df.loc[last_listed,'price'] = df.loc[last_listed,'price'].map(
+            lambda p: p.replace("Last listed at\t$","").replace(",",""))
+
     #change realtor "View original listing" to a missing value
     df.loc[df['realtor'] == "View original listing",'realtor'] = -1
     df.loc[df['realtor'] == "View original listing ",'realtor'] = -1
 
+    #eliminate the apostrophe in Hell's Kitchen
+    df.loc[df['neighborhood'] == "Hell's Kitchen",'neighborhood'] = 'Hells Kitchen'
+
+    #add the borough with one vectorized lookup against the borough list.  neighborhoods
+    #listed under more than one borough take the max, as before.  unknown neighborhoods get -1.
+    borough_lookup = pd.read_csv(borough_file).groupby('Name')['Borough'].max()
+    df['borough'] = df['neighborhood'].map(borough_lookup).fillna(-1)
+
+    return df
+
+
+def main(db_name, data_directory, csv_file, borough_file, chunk_size=5000):
+    """Will load a .csv produced from the streeteasy_scrape_public.py function, perform some additional formatting
+    that was not handled in the web scraper function, and save the results in a local SQLite database.  
+    
+    The data are cleaned with clean() (see there for the operations performed) and loaded with
+    bulk_load().
+
+    Parameters
+    ----------
+      db_name: str
+        - name of the database in which to save the table.  If it exists, the table will be added.
+          If it does not exist, it will be created.
+      data_directory: str
+        - directory in which to find the .csv data file.
+      csv_file: str
+        - name of the csv file to be loaded.
+      borough_file: str
+        - name and path of the csv file containing the borough associated with each neighborhood.
+      chunk_size: int, default 5000
+        - number of rows inserted per executemany call.
+        
+    """
+
+    #import as dataframe
+    print "Reading csv from %s" % (data_directory + csv_file)
+    df = pd.read_csv(data_directory + csv_file)
+    print "Done.\n"
+
+    #clean the data
+    df = clean(df, borough_file)
 
     #########
     #Format for SQL database
@@ -130,154 +269,17 @@ def main(db_name, data_directory, csv_file, borough_file):
     print "Done.\n"
     print "Begin formatting data."
 
-    #set up a cursor to the table, then use the execute command to query the table.
-    c = con.cursor()
+    #modify the csv file name to get the table name
+    table_name = 't' + csv_file.replace('.csv','').replace('-','')
 
-    #modify the csv file name to get the temporary table name
-    table_name_tp = 't' + csv_file.replace('.csv','_tp').replace('-','')    #temporary table to import dataframe without primary key
-    table_name = table_name_tp.replace('_tp','')            #final table that will add a primary key
-
-    #drop the table_name_tp if it already exists
-    c.execute("""
-    DROP TABLE IF EXISTS %s;
-    """ % (table_name_tp))
-
-    #add the dataframe as a table in the database
-    df.to_sql(table_name_tp,con) #create a table named 20161005
-
-    #the to_sql method does not allow us to add a primary key.  to do this, we must create
-    #a new table and copy the data
-        #drop the table if it already exists
-    c.execute("""
-    DROP TABLE IF EXISTS %s;
-    """ % (table_name))
-        #create the table
-    c.execute("""
-    CREATE TABLE %s (
-        data_id INTEGER PRIMARY KEY, scrape_date TEXT, link TEXT, address TEXT, price REAL, sq_ft REAL,
-        rooms INTEGER, beds INTEGER, baths INTEGER, unit_type , neighborhood TEXT, days_on_streeteasy INTEGER,
-        realtor INTEGER, bike_room INTEGER, board_approval_required INTEGER, cats_and_dogs_allowed INTEGER,
-        central_air_conditioning INTEGER, concierge INTEGER, cold_storage INTEGER, community_recreation_facilities INTEGER,
-        children_playroom INTEGER, deck INTEGER, dishwasher INTEGER, doorman INTEGER, elevator INTEGER, full_time_doorman INTEGER,
-        furnished INTEGER, garage_parking INTEGER, green_building INTEGER, gym INTEGER, garden INTEGER, guarantors_accepted INTEGER,
-        laundry_in_building INTEGER, live_in_super INTEGER, loft INTEGER, package_room INTEGER, parking_available INTEGER,
-        patio INTEGER, pets_allowed INTEGER, roof_deck INTEGER, smoke_free INTEGER, storage_available INTEGER, sublet INTEGER,
-        terrace INTEGER, virtual_doorman INTEGER, washer_dryer_in_unit INTEGER, waterview INTEGER, waterfront INTEGER,
-        line_A REAL, line_C REAL, line_E REAL, line_B REAL, line_D REAL, line_F REAL, line_M REAL, line_G REAL, line_L REAL,
-        line_J REAL, line_Z REAL, line_N REAL, line_Q REAL, line_R REAL, line_1 REAL, line_2 REAL, line_3 REAL, line_4 REAL,
-        line_5 REAL, line_6 REAL, line_7 REAL, line_S REAL, LIRR REAL, PATH REAL)
-    """ % (table_name))
-
-    #delete duplicates in the temporary table before adding to the new table
-    c.execute("""
-    DELETE FROM %s
-    WHERE rowid NOT IN
-        (
-        SELECT MAX(rowid)
-        FROM %s
-        GROUP BY data_id
-        );
-    """ % (table_name_tp,table_name_tp))
-
-    #join the old table with the new one
-    c.execute("""
-    INSERT INTO %s
-        (data_id, scrape_date, link, address, price, sq_ft,
-        rooms, beds, baths, unit_type, neighborhood, days_on_streeteasy, realtor,
-        bike_room, board_approval_required, cats_and_dogs_allowed,
-        central_air_conditioning, concierge, cold_storage, community_recreation_facilities,
-        children_playroom, deck, dishwasher, doorman, elevator, full_time_doorman,
-        furnished, garage_parking, green_building, gym, garden, guarantors_accepted,
-        laundry_in_building, live_in_super, loft, package_room, parking_available,
-        patio, pets_allowed, roof_deck, smoke_free, storage_available, sublet,
-        terrace, virtual_doorman, washer_dryer_in_unit, waterview, waterfront,
-        line_A, line_C, line_E, line_B, line_D, line_F, line_M, line_G, line_L,
-        line_J, line_Z, line_N, line_Q, line_R, line_1, line_2, line_3, line_4,
-        line_5, line_6, line_7, line_S, LIRR, PATH)
-    SELECT
-        data_id, scrape_date, link, address, price, sq_ft,
-        rooms, beds, baths, unit_type, neighborhood, days_on_streeteasy,realtor,
-        bike_room, board_approval_required, cats_and_dogs_allowed,
-        central_air_conditioning, concierge, cold_storage, community_recreation_facilities,
-        children_playroom, deck, dishwasher, doorman, elevator, full_time_doorman,
-        furnished, garage_parking, green_building, gym, garden, guarantors_accepted,
-        laundry_in_building, live_in_super, loft, package_room, parking_available,
-        patio, pets_allowed, roof_deck, smoke_free, storage_available, sublet,
-        terrace, virtual_doorman, washer_dryer_in_unit, waterview, waterfront,
-        line_A, line_C, line_E, line_B, line_D, line_F, line_M, line_G, line_L,
-        line_J, line_Z, line_N, line_Q, line_R, line_1, line_2, line_3, line_4,
-        line_5, line_6, line_7, line_S, LIRR, PATH
-    FROM %s;
-    """ % (table_name,table_name_tp))
-
-    #delete the temporary table
-    c.execute("""
-    DROP TABLE %s;
-    """ % (table_name_tp))
-
-
-    #We are now finished creating our new table in the database.
-    #We will now clean up some of the neighborhood names and add a borough column
-
-    #insert a new column for borough
-    c.execute("""
-    ALTER TABLE "%s"
-    ADD "borough" TEXT;
-    """ % (table_name))
-
-    #eliminate the apostrophe in Hell's Kitchen
-    c.execute("""
-    UPDATE '%s'
-    SET neighborhood = 'Hells Kitchen'
-    WHERE neighborhood = "Hell's Kitchen"
-    """ % (table_name))
-    con.commit()
-
-    #get a list of all neighborhoods
-    c.execute("""
-    SELECT DISTINCT neighborhood
-    FROM "%s";
-    """ % (table_name))
-    nhood_tups = c.fetchall()
-
-    #conver to list of strings
-    nhood_list = [str(i[0]) for i in nhood_tups]
-
-    #load the borough list
-    df_borough = pd.read_csv(borough_file)
-
-    #now put it all together with sql commands.
-    for nhood in nhood_list:
-        borough = df_borough[df_borough['Name'] == nhood]['Borough'].max()
-        query = "UPDATE %s SET borough = '%s' WHERE neighborhood = '%s';" % (table_name,borough,nhood)
-        c.execute(query)
-
-    #Find prices that say "Last listed as..." and convert to actual price
-        #query all rows with prices starting "Last listed ...", save as df
-    df_tp = pd.read_sql("""
-    SELECT *
-    FROM %s
-    WHERE price LIKE "Last listed %%";
-    """ % (table_name),con)
-        #loop over rows of the df
-    for i in np.arange(np.shape(df_tp)[0]):
-        #reformat the price
-        new_price = df_tp['price'][i].replace("Last listed at\t$","").replace(",","")
-        #update the sql table
-        data_id_tp = df_tp['data_id'][i]
-        c.execute("""
-        UPDATE %s
-        SET price=%s
-        WHERE data_id=%s;
-        """ % (table_name,new_price,data_id_tp))
-
-    #Commit the changes
-    con.commit()
+    #build the table and load every row exactly once, in a single transaction
+    bulk_load(con, table_name, df, chunk_size)
 
     # print the first ten rows as reality check
     print "Data formatted. Printing first ten rows as reality check.\n"
+    c = con.cursor()
     c.execute("""
-    SELECT * FROM %s;
+    SELECT * FROM v_%s LIMIT 10;
     """ % (table_name))
     x =  c.fetchall()
     for i in x[0:10]:
@@ -286,6 +288,98 @@ def main(db_name, data_directory, csv_file, borough_file):
     #Finished! We now have a table in our database with data_id set as the primary key!
     con.close()
 
+def read_clean(args):
+    """Read and clean one csv file.  Runs in a worker process of ingest_directory.
+
+    Parameters
+    ----------
+      args: tuple (data_directory, csv_file, borough_file)
+
+    Returns (csv_file, df, seconds).  If the file cannot be read or cleaned, df is None and
+    the error message is returned in place of seconds.
+    """
+    data_directory, csv_file, borough_file = args
+    start = time.time()
+    try:
+        df = clean(pd.read_csv(os.path.join(data_directory, csv_file)), borough_file)
+    except Exception as e:
+        return csv_file, None, "%s: %s" % (type(e).__name__, e)
+    return csv_file, df, time.time() - start
+
+
+def ingest_directory(db_name, data_directory, borough_file, processes=None, chunk_size=5000, metrics_file=None):
+    """Load every scraped .csv file in a directory into the database, one table per file as in
+    main().  Files are read and cleaned in parallel in a process pool and written by this
+    process only, as each file becomes ready.  Loaded files are recorded in the loaded_files
+    table, so a rerun only ingests new days.
+
+    Parameters
+    ----------
+      db_name: str
+        - name of the database.  Created if it does not exist.
+      data_directory: str
+        - directory in which to find the .csv data files.
+      borough_file: str
+        - name and path of the csv file containing the borough associated with each neighborhood.
+      processes: int, default None
+        - number of worker processes.  Defaults to the number of CPUs.
+      chunk_size: int, default 5000
+        - number of rows inserted per executemany call.
+      metrics_file: str, default None
+        - if given, read+clean and load timings and file, row and error counts are written to
+          <metrics_file>.json and <metrics_file>.prom (see metrics.py).
+    """
+    metrics.reset()
+    print "Connecting to %s database." % (db_name)
+    con = sqlite3.connect(db_name)
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS loaded_files (
+        csv_file TEXT PRIMARY KEY, table_name TEXT, n_rows INTEGER, loaded_at TEXT);
+    """)
+    con.commit()
+    loaded = set(r[0] for r in con.execute("SELECT csv_file FROM loaded_files;"))
+
+    #only the days that are not yet in the database
+    csv_files = sorted(f for f in os.listdir(data_directory) if f.endswith('.csv') and f not in loaded)
+    print "%d new files, %d already loaded.\n" % (len(csv_files), len(loaded))
+    if not csv_files:
+        con.close()
+        return
+
+    start = time.time()
+    total_rows = 0
+    pool = multiprocessing.Pool(processes)
+    try:
+        jobs = [(data_directory, f, borough_file) for f in csv_files]
+        for csv_file, df, seconds in pool.imap_unordered(read_clean, jobs):
+            if df is None:
+                log(ERROR, "%s: could not be read, skipping.  %s", csv_file, seconds)
+                metrics.count('errors', type=seconds.split(':')[0])
+                continue
+            metrics.observe('stage_seconds', seconds, stage='read_clean')
+            table_name = 't' + csv_file.replace('.csv','').replace('-','')
+            load_start = time.time()
+            with metrics.timed('sql_load'):
+                bulk_load(con, table_name, df, chunk_size)
+            con.execute("INSERT OR REPLACE INTO loaded_files VALUES (?, ?, ?, ?);",
+                        (csv_file, table_name, len(df), str(datetime.datetime.now())))
+            con.commit()
+            load_seconds = time.time() - load_start
+            total_rows += len(df)
+            metrics.count('files_loaded')
+            metrics.count('rows_loaded', len(df))
+            log(INFO, "%s -> %s: %d rows, read+clean %.1f s, load %.1f s (%.0f rows/s)",
+                csv_file, table_name, len(df), seconds, load_seconds, len(df) / max(seconds + load_seconds, 1e-6))
+    finally:
+        pool.close()
+        pool.join()
+        con.close()
+        if metrics_file:
+            metrics.write(metrics_file)
+    elapsed = time.time() - start
+    print "\nLoaded %d rows from %d files in %.1f s (%.0f rows/s)." % (
+        total_rows, len(csv_files), elapsed, total_rows / max(elapsed, 1e-6))
+
 if __name__ == '__main__':
     #set variables
     db_name = '../data/db/rentnyc_db'    # database name
@@ -294,3 +388,5 @@ if __name__ == '__main__':
     borough_file = '../data/misc/neighborhood_borough.csv'
     #run function
     main(db_name, data_directory, csv_file, borough_file)
+    #or load every day in data_directory that is not yet in the database
+    #ingest_directory(db_name, data_directory, borough_file)
@@ -0,0 +1,102 @@
+"""
+Dictionary encoding of the repeated text columns of the listing tables.
+
+Each column in DIMENSIONS has a dimension table dim_<column> (id INTEGER PRIMARY KEY,
+value TEXT UNIQUE).  The daily and merged tables store the integer key in <column>_id
+instead of the text, with -1 for a missing value as in the other columns.  The view
+v_<table> adds the text columns back under their usual names, so
+
+    SELECT neighborhood, realtor, price FROM v_all_data WHERE ...
+
+reads like the tables did before the encoding.
+"""
+
+
+DIMENSIONS = ['neighborhood', 'realtor', 'unit_type', 'borough', 'address', 'link']
+
+#key of a missing value
+MISSING = -1
+
+
+def init(con):
+    """Create the dimension tables if they do not exist."""
+    for dim in DIMENSIONS:
+        con.execute("CREATE TABLE IF NOT EXISTS dim_%s (id INTEGER PRIMARY KEY, value TEXT UNIQUE);" % (dim))
+
+
+def as_text(value):
+    return value if isinstance(value, basestring) else str(value)
+
+
+def is_missing(values):
+    """Return a boolean Series, true where values is NaN or the -1 missing code."""
+    return values.isnull() | values.map(as_text).isin([str(MISSING), str(float(MISSING))])
+
+
+def keys(con, dim):
+    """Return {value: id} for one dimension table."""
+    return dict(con.execute("SELECT value, id FROM dim_%s;" % (dim)).fetchall())
+
+
+def values(con, dim):
+    """Return {id: value} for one dimension table."""
+    return dict(con.execute("SELECT id, value FROM dim_%s;" % (dim)).fetchall())
+
+
+def lookup(con, dim, value):
+    """Return the id of one value, or None if it is not in the dimension table."""
+    row = con.execute("SELECT id FROM dim_%s WHERE value = ?;" % (dim), (value,)).fetchone()
+    return row[0] if row else None
+
+
+def encode(con, df):
+    """Replace the DIMENSIONS columns of df by their <column>_id keys, adding new values to
+    the dimension tables with one executemany per table.  Runs in the caller's transaction.
+    Returns a new DataFrame.
+    """
+    init(con)
+    df = df.copy()
+    for dim in DIMENSIONS:
+        if dim not in df:
+            continue
+        missing = is_missing(df[dim])
+        text = df[dim].map(as_text)
+        con.executemany("INSERT OR IGNORE INTO dim_%s (value) VALUES (?);" % (dim),
+                        [(v,) for v in text[~missing].unique()])
+        ids = text.map(keys(con, dim))
+        ids[missing] = MISSING
+        df[dim] = ids.astype('int64')
+        df = df.rename(columns={dim: dim + '_id'})
+    return df
+
+
+def decode(con, df):
+    """Inverse of encode: replace the <column>_id columns of df by the text values."""
+    df = df.copy()
+    for dim in DIMENSIONS:
+        col = dim + '_id'
+        if col not in df:
+            continue
+        text = df[col].map(values(con, dim))
+        text[df[col] == MISSING] = MISSING
+        df[col] = text
+        df = df.rename(columns={col: dim})
+    return df
+
+
+def create_view(con, table_name):
+    """Create or replace the view v_<table_name>: every column of the table, followed by the
+    text of each <column>_id under the name <column> (-1 if missing).
+    """
+    columns = [r[1] for r in con.execute("PRAGMA table_info(%s);" % (table_name))]
+    select = ["f.%s" % (c) for c in columns]
+    joins = []
+    for dim in DIMENSIONS:
+        if dim + '_id' not in columns:
+            continue
+        # the missing code has no row in the dimension table, so it falls through to -1
+        select.append("COALESCE(d_%s.value, f.%s_id) AS %s" % (dim, dim, dim))
+        joins.append("LEFT JOIN dim_%s AS d_%s ON d_%s.id = f.%s_id" % (dim, dim, dim, dim))
+    init(con)
+    con.execute("DROP VIEW IF EXISTS v_%s;" % (table_name))
+    con.execute("CREATE VIEW v_%s AS SELECT %s FROM %s AS f %s;" % (table_name, ", ".join(select), table_name, " ".join(joins)))
@@ -0,0 +1,195 @@
+"""
+Columnar export of the daily tables for modeling.
+
+Each daily table written by csv2sql is exported once to a directory partitioned by scrape
+date and borough:
+
+    <out_dir>/scrape_date=2017-01-11/borough=Brooklyn/part-0.arrow
+
+Files are Arrow IPC (fmt="arrow", the default) or Parquet (fmt="parquet").  Amenity flags
+are stored as int8, transit distances as float32 and text columns as dictionaries.
+read_features() memory-maps the files and reads only the columns it is asked for, so
+loading features does not go through SQLite and pandas row by row.
+
+Needs pyarrow (pip install pyarrow).
+"""
+import os
+import re
+import sys
+import shutil
+import sqlite3
+import datetime
+import pandas as pd
+from mergeSQL import daily_tables
+import dimensions
+import amenities
+import transit
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+
+AMENITY_COLUMNS = amenities.COLUMNS
+TRANSIT_COLUMNS = transit.COLUMNS
+PARTITIONS = ['scrape_date', 'borough']
+EXTENSIONS = {'arrow': '.arrow', 'parquet': '.parquet'}
+
+
+def require_pyarrow():
+    if pa is None:
+        raise ImportError("export.py needs pyarrow.  Install it with: pip install pyarrow")
+
+
+def to_columnar(df):
+    """Return df with the export column types: int8 amenities, float32 transit distances,
+    categorical text columns.  The integer keys of the dimension tables are dropped, since
+    the text is kept.
+    """
+    df = df.drop([c for c in df.columns if c.endswith('_id') and c[:-3] in dimensions.DIMENSIONS], axis=1)
+    for col in df.columns:
+        if col in AMENITY_COLUMNS:
+            df[col] = df[col].astype('int8')
+        elif col in TRANSIT_COLUMNS:
+            df[col] = df[col].astype('float32')
+        elif df[col].dtype == object:
+            df[col] = df[col].astype(unicode).astype('category')
+    return df
+
+
+def write_file(df, path, fmt):
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    if fmt == 'parquet':
+        pq.write_table(table, path)
+    else:
+        with pa.OSFile(path, 'wb') as f:
+            writer = pa.RecordBatchFileWriter(f, table.schema)
+            writer.write_table(table)
+            writer.close()
+
+
+def table_date(source):
+    """Return the scrape date of a daily table named t<yyyymmdd>, or None."""
+    m = re.match(r'^t(\d{4})(\d{2})(\d{2})$', source)
+    return '-'.join(m.groups()) if m else None
+
+
+def export_table(con, source, out_dir, fmt='arrow'):
+    """Export one daily table to its scrape date partition, one file per borough.  The
+    partition is written under a temporary name and renamed when complete.
+
+    Returns the number of rows written.
+    """
+    views = set(r[0] for r in con.execute("SELECT name FROM sqlite_master WHERE type = 'view';"))
+    df = pd.read_sql("SELECT * FROM %s;" % ('v_' + source if 'v_' + source in views else source), con)
+    scrape_date = table_date(source) or df['scrape_date'].max()
+    final_dir = os.path.join(out_dir, 'scrape_date=%s' % (scrape_date))
+    tmp_dir = final_dir + '.tmp'
+    if os.path.isdir(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    df = to_columnar(df.drop('scrape_date', axis=1))
+    for borough, part in df.groupby(df['borough'].astype(unicode)):
+        path = os.path.join(tmp_dir, 'borough=%s' % (borough))
+        os.makedirs(path)
+        write_file(part.drop('borough', axis=1), os.path.join(path, 'part-0' + EXTENSIONS[fmt]), fmt)
+    if os.path.isdir(final_dir):
+        shutil.rmtree(final_dir)
+    os.rename(tmp_dir, final_dir)
+    return len(df)
+
+
+def partitions(out_dir):
+    """Return the (scrape_date, borough, path) of every exported file, sorted."""
+    found = []
+    for date_dir in sorted(os.listdir(out_dir)):
+        if not date_dir.startswith('scrape_date=') or date_dir.endswith('.tmp'):
+            continue
+        for borough_dir in sorted(os.listdir(os.path.join(out_dir, date_dir))):
+            for name in sorted(os.listdir(os.path.join(out_dir, date_dir, borough_dir))):
+                found.append((date_dir.split('=', 1)[1], borough_dir.split('=', 1)[1],
+                              os.path.join(out_dir, date_dir, borough_dir, name)))
+    return found
+
+
+def read_file(path, columns=None):
+    """Read one exported file through a memory map, keeping only columns (all if None)."""
+    if path.endswith('.parquet'):
+        return pq.read_table(path, columns=columns, memory_map=True)
+    table = pa.ipc.open_file(pa.memory_map(path)).read_all()
+    if columns is None:
+        return table
+    return pa.Table.from_arrays([table.column(c) for c in columns], names=columns)
+
+
+def read_features(out_dir, columns=None, dates=None, boroughs=None):
+    """Load exported listings as a DataFrame.
+
+    Parameters
+    ----------
+      out_dir: str
+        - export directory.
+      columns: list of str, default None
+        - columns to load, which may include scrape_date and borough.  None loads all.
+      dates: list of str, default None
+        - scrape dates to load.  None loads all.
+      boroughs: list of str, default None
+        - boroughs to load.  None loads all.
+    """
+    require_pyarrow()
+    file_columns = None if columns is None else [c for c in columns if c not in PARTITIONS]
+    frames = []
+    for scrape_date, borough, path in partitions(out_dir):
+        if (dates is not None and scrape_date not in dates) or (boroughs is not None and borough not in boroughs):
+            continue
+        df = read_file(path, file_columns).to_pandas()
+        for col, value in zip(PARTITIONS, [scrape_date, borough]):
+            if columns is None or col in columns:
+                df[col] = value
+        frames.append(df)
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    df = pd.concat(frames, ignore_index=True)
+    #text columns with different dictionaries per file come back as objects
+    for col in df.columns:
+        if df[col].dtype == object:
+            df[col] = df[col].astype('category')
+    return df if columns is None else df[columns]
+
+
+def main(db_name, out_dir, table_list=None, fmt='arrow'):
+    """Export the daily tables that are not exported yet.
+
+    Parameters
+    ----------
+      db_name: str
+        - name of the database in which the tables are saved.
+      out_dir: str
+        - export directory.  Created if it does not exist.
+      table_list: list of str, default None
+        - daily tables to export.  None exports every t<yyyymmdd> table.
+      fmt: str, default "arrow"
+        - "arrow" for Arrow IPC files or "parquet".
+    """
+    require_pyarrow()
+    if fmt not in EXTENSIONS:
+        raise ValueError("fmt must be 'arrow' or 'parquet', not %r" % (fmt))
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    con = sqlite3.connect(db_name)
+    if table_list is None:
+        table_list = daily_tables(con)
+    done = set(scrape_date for scrape_date, borough, path in partitions(out_dir))
+    for source in table_list:
+        if table_date(source) in done:
+            continue
+        start = datetime.datetime.now()
+        n_rows = export_table(con, source, out_dir, fmt)
+        print "%s: %d rows exported (%.1f s)" % (source, n_rows, (datetime.datetime.now() - start).total_seconds())
+    con.close()
+
+if __name__ == '__main__':
+    #path to database
+    db_name = '../data/db/rentnyc_db'
+    main(db_name, '../data/columnar', fmt=sys.argv[1] if len(sys.argv) > 1 else 'arrow')
@@ -0,0 +1,269 @@
+"""
+Compact history of every daily observation of each listing.
+
+The daily tables written by csv2sql repeat every listing on every day it is online, and
+mergeSQL keeps only the last observation.  The history store keeps all of them, in space
+that grows with the number of changes rather than the number of scrape days:
+
+    history_base     the listing as first seen, one row per data_id.  scrape_date is stored
+                     as first_seen and days_on_streeteasy as the date the listing went
+                     online (listed_on), which does not change from day to day.
+    history_changes  (data_id, field, scrape_date, value), written only when a field differs
+                     from the previous observation.  The field "_present" records when a
+                     listing disappears (0) from or comes back (1) to the scrape.
+    history_days     the scrape dates ingested, in order.
+
+as_of() rebuilds the listings online on a given date with the columns of the daily tables,
+and field_history()/price_history() return the values of one listing over time.
+"""
+import sqlite3
+import datetime
+import numpy as np
+import pandas as pd
+from mergeSQL import daily_tables, migrate_table
+import dimensions
+
+#field of history_changes recording whether a listing was in the scrape
+PRESENT = '_present'
+
+
+def init(con):
+    """Create the change log and the table of ingested days if they do not exist."""
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS history_days (
+        scrape_date TEXT PRIMARY KEY, source TEXT, n_rows INTEGER, n_new INTEGER, n_changes INTEGER);
+    """)
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS history_changes (
+        data_id INTEGER, field TEXT, scrape_date TEXT, value, PRIMARY KEY (data_id, field, scrape_date)
+    ) WITHOUT ROWID;
+    """)
+    con.commit()
+
+
+def has_base(con):
+    return con.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'history_base';").fetchone()[0] > 0
+
+
+def encode(df, scrape_date):
+    """Return a daily table in the columns of history_base, indexed by data_id.
+    scrape_date becomes first_seen and days_on_streeteasy becomes listed_on (NULL if unknown).
+    """
+    df = df.set_index('data_id')
+    df = df.rename(columns={'scrape_date': 'first_seen', 'days_on_streeteasy': 'listed_on'})
+    df['first_seen'] = scrape_date
+    if 'listed_on' in df:
+        days = pd.to_numeric(df['listed_on'], errors='coerce')
+        listed_on = pd.Timestamp(scrape_date) - pd.to_timedelta(days.clip(lower=0).fillna(0), unit='D')
+        df['listed_on'] = pd.Series(listed_on.dt.strftime('%Y-%m-%d'), index=df.index).where(days >= 0)
+    return df
+
+
+def decode(state, scrape_date):
+    """Inverse of encode: return the listings in the columns of the daily tables."""
+    df = state.rename(columns={'first_seen': 'scrape_date', 'listed_on': 'days_on_streeteasy'})
+    df['scrape_date'] = scrape_date
+    if 'days_on_streeteasy' in df:
+        listed_on = pd.to_datetime(df['days_on_streeteasy'])
+        df['days_on_streeteasy'] = (pd.Timestamp(scrape_date) - listed_on).dt.days.fillna(-1).astype(np.int64)
+    return df.reset_index()
+
+
+def last_day(con, date=None):
+    """Return the last ingested scrape date, or the last one not after date.  None if there is none."""
+    if date is None:
+        return con.execute("SELECT MAX(scrape_date) FROM history_days;").fetchone()[0]
+    return con.execute("SELECT MAX(scrape_date) FROM history_days WHERE scrape_date <= ?;", (date,)).fetchone()[0]
+
+
+def state(con, scrape_date, present_only=True):
+    """Return every listing seen up to scrape_date with its latest values, in the columns of
+    history_base and indexed by data_id.  Column _present is 1 for the listings in the scrape
+    of that day.  If present_only is true, the other listings are left out.
+    """
+    base = pd.read_sql("SELECT * FROM history_base WHERE first_seen <= ?;", con,
+                       params=(scrape_date,), index_col='data_id')
+    # SQLite takes the bare columns of a MAX() aggregate from the row holding the maximum
+    changes = pd.read_sql("""
+    SELECT data_id, field, value, MAX(scrape_date) AS scrape_date FROM history_changes
+    WHERE scrape_date <= ? GROUP BY data_id, field;
+    """, con, params=(scrape_date,))
+    base[PRESENT] = 1
+    for field, rows in changes.groupby('field'):
+        if field not in base:
+            continue
+        values = base[field].astype(object)
+        values.loc[rows['data_id'].values] = rows['value'].values
+        base[field] = values
+    base = base.infer_objects()
+    if present_only:
+        base = base[base[PRESENT] == 1].drop(PRESENT, axis=1)
+    return base
+
+
+def ingest(con, df, scrape_date=None, source=None):
+    """Add one day of listings to the history.  Days must be ingested in date order.
+
+    Parameters
+    ----------
+      con: sqlite3.Connection
+      df: DataFrame
+        - one daily table, as written by csv2sql.
+      scrape_date: str, default None
+        - date of the scrape.  Defaults to the latest scrape_date in df.
+      source: str, default None
+        - name of the daily table, recorded in history_days.
+
+    Columns of df that history_base lacks are added to it.
+
+    Returns (n_new, n_changes): the number of new listings and of change log rows written.
+    """
+    if scrape_date is None:
+        scrape_date = df['scrape_date'].max()
+    last = last_day(con)
+    if last is not None and scrape_date <= last:
+        raise ValueError("%s is not after the last ingested day, %s.  Ingest days in date order." % (scrape_date, last))
+    new = encode(df, scrape_date)
+    new = new[~new.index.duplicated(keep='last')]
+
+    if not has_base(con):
+        con.execute("CREATE TABLE history_base (data_id INTEGER PRIMARY KEY, %s);"
+                    % (", ".join('"%s"' % c for c in new.columns)))
+    columns = [r[1] for r in con.execute("PRAGMA table_info(history_base);") if r[1] != 'data_id']
+    #columns that first appear on this day (e.g. amenity_mask) are added to the base table.
+    #listings seen before are NULL in them, so their first value is logged as a change.
+    added_columns = [c for c in new.columns if c not in columns]
+    for c in added_columns:
+        con.execute('ALTER TABLE history_base ADD COLUMN "%s";' % (c))
+    if added_columns:
+        con.commit()
+        print "Added %s to history_base." % (", ".join(added_columns))
+        columns += added_columns
+    fields = [c for c in columns if c != 'first_seen']
+    new = new.reindex(columns=columns)
+    if last is not None:
+        old = state(con, last, present_only=False)
+    else:
+        old = pd.DataFrame(columns=columns + [PRESENT], index=pd.Index([], name='data_id'))
+
+    #listings seen for the first time go to the base table
+    added = new.loc[new.index.difference(old.index)]
+
+    #fields that differ from the last observation of the listings seen before
+    changes = []
+    common = new.index.intersection(old.index)
+    for field in fields:
+        a = old.loc[common, field].values
+        b = new.loc[common, field].values
+        changed = ~((a == b) | (pd.isnull(a) & pd.isnull(b)))
+        for data_id, value in zip(common[changed].tolist(), b[changed].tolist()):
+            changes.append((data_id, field, scrape_date, value))
+
+    #listings that left or came back to the scrape
+    was_present = old[PRESENT] == 1
+    gone = old.index[was_present & ~old.index.isin(new.index)]
+    back = old.index[~was_present & old.index.isin(new.index)]
+    changes += [(data_id, PRESENT, scrape_date, 0) for data_id in gone.tolist()]
+    changes += [(data_id, PRESENT, scrape_date, 1) for data_id in back.tolist()]
+
+    con.isolation_level = None
+    con.execute("BEGIN;")
+    try:
+        rows = added.reset_index()[['data_id'] + columns].astype(object)
+        rows = rows.where(rows.notnull(), None)
+        con.executemany("INSERT INTO history_base VALUES (%s);" % (", ".join(["?"] * (len(columns) + 1))),
+                        rows.values.tolist())
+        con.executemany("INSERT INTO history_changes VALUES (?, ?, ?, ?);", changes)
+        con.execute("INSERT INTO history_days VALUES (?, ?, ?, ?, ?);",
+                    (scrape_date, source, len(new), len(added), len(changes)))
+        con.execute("COMMIT;")
+    except:
+        con.execute("ROLLBACK;")
+        raise
+    finally:
+        con.isolation_level = ''
+    return len(added), len(changes)
+
+
+def as_of(con, date):
+    """Return the listings online on the last scrape day not after date, in the columns of
+    the daily tables.  days_on_streeteasy and scrape_date refer to that day.
+    """
+    day = last_day(con, date)
+    if day is None:
+        raise ValueError("No scrape day on or before %s in the history." % (date))
+    return decode(state(con, day), day)
+
+
+def field_history(con, data_id, field):
+    """Return the values of one field of a listing over time, as a DataFrame with columns
+    scrape_date and field.  Each row is the day the value was first seen.  With field
+    "_present" the rows are the days the listing left (0) or came back to (1) the scrape.
+    """
+    #a listing is present when first seen
+    column = '1' if field == PRESENT else '"%s"' % (field)
+    first = con.execute('SELECT first_seen, %s FROM history_base WHERE data_id = ?;' % (column),
+                        (data_id,)).fetchone()
+    if first is None:
+        raise KeyError("data_id %s is not in the history." % (data_id))
+    rows = con.execute("""
+    SELECT scrape_date, value FROM history_changes WHERE data_id = ? AND field = ? ORDER BY scrape_date;
+    """, (data_id, field)).fetchall()
+    return pd.DataFrame([first] + rows, columns=['scrape_date', field])
+
+
+def price_history(con, data_id):
+    """Return the asking price of a listing over time.  See field_history."""
+    return field_history(con, data_id, 'price')
+
+
+def read_daily(con, source):
+    """Return a daily table with neighborhood, realtor, etc. as text, whether it was written
+    before or after they were encoded.  A table in the old format is migrated first (see
+    mergeSQL.migrate_table), so every day has the same columns and the same missing code.
+    """
+    isolation_level = con.isolation_level
+    con.isolation_level = None  #migrate_table manages its transaction
+    try:
+        migrate_table(con, source)
+    finally:
+        con.isolation_level = isolation_level
+    df = pd.read_sql("SELECT * FROM %s;" % (source), con)
+    return dimensions.decode(con, df.drop([c for c in dimensions.DIMENSIONS if c in df], axis=1))
+
+
+def main(db_name, table_list=None):
+    """Add daily tables to the history store, skipping the days already ingested.
+
+    Parameters
+    ----------
+      db_name: str
+        - name of the database in which the tables are saved.
+      table_list: list of str, default None
+        - daily tables to ingest, oldest first.  None ingests every t<yyyymmdd> table.
+    """
+    print "Connecting to %s database." % (db_name)
+    con = sqlite3.connect(db_name)
+    init(con)
+    if table_list is None:
+        table_list = daily_tables(con)
+    done = set(r[0] for r in con.execute("SELECT source FROM history_days;"))
+    for source in table_list:
+        if source in done:
+            continue
+        start = datetime.datetime.now()
+        df = read_daily(con, source)
+        n_new, n_changes = ingest(con, df, source=source)
+        print "%s: %d listings, %d new, %d changes (%.1f s)" % (
+            source, len(df), n_new, n_changes, (datetime.datetime.now() - start).total_seconds())
+
+    n_base = con.execute("SELECT COUNT(*) FROM history_base;").fetchone()[0] if has_base(con) else 0
+    n_changes, n_rows = con.execute("SELECT SUM(n_changes), SUM(n_rows) FROM history_days;").fetchone()
+    print "DONE. %d listings and %d changes stored for %d daily rows." % (n_base, n_changes or 0, n_rows or 0)
+    con.close()
+
+if __name__ == '__main__':
+    #path to database
+    db_name = '../data/db/rentnyc_db'
+    #ingest every daily table not yet in the history
+    main(db_name)
@@ -0,0 +1,123 @@
+"""
+Append-only archive of the raw pages downloaded by streeteasy_scrape_public.py.
+
+Each scrape date has two files in the archive directory:
+
+    <date>.html.gz   every page as a separate gzip member, so the file is a valid
+                     multi-member gzip file and any page can be decompressed on its own.
+    <date>.idx       one tab-separated line per page:
+                     kind, data_id, page, offset, length, url
+
+kind is "index" for listings pages and "detail" for listing detail pages.  A listing carried
+forward from a snapshot instead of downloaded is kept as "carried", with the listing as JSON
+(snapshot.dumps) in place of the page.  A page's data is written before its index line, so
+an interrupted run leaves at worst an unindexed tail.
+"""
+import os
+import zlib
+import threading
+from collections import namedtuple
+
+
+Entry = namedtuple('Entry', ['kind', 'data_id', 'page', 'offset', 'length', 'url'])
+
+
+def _compress(html):
+    c = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return c.compress(html) + c.flush()
+
+
+class HTMLArchive(object):
+    """Write and read the raw page archive.
+
+    Parameters
+    ----------
+      directory: str
+        - archive directory.  Created if it does not exist.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._files = {}
+        self._lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _paths(self, date):
+        return (os.path.join(self.directory, date + '.html.gz'),
+                os.path.join(self.directory, date + '.idx'))
+
+    def dates(self):
+        """Return the sorted list of scrape dates in the archive."""
+        return sorted(f[:-len('.idx')] for f in os.listdir(self.directory) if f.endswith('.idx'))
+
+    def add(self, date, url, html, kind, data_id=None, page=None):
+        """Append one page to the archive for the given scrape date.  Thread-safe.
+
+        Parameters
+        ----------
+          date: str
+            - scrape date, e.g. "2017-01-11".
+          url: str
+            - url the page was downloaded from.
+          html: str
+            - page contents.
+          kind: str
+            - "index", "detail" or "carried".
+          data_id: int, default None
+            - listing id of a detail page.
+          page: int, default None
+            - listings page on which the page was found.
+        """
+        data = _compress(html)
+        with self._lock:
+            if date not in self._files:
+                data_file, index_file = self._paths(date)
+                self._files[date] = (open(data_file, 'ab'), open(index_file, 'a'))
+            data_f, index_f = self._files[date]
+            data_f.seek(0, os.SEEK_END)
+            offset = data_f.tell()
+            data_f.write(data)
+            data_f.flush()
+            index_f.write('%s\t%s\t%s\t%d\t%d\t%s\n' % (kind, '' if data_id is None else data_id,
+                                                       '' if page is None else page, offset, len(data), url))
+            index_f.flush()
+
+    def entries(self, date, kind=None):
+        """Return the archived pages of a scrape date as a list of Entry, in the order they
+        were added.  If kind is given, only pages of that kind are returned.
+        """
+        entries = []
+        with open(self._paths(date)[1]) as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) != 6:
+                    continue  #incomplete last line of an interrupted run
+                if kind and fields[0] != kind:
+                    continue
+                entries.append(Entry(fields[0], int(fields[1]) if fields[1] else None,
+                                     int(fields[2]) if fields[2] else None,
+                                     int(fields[3]), int(fields[4]), fields[5]))
+        return entries
+
+    def read(self, date, entry):
+        """Return the page contents for an Entry of the given scrape date."""
+        for entry, html in self.iter_pages(date, [entry]):
+            return html
+
+    def iter_pages(self, date, entries):
+        """Yield (entry, html) for each Entry of the given scrape date, reading them through a
+        single open file.
+        """
+        with open(self._paths(date)[0], 'rb') as f:
+            for entry in entries:
+                f.seek(entry.offset)
+                yield entry, zlib.decompress(f.read(entry.length), 16 + zlib.MAX_WBITS)
+
+    def close(self):
+        """Close the files opened for writing."""
+        with self._lock:
+            for data_f, index_f in self._files.values():
+                data_f.close()
+                index_f.close()
+            self._files = {}
@@ -0,0 +1,234 @@
+"""
+Shared HTTP client for streeteasy_scrape_public.py.
+
+Connections are kept alive and reused per host, responses are requested gzip-compressed,
+and pages can be kept in an on-disk cache.  Cached pages are revalidated with
+If-None-Match/If-Modified-Since, so an unchanged page costs a 304 instead of a full download.
+Requests can be paced, retried and budgeted by a Scheduler (see scheduler.py).
+"""
+import httplib
+import urlparse
+import threading
+import Queue
+import hashlib
+import json
+import zlib
+import gzip
+import os
+import time
+from collections import namedtuple
+
+
+# status: HTTP status of the final response.  source: "network" for a full download,
+# "304" when the server confirmed the cached copy, "cache" when served from the cache
+# without a request.
+Response = namedtuple('Response', ['url', 'status', 'body', 'source'])
+
+REDIRECTS = (301, 302, 303, 307, 308)
+
+
+class HTTPClient(object):
+    """Thread-safe HTTP GET client with keep-alive connection pooling and an optional
+    conditional-request cache.
+
+    Like urllib.urlopen, get() returns the body of error responses (e.g. 404) instead of
+    raising, so the caller can inspect the page.  Network errors are raised.
+
+    Parameters
+    ----------
+      cache_dir: str, default None
+        - directory for cached pages.  Created if it does not exist.  None turns caching off.
+      max_age: float, default 0
+        - cached pages younger than max_age seconds are returned without contacting the
+          server.  With 0 every cached page is revalidated.
+      pool_size: int, default 8
+        - number of idle connections kept per host.
+      timeout: float, default 30
+        - socket timeout in seconds.
+      max_redirects: int, default 5
+        - number of redirects to follow.
+      scheduler: Scheduler, default None
+        - every request to the network goes through scheduler.call.  None sends requests
+          as they come.
+    """
+
+    def __init__(self, cache_dir=None, max_age=0, pool_size=8, timeout=30, max_redirects=5, scheduler=None):
+        self.cache_dir = cache_dir
+        self.max_age = max_age
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.max_redirects = max_redirects
+        self.scheduler = scheduler
+        self.headers = {'User-Agent': 'Mozilla/5.0', 'Accept-Encoding': 'gzip'}
+        self._pools = {}
+        self._lock = threading.Lock()
+        self.stats = {'requests': 0, 'network': 0, '304': 0, 'cache': 0, 'uncached': 0, 'bytes': 0}
+        if cache_dir and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    #########
+    #Connection pool
+    #########
+
+    def _pool(self, scheme, host):
+        with self._lock:
+            key = (scheme, host)
+            if key not in self._pools:
+                self._pools[key] = Queue.Queue(self.pool_size)
+            return self._pools[key]
+
+    def _connect(self, scheme, host):
+        try:
+            return self._pool(scheme, host).get_nowait()
+        except Queue.Empty:
+            if scheme == 'https':
+                return httplib.HTTPSConnection(host, timeout=self.timeout)
+            return httplib.HTTPConnection(host, timeout=self.timeout)
+
+    def _release(self, scheme, host, conn):
+        try:
+            self._pool(scheme, host).put_nowait(conn)
+        except Queue.Full:
+            conn.close()
+
+    def _request(self, url, headers):
+        """Send one GET and read the whole response.  A request on a reused connection that
+        the server has since closed is retried once on a fresh connection.
+        Returns (status, headers, body) with the body decompressed.
+        """
+        parts = urlparse.urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        for attempt in range(2):
+            conn = self._connect(parts.scheme, parts.netloc)
+            try:
+                conn.request('GET', path, headers=headers)
+                r = conn.getresponse()
+                body = r.read()
+            except (httplib.HTTPException, IOError):
+                conn.close()
+                if attempt == 1:
+                    raise
+                continue
+            if r.will_close:
+                conn.close()
+            else:
+                self._release(parts.scheme, parts.netloc, conn)
+            break
+        with self._lock:
+            self.stats['requests'] += 1
+            self.stats['bytes'] += len(body)
+        if r.getheader('content-encoding', '').lower() == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        return r.status, dict((k.lower(), v) for k, v in r.getheaders()), body
+
+    def _send(self, url, headers):
+        """_request through the scheduler, if any."""
+        if self.scheduler is None:
+            return self._request(url, headers)
+        return self.scheduler.call(urlparse.urlsplit(url).netloc, lambda: self._request(url, headers))
+
+    #########
+    #Cache
+    #########
+
+    def _cache_paths(self, url):
+        key = hashlib.sha1(url).hexdigest()
+        return os.path.join(self.cache_dir, key + '.json'), os.path.join(self.cache_dir, key + '.html.gz')
+
+    def _cache_read(self, url):
+        meta_file, body_file = self._cache_paths(url)
+        if not (os.path.isfile(meta_file) and os.path.isfile(body_file)):
+            return None
+        try:
+            with open(meta_file) as f:
+                meta = json.load(f)
+        except ValueError:
+            return None
+        return meta
+
+    def _cache_body(self, url):
+        with gzip.open(self._cache_paths(url)[1], 'rb') as f:
+            return f.read()
+
+    def _cache_write(self, url, headers, body):
+        meta_file, body_file = self._cache_paths(url)
+        meta = {'url': url, 'etag': headers.get('etag'), 'last_modified': headers.get('last-modified'),
+                'time': time.time()}
+        with gzip.open(body_file + '.tmp', 'wb') as f:
+            f.write(body)
+        os.rename(body_file + '.tmp', body_file)
+        self._cache_touch(meta_file, meta)
+
+    def _cache_touch(self, meta_file, meta):
+        meta['time'] = time.time()
+        with open(meta_file + '.tmp', 'w') as f:
+            json.dump(meta, f)
+        if os.path.isfile(meta_file):
+            os.remove(meta_file)
+        os.rename(meta_file + '.tmp', meta_file)
+
+    #########
+    #Public interface
+    #########
+
+    def get(self, url):
+        """Download url, using the cache when possible.  Returns a Response."""
+        meta = self._cache_read(url) if self.cache_dir else None
+        if meta and time.time() - meta['time'] < self.max_age:
+            self._count('cache')
+            return Response(url, 200, self._cache_body(url), 'cache')
+
+        headers = dict(self.headers)
+        if meta:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+
+        target = url
+        for redirect in range(self.max_redirects + 1):
+            status, resp_headers, body = self._send(target, headers)
+            if status not in REDIRECTS or 'location' not in resp_headers:
+                break
+            target = urlparse.urljoin(target, resp_headers['location'])
+
+        if status == 304 and meta:
+            self._count('304')
+            self._cache_touch(self._cache_paths(url)[0], meta)
+            return Response(url, 200, self._cache_body(url), '304')
+
+        self._count('network')
+        if self.cache_dir and status == 200 and ('etag' in resp_headers or 'last-modified' in resp_headers):
+            self._cache_write(url, resp_headers, body)
+        elif self.cache_dir:
+            self._count('uncached')
+        return Response(url, status, body, 'network')
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def report(self):
+        """Print request counts and cache hit, 304 and miss rates."""
+        s = self.stats
+        pages = s['network'] + s['304'] + s['cache']
+        print "HTTP: %d pages, %d requests, %.1f MB received" % (pages, s['requests'], s['bytes'] / 1e6)
+        if self.cache_dir and pages:
+            print "HTTP cache: %.1f%% hit, %.1f%% not modified (304), %.1f%% miss (%d not cacheable)" % (
+                100. * s['cache'] / pages, 100. * s['304'] / pages, 100. * s['network'] / pages, s['uncached'])
+        if self.scheduler:
+            self.scheduler.report()
+
+    def close(self):
+        """Close all idle connections."""
+        with self._lock:
+            pools = self._pools.values()
+            self._pools = {}
+        for pool in pools:
+            while True:
+                try:
+                    pool.get_nowait().close()
+                except Queue.Empty:
+                    break
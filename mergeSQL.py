@@ -1,62 +1,314 @@
 """
 Merge listing tables within the SQL database across days into data set groups.
 Duplicate listings are removed and a new variable is added the date on which the
-listing was most recently scraped.  
+listing was most recently scraped.
+
+The merge is incremental: each daily table is upserted into the merged table inside SQLite
+and recorded in the merged_tables table, so a rerun only merges the days added since.
+Rows are copied in chunks of rowids and never loaded into Python, so memory use is set by
+the SQLite page cache (cache_mb) and the chunk size, not by the size of the history.
+
+Daily tables written before the text columns were dictionary-encoded (see dimensions.py)
+are first migrated in place by migrate_table.  A merged table in that format cannot be
+merged into and must be rebuilt.
 """
-import pandas as pd
 import sqlite3
-import numpy as np
+import sys
+import datetime
+import re
+import pandas as pd
+from query import create_indexes
+import dimensions
+import amenities
+import transit
+import metrics
+from metrics import log, INFO
+
+def list_columns(con, table_name):
+    """Return the column names of a table, in table order."""
+    return [r[1] for r in con.execute("PRAGMA table_info(%s);" % (table_name))]
+
+def copy_columns(con, table_name):
+    """Return the columns of a table that are merged: every column but the text columns of
+    dimensions.DIMENSIONS, which a migrated table keeps next to their keys.
+    """
+    return [c for c in list_columns(con, table_name) if c not in dimensions.DIMENSIONS]
+
+def text_dimensions(con, table_name):
+    """Return the columns of dimensions.DIMENSIONS that a table stores as text only, i.e.
+    the table was written before the encoding.
+    """
+    columns = list_columns(con, table_name)
+    return [d for d in dimensions.DIMENSIONS if d in columns and d + '_id' not in columns]
+
+def daily_tables(con):
+    """Return the names of the daily tables written by csv2sql (t<yyyymmdd>), oldest first."""
+    names = [r[0] for r in con.execute("SELECT name FROM sqlite_master WHERE type = 'table';")]
+    return sorted(n for n in names if re.match(r'^t\d{8}$', n))
+
+def rowid_chunks(con, source, chunk_size):
+    """Yield (low, high) rowid bounds that split a table into chunks of chunk_size rows.
+    A chunk is the rows with low < rowid <= high.  Each bound is found with one index seek,
+    so the table can be written to between chunks.
+    """
+    low = -2 ** 63
+    while True:
+        high = con.execute("SELECT MAX(rowid) FROM (SELECT rowid FROM %s WHERE rowid > ? ORDER BY rowid LIMIT ?);"
+                           % (source), (low, chunk_size)).fetchone()[0]
+        if high is None:
+            return
+        yield low, high
+        low = high
+
+def migrate_table(con, source):
+    """Bring a daily table written by an older csv2sql to the current format, in place and in
+    one transaction: the text columns of dimensions.DIMENSIONS get their <column>_id keys, and
+    amenity_mask and the transit features are computed from the amenity and line columns if
+    the table lacks them.  Unlike the merge, this reads the columns it needs into memory,
+    once per old table.  Returns the names of the added columns.
+    """
+    columns = list_columns(con, source)
+    dims = text_dimensions(con, source)
+    add_mask = 'amenity_mask' not in columns
+    add_features = [c for c in transit.FEATURE_COLUMNS if c not in columns]
+    if not (dims or add_mask or add_features):
+        return []
+    print "Migrating %s to the current table format." % (source)
+    read = dims + [c for c in amenities.COLUMNS if add_mask and c in columns] + \
+        [c for c in transit.COLUMNS if add_features and c in columns]
+    df = pd.read_sql_query('SELECT rowid AS rid, %s FROM %s;' % (", ".join('"%s"' % c for c in read), source), con)
+    #the new columns and their types
+    new = pd.DataFrame(index=df.index)
+    types = {}
+    con.execute("BEGIN;")
+    try:
+        if dims:
+            #the old csv2sql wrote the borough of an unlisted neighborhood as the text "nan"
+            encoded = dimensions.encode(con, df[dims].replace('nan', dimensions.MISSING))
+            for dim in dims:
+                new[dim + '_id'] = encoded[dim + '_id']
+                types[dim + '_id'] = 'INTEGER'
+        if add_mask:
+            new['amenity_mask'] = amenities.pack(df)
+            types['amenity_mask'] = 'INTEGER'
+        if add_features:
+            features = transit.features(df)
+            for c in add_features:
+                new[c] = features[c]
+                types[c] = 'TEXT' if c == 'nearest_line' else 'REAL' if c == 'nearest_distance' else 'INTEGER'
+        for c in new.columns:
+            con.execute('ALTER TABLE %s ADD COLUMN "%s" %s;' % (source, c, types[c]))
+        rows = [values + [rid] for values, rid in zip(new.astype(object).values.tolist(), df['rid'].tolist())]
+        con.executemany("UPDATE %s SET %s WHERE rowid = ?;" % (source, ", ".join('"%s" = ?' % c for c in new.columns)),
+                        rows)
+        con.execute("COMMIT;")
+    except:
+        con.execute("ROLLBACK;")
+        raise
+    return list(new.columns)
 
-def main(db_name, table_list, table_name):
-  """
-  Parameters
-  ----------
-    db_name: str
-      - name of the database in which the tables are saved.
-    table_list: list of str
-      - list of table names that should be merged into the database
-    table_name: str
-      - name of the new merged table
-  """
+def add_columns(con, source, table_name):
+    """Add the columns of source that the merged table lacks, with their declared types, so
+    that no column of source is dropped by the copy.  Listings merged before hold NULL in
+    them until the merged table is rebuilt.  Returns the names of the added columns.
+    """
+    target_cols = set(list_columns(con, table_name))
+    added = []
+    for r in con.execute("PRAGMA table_info(%s);" % (source)).fetchall():
+        if r[1] not in target_cols and r[1] not in dimensions.DIMENSIONS:
+            con.execute('ALTER TABLE %s ADD COLUMN "%s" %s;' % (table_name, r[1], r[2]))
+            added.append(r[1])
+    if added:
+        print "Added %s to %s.  Listings merged before %s are NULL in them until %s is rebuilt (rebuild=True)." % (
+            ", ".join(added), table_name, source, table_name)
+    return added
 
+def upsert_table(con, source, table_name, chunk_size=50000):
+    """Upsert the rows of one daily table into the merged table, one transaction per chunk
+    of chunk_size rows.  A listing already in the merged table is replaced if the new row was
+    scraped on the same day or later, so the newest row per data_id is kept even if days are
+    merged out of order.  Upserting a table twice gives the same result, so a merge that was
+    interrupted can simply be run again.
 
+    Columns of the source that the merged table lacks are added first (see add_columns).
+
+    Returns the number of rows in the source table.
+    """
+    add_columns(con, source, table_name)
+    cols = copy_columns(con, source)
+    col_sql = ", ".join('"%s"' % c for c in cols)
+    update_sql = ", ".join('"%s" = excluded."%s"' % (c, c) for c in cols if c != 'data_id')
+    for low, high in rowid_chunks(con, source, chunk_size):
+        con.execute("BEGIN;")
+        # "WHERE" keeps the parser from reading ON CONFLICT as part of the SELECT
+        con.execute("""
+        INSERT INTO %s (%s) SELECT %s FROM %s WHERE rowid > ? AND rowid <= ?
+        ON CONFLICT(data_id) DO UPDATE SET %s
+        WHERE excluded.scrape_date >= %s.scrape_date OR %s.scrape_date IS NULL;
+        """ % (table_name, col_sql, col_sql, source, update_sql, table_name, table_name), (low, high))
+        con.execute("COMMIT;")
+    return con.execute("SELECT COUNT(*) FROM %s;" % (source)).fetchone()[0]
+
+def rebuild_table(con, sources, table_name, chunk_size=50000):
+    """Fill an empty merged table from the daily tables, writing each listing once.
+
+    The newest source of each data_id is first resolved in a temporary key table
+    (data_id, source, scrape_date), which is much smaller than the listings.  Each source is
+    then copied in chunks, keeping only the rows that the key table assigns to it.  Ties on
+    scrape_date go to the later table in sources, as in upsert_table, and columns the merged
+    table lacks are added as there.
+
+    Returns a list with the number of rows in each source table.
+    """
+    con.execute("DROP TABLE IF EXISTS temp.latest_keys;")
+    con.execute("CREATE TEMP TABLE latest_keys (data_id INTEGER PRIMARY KEY, source INTEGER, scrape_date TEXT);")
+    n_rows = []
+    for i, source in enumerate(sources):
+        con.execute("BEGIN;")
+        con.execute("""
+        INSERT INTO latest_keys SELECT data_id, ?, scrape_date FROM %s WHERE true
+        ON CONFLICT(data_id) DO UPDATE SET source = excluded.source, scrape_date = excluded.scrape_date
+        WHERE excluded.scrape_date >= latest_keys.scrape_date OR latest_keys.scrape_date IS NULL;
+        """ % (source), (i,))
+        con.execute("COMMIT;")
+        n_rows.append(con.execute("SELECT COUNT(*) FROM %s;" % (source)).fetchone()[0])
+
+    for i, source in enumerate(sources):
+        log(INFO, "Now copying %s (%d/%d)", source, i + 1, len(sources))
+        add_columns(con, source, table_name)
+        cols = copy_columns(con, source)
+        col_sql = ", ".join('"%s"' % c for c in cols)
+        select_sql = ", ".join('s."%s"' % c for c in cols)
+        for low, high in rowid_chunks(con, source, chunk_size):
+            con.execute("BEGIN;")
+            con.execute("""
+            INSERT OR REPLACE INTO %s (%s) SELECT %s FROM %s AS s JOIN latest_keys AS k
+            ON k.data_id = s.data_id AND k.source = ? WHERE s.rowid > ? AND s.rowid <= ?;
+            """ % (table_name, col_sql, select_sql, source), (i, low, high))
+            con.execute("COMMIT;")
+    con.execute("DROP TABLE temp.latest_keys;")
+    return n_rows
+
+def main(db_name, table_list, table_name, rebuild=False, chunk_size=50000, cache_mb=64, metrics_file=None):
+    """
+    Parameters
+    ----------
+      db_name: str
+        - name of the database in which the tables are saved.
+      table_list: list of str
+        - list of table names that should be merged into the database.  None merges every
+          daily table (t<yyyymmdd>) in the database.  Tables already merged are skipped, and
+          tables in an older format are migrated first (see migrate_table).
+      table_name: str
+        - name of the merged table.  Created from the first table if it does not exist.
+      rebuild: logical, default False
+        - if true, drop the merged table and merge every table in table_list again.  Needed
+          once for a merged table written before the text columns were encoded.
+      chunk_size: int, default 50000
+        - number of rows copied per transaction.
+      cache_mb: int, default 64
+        - size of the SQLite page cache in MB.  Together with chunk_size this sets the
+          peak memory of the merge, whatever the size of the history.
+      metrics_file: str, default None
+        - if given, merge and index timings and row counts are written to <metrics_file>.json
+          and <metrics_file>.prom (see metrics.py).
+    """
+    metrics.reset()
     #establish a connection to a sql database, if it does not already exist, it is created
     #note that rentnyc is the name of the database and it can have multiple internal tables
     print "Connecting to %s database." % (db_name)
     con = sqlite3.connect(db_name)
-    c = con.cursor()
+    con.isolation_level = None  #transactions are managed explicitly below
+    con.execute("PRAGMA cache_size = %d;" % (-1024 * cache_mb))
+    con.execute("PRAGMA temp_store = FILE;")  #keep the temporary key table out of memory
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS merged_tables (
+        table_name TEXT, source TEXT, n_rows INTEGER, merged_at TEXT, PRIMARY KEY (table_name, source));
+    """)
     print "Done.\n"
     print "Begin formatting data."
 
-    #read the first table in the list
-    df = pd.read_sql("SELECT * FROM %s;" % (table_list[0]), con)
+    if table_list is None:
+        table_list = daily_tables(con)
+    if rebuild:
+        print "Rebuilding %s." % (table_name)
+        con.execute("BEGIN;")
+        con.execute("DROP TABLE IF EXISTS %s;" % (table_name))
+        con.execute("DELETE FROM merged_tables WHERE table_name = ?;", (table_name,))
+        con.execute("COMMIT;")
+
+    #a merged table with text neighborhood, realtor, etc. cannot take the encoded rows
+    old = text_dimensions(con, table_name)
+    if old:
+        con.close()
+        raise ValueError("%s stores %s as text, it was merged before they were encoded (see dimensions.py).  "
+                         "Run mergeSQL.main with rebuild=True to merge it again in the current format."
+                         % (table_name, ", ".join(old)))
+
+    #skip the tables that are already in the merged table
+    merged = set(r[0] for r in con.execute("SELECT source FROM merged_tables WHERE table_name = ?;", (table_name,)))
+    todo = [t for t in table_list if t not in merged]
+    print "%d tables to merge, %d already merged." % (len(todo), len(table_list) - len(todo))
+    if not todo:
+        con.close()
+        return
+
+    #bring daily tables written by an older csv2sql to the current format
+    for source in todo:
+        migrate_table(con, source)
 
-    #loop over remainder of list, merge the dataframes, drop duplicates data_id, but
-    #keep the newer one
-    for t in np.arange(1,np.shape(table_list)[0]):
-        #print
-        print "Now reading %s (%d/%d)" % (table_list[t],t,np.shape(table_list)[0]-1)
-        #read in this table
-        df_tp = pd.read_sql("SELECT * FROM %s;" % (table_list[t]), con)
-        #merge and drop older duplicates
-        df = pd.concat([df,df_tp]).drop_duplicates('data_id','last')
+    #create the merged table with the columns of the first table and a unique data_id
+    con.execute("CREATE TABLE IF NOT EXISTS %s AS SELECT %s FROM %s WHERE 0;" % (
+        table_name, ", ".join('"%s"' % c for c in copy_columns(con, todo[0])), todo[0]))
+    con.execute("CREATE UNIQUE INDEX IF NOT EXISTS ix_%s_data_id ON %s (data_id);" % (table_name, table_name))
 
-    #if the merged table already exists, drop it
-    c.execute("""
-    DROP TABLE IF EXISTS %s;
-    """ % (table_name))
+    try:
+        if con.execute("SELECT COUNT(*) FROM %s;" % (table_name)).fetchone()[0] == 0:
+            #empty merged table: resolve the newest row of each data_id first and copy it once
+            merged_at = str(datetime.datetime.now())
+            with metrics.timed('merge'):
+                n_rows = rebuild_table(con, todo, table_name, chunk_size)
+            metrics.count('rows_merged', sum(n_rows))
+            metrics.count('tables_merged', len(todo))
+            con.executemany("INSERT OR REPLACE INTO merged_tables VALUES (?, ?, ?, ?);",
+                            [(table_name, source, n, merged_at) for source, n in zip(todo, n_rows)])
+        else:
+            #upsert the tables in order, keeping the newer duplicate of each data_id
+            for t, source in enumerate(todo):
+                log(INFO, "Now merging %s (%d/%d)", source, t + 1, len(todo))
+                with metrics.timed('merge'):
+                    n_rows = upsert_table(con, source, table_name, chunk_size)
+                metrics.count('rows_merged', n_rows)
+                metrics.count('tables_merged')
+                con.execute("INSERT OR REPLACE INTO merged_tables VALUES (?, ?, ?, ?);",
+                            (table_name, source, n_rows, str(datetime.datetime.now())))
+    except:
+        metrics.count('errors', type=sys.exc_info()[0].__name__)
+        if metrics_file:
+            metrics.write(metrics_file)
+        try:
+            con.execute("ROLLBACK;")
+        except sqlite3.OperationalError:
+            pass  #no transaction was open
+        con.close()
+        raise
 
-    #upload the newtable to the database
-    print("Uploading new table to database.")
-    df.to_sql(table_name, con)
+    #indexes for the queries of query.py
+    with metrics.timed('index'):
+        create_indexes(con, table_name)
+    #view showing neighborhood, realtor, etc. as text
+    dimensions.create_view(con, table_name)
 
     #close connection
-    print("DONE. Closing database connection.")
+    print "DONE. %s has %d listings. Closing database connection." % (
+        table_name, con.execute("SELECT COUNT(*) FROM %s;" % (table_name)).fetchone()[0])
     con.close()
+    if metrics_file:
+        metrics.write(metrics_file)
 
 if __name__ == '__main__':
-    #path to database 
-    db_name = '../data/db/rentnyc_db'                  
+    #path to database
+    db_name = '../data/db/rentnyc_db'
     #list of tables to merge
     table_list = [
         't20161030', 't20161102', 't20161103', 't20161104', 't20161106', 't20161107', 't20161108', 't20161109',
@@ -71,4 +323,3 @@ if __name__ == '__main__':
     table_name = 'all_data'
     #run function
     main(db_name, table_list, table_name)
-    
\ No newline at end of file
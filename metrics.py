@@ -0,0 +1,223 @@
+"""
+Run metrics and log levels for the scraper and the loaders.
+
+Stages are timed into one histogram, stage_seconds, labelled by stage:
+
+    with metrics.timed('parse'):
+        parse_listing(html, d)
+
+and events are counted, optionally by label:
+
+    metrics.count('listings')
+    metrics.count('errors', type='IOError')
+
+At the end of a run write() saves a JSON summary (<prefix>.json: counters, gauges, and
+count, total, mean, min, max and p50/p95/p99 seconds per stage) and the same metrics in the
+Prometheus text format (<prefix>.prom), which the node_exporter textfile collector can
+pick up.
+
+Messages go through log(level, msg, *args).  msg is only formatted and printed if level is
+at or above the level set with set_level, so per-listing debug messages cost a comparison
+when they are off.
+"""
+import threading
+import json
+import time
+import os
+from contextlib import contextmanager
+
+
+#########
+#Log levels
+#########
+
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
+
+_level = INFO
+
+
+def set_level(level):
+    """Set the log level, given as a name ("debug", "info", "warning", "error") or number."""
+    global _level
+    _level = LEVELS[level.lower()] if isinstance(level, basestring) else level
+
+
+def enabled(level):
+    return level >= _level
+
+
+def log(level, msg, *args):
+    """Print msg % args if level is enabled."""
+    if level >= _level:
+        print msg % args if args else msg
+
+
+#########
+#Registry
+#########
+
+# upper bounds in seconds of the stage_seconds histogram buckets
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# prefix of the Prometheus metric names
+NAMESPACE = 'streeteasy'
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def _label_text(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % (','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs))
+
+
+class _Histogram(object):
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  #last one is +Inf
+        self.sum = 0.
+        self.count = 0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def quantile(self, q):
+        """Estimate a quantile by linear interpolation within its bucket, clipped to the
+        smallest and largest values seen.  The +Inf bucket ends at the largest value seen.
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.
+                upper = self.buckets[i] if i < len(self.buckets) else self.max
+                return min(max(lower + (upper - lower) * (rank - seen) / n, self.min), self.max)
+            seen += n
+        return self.max
+
+
+class Metrics(object):
+    """Thread-safe counters, gauges and histograms of one run.
+
+    Parameters
+    ----------
+      buckets: tuple of float, default BUCKETS
+        - upper bounds of the histogram buckets.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.gauges = {}
+            self.histograms = {}
+            self.started = time.time()
+
+    def count(self, name, n=1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def gauge(self, name, value, **labels):
+        with self._lock:
+            self.gauges[_key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = _Histogram(self.buckets)
+            self.histograms[key].observe(value)
+
+    @contextmanager
+    def timed(self, stage):
+        """Time the body of a with statement into stage_seconds{stage=...}, exceptions
+        included.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe('stage_seconds', time.time() - start, stage=stage)
+
+    def summary(self):
+        """Return the metrics as a dict for the JSON summary."""
+        def name(key):
+            return key[0] + _label_text(key[1])
+        with self._lock:
+            stages = {}
+            for key, h in self.histograms.items():
+                stages[name(key)] = {'count': h.count, 'total_seconds': h.sum,
+                                     'mean_seconds': h.sum / h.count if h.count else None,
+                                     'min_seconds': h.min, 'max_seconds': h.max,
+                                     'p50_seconds': h.quantile(0.5), 'p95_seconds': h.quantile(0.95),
+                                     'p99_seconds': h.quantile(0.99)}
+            return {'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+                    'run_seconds': time.time() - self.started,
+                    'counters': dict((name(k), v) for k, v in self.counters.items()),
+                    'gauges': dict((name(k), v) for k, v in self.gauges.items()),
+                    'histograms': stages}
+
+    def prometheus(self):
+        """Return the metrics in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            for kind, values, suffix in [('counter', self.counters, '_total'), ('gauge', self.gauges, '')]:
+                for metric in sorted(set(k[0] for k in values)):
+                    full = '%s_%s%s' % (NAMESPACE, metric, suffix)
+                    lines.append('# TYPE %s %s' % (full, kind))
+                    for key in sorted(k for k in values if k[0] == metric):
+                        lines.append('%s%s %r' % (full, _label_text(key[1]), float(values[key])))
+            for metric in sorted(set(k[0] for k in self.histograms)):
+                full = '%s_%s' % (NAMESPACE, metric)
+                lines.append('# TYPE %s histogram' % (full))
+                for key in sorted(k for k in self.histograms if k[0] == metric):
+                    h = self.histograms[key]
+                    cumulative = 0
+                    for bound, n in zip(list(self.buckets) + ['+Inf'], h.counts):
+                        cumulative += n
+                        lines.append('%s_bucket%s %d' % (full, _label_text(key[1], [('le', bound)]), cumulative))
+                    lines.append('%s_sum%s %r' % (full, _label_text(key[1]), h.sum))
+                    lines.append('%s_count%s %d' % (full, _label_text(key[1]), h.count))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, prefix):
+        """Write <prefix>.json and <prefix>.prom.  Each file is written under a temporary
+        name and renamed over the old one, so a collector never reads half a file or finds
+        none.
+        """
+        for ext, text in [('.json', json.dumps(self.summary(), indent=1, sort_keys=True)), ('.prom', self.prometheus())]:
+            with open(prefix + ext + '.tmp', 'w') as f:
+                f.write(text)
+            os.rename(prefix + ext + '.tmp', prefix + ext)
+
+
+# registry shared by the modules of a run
+METRICS = Metrics()
+reset = METRICS.reset
+count = METRICS.count
+gauge = METRICS.gauge
+observe = METRICS.observe
+timed = METRICS.timed
+summary = METRICS.summary
+write = METRICS.write
@@ -0,0 +1,260 @@
+"""
+Read-only queries on the merged listings table, for the RentNYC back end.
+
+The merged table gets composite indexes that cover the common filters (neighborhood or
+borough, beds, price range), so these queries read only the index instead of scanning every
+row.  Each query shape has a fixed SQL text with ? parameters, so sqlite3 prepares it once
+per connection and reuses the statement.  Results are kept in an LRU cache that is emptied
+when mergeSQL merges new days into the table.
+
+Neighborhood and borough are stored as keys into dimension tables (see dimensions.py).
+Names given to the queries are looked up once and the filters and group-bys compare
+integers; listings are read through the v_<table> view, which adds the names back.
+
+Each transit line column has a partial index holding only the listings near that line, so
+near_lines() reads one index range per line (see transit.py).
+"""
+import sqlite3
+import threading
+import itertools
+from collections import OrderedDict
+import dimensions
+import amenities
+import transit
+
+
+# name, columns and optional WHERE clause of the indexes on the merged table.  price comes
+# last so that price ranges and medians within a group are read in order from the index.
+INDEXES = [
+    ('nhood_beds_price', ['neighborhood_id', 'beds', 'price']),
+    ('borough_beds_price', ['borough_id', 'beds', 'price']),
+    ('beds_price', ['beds', 'price']),
+    ('price', ['price']),
+    # amenity set filters scan this index instead of the table (see amenities.py)
+    ('amenity_mask_price', ['amenity_mask', 'price']),
+    ('nearest_distance_price', ['nearest_distance', 'price']),
+] + transit.indexes()
+
+# columns returned by ListingQueries.listings
+LISTING_COLUMNS = ['data_id', 'address', 'neighborhood', 'borough', 'price', 'beds', 'baths',
+                   'sq_ft', 'unit_type', 'link']
+
+# filters of ListingQueries.listings, in the order they appear in the SQL.  neighborhood and
+# borough names are replaced by their keys, lists of amenities by their mask (see amenities.py).
+FILTERS = OrderedDict([
+    ('neighborhood', 'neighborhood_id = ?'),
+    ('borough', 'borough_id = ?'),
+    ('beds', 'beds = ?'),
+    ('min_price', 'price >= ?'),
+    ('max_price', 'price <= ?'),
+    ('amenities_all', '(~amenity_mask & ?) = 0'),
+    ('amenities_any', '(amenity_mask & ?) != 0'),
+    ('max_transit_distance', 'nearest_distance BETWEEN 0 AND ?'),
+])
+
+
+def create_indexes(con, table_name):
+    """Create the indexes of INDEXES on a table if they do not exist, then update the
+    statistics the query planner uses to choose between them.
+    """
+    for index in INDEXES:
+        name, columns = index[:2]
+        where = " WHERE %s" % (index[2]) if len(index) > 2 else ""
+        con.execute("CREATE INDEX IF NOT EXISTS ix_%s_%s ON %s (%s)%s;" % (table_name, name, table_name, ", ".join(columns), where))
+    con.execute("ANALYZE %s;" % (table_name))
+    con.commit()
+
+
+def median(values):
+    """Median of a sorted list."""
+    n = len(values)
+    if n % 2:
+        return values[n // 2]
+    return (values[n // 2 - 1] + values[n // 2]) / 2.
+
+
+class ListingQueries(object):
+    """Parameterized, cached queries on a merged listings table.  Thread-safe.
+
+    Parameters
+    ----------
+      db_name: str
+        - name of the database.
+      table_name: str, default "all_data"
+        - merged table, as written by mergeSQL.
+      cache_size: int, default 256
+        - number of query results kept.  0 turns the cache off.
+    """
+
+    def __init__(self, db_name, table_name='all_data', cache_size=256):
+        self.table_name = table_name
+        self.cache_size = cache_size
+        self.con = sqlite3.connect(db_name, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._generation = None
+        self._keys = {}
+        self.stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+    #########
+    #Cache
+    #########
+
+    def generation(self):
+        """Return a value that changes whenever mergeSQL merges into the table: the number
+        of merged days and the time of the last merge, from the merged_tables registry.
+        """
+        try:
+            return self.con.execute("SELECT COUNT(*), MAX(merged_at) FROM merged_tables WHERE table_name = ?;",
+                                    (self.table_name,)).fetchone()
+        except sqlite3.OperationalError:
+            return None  #no registry: table not built by mergeSQL
+
+    def _run(self, shape, sql, params, reduce=list):
+        """Run a query, or return its cached result.  reduce turns the cursor into the
+        result that is cached.
+        """
+        key = (shape, params)
+        with self._lock:
+            self._refresh()
+            if key in self._cache:
+                self.stats['hits'] += 1
+                result = self._cache.pop(key)
+                self._cache[key] = result  #most recently used goes last
+                return result
+            self.stats['misses'] += 1
+            result = reduce(self.con.execute(sql, params))
+            if self.cache_size > 0:
+                self._cache[key] = result
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+            return result
+
+    def _refresh(self):
+        """Empty the caches if the table changed.  Called with the lock held."""
+        generation = self.generation()
+        if generation != self._generation:
+            if self._cache:
+                self.stats['invalidations'] += 1
+            self._cache.clear()
+            self._keys = {}
+            self._generation = generation
+
+    def _dimension(self, dim, reverse=False):
+        """Return {name: key} of a dimension table, or {key: name} if reverse is true."""
+        with self._lock:
+            self._refresh()
+            if (dim, reverse) not in self._keys:
+                read = dimensions.values if reverse else dimensions.keys
+                self._keys[(dim, reverse)] = read(self.con, dim)
+            return self._keys[(dim, reverse)]
+
+    def clear_cache(self):
+        with self._lock:
+            self._cache.clear()
+
+    #########
+    #Queries
+    #########
+
+    def _where(self, filters):
+        """Return (filter names, WHERE clause, parameters) for the filters of listings().
+        The clause depends only on which filters are set, so each combination is one query
+        shape with one prepared statement.
+        """
+        unknown = set(filters) - set(FILTERS)
+        if unknown:
+            raise TypeError("unknown filters: %s" % (", ".join(sorted(unknown))))
+        used = [f for f in FILTERS if filters.get(f) is not None]
+        where = " AND ".join(FILTERS[f] for f in used) or "1"
+        params = []
+        for f in used:
+            if f in dimensions.DIMENSIONS:
+                #an unknown name becomes NULL, which matches no row
+                params.append(self._dimension(f).get(filters[f]))
+            elif f.startswith('amenities_'):
+                params.append(amenities.mask(filters[f]))
+            else:
+                params.append(filters[f])
+        return used, where, tuple(params)
+
+    def listings(self, limit=100, **filters):
+        """Return listings matching the filters, cheapest first, as a list of dicts with the
+        columns of LISTING_COLUMNS.
+
+        Keyword arguments:
+            neighborhood, borough, beds: exact match
+            min_price, max_price: price range, inclusive
+            amenities_all, amenities_any: lists of amenities, all or at least one of which the
+                listing has
+            max_transit_distance: distance in miles to the nearest line of any kind
+        """
+        used, where, params = self._where(filters)
+        sql = "SELECT %s FROM v_%s WHERE %s ORDER BY price LIMIT ?;" % (", ".join(LISTING_COLUMNS), self.table_name, where)
+        rows = self._run('listings:' + ",".join(used), sql, params + (limit,))
+        return [dict(zip(LISTING_COLUMNS, r)) for r in rows]
+
+    def near_lines(self, lines, radius=0.25, limit=100, **filters):
+        """Return listings within radius miles of any of the given lines (e.g. ["A", "C",
+        "E"]) that match the filters of listings(), closest first.  Each dict has the columns
+        of LISTING_COLUMNS and "distance", the distance to the closest of the lines.
+        """
+        lines = sorted(set(transit.column(l) for l in lines))
+        near, near_params = transit.sql_filter(lines, radius)
+        used, where, params = self._where(filters)
+        # absent lines (0) must not count as the closest.  every row has one line within
+        # radius, so the min is a real distance.
+        distance = "min(%s)" % (", ".join("CASE WHEN %s > 0 THEN %s ELSE 1e9 END" % (c, c) for c in lines)) \
+            if len(lines) > 1 else lines[0]
+        sql = "SELECT %s, %s AS distance FROM v_%s WHERE %s AND %s ORDER BY distance, price LIMIT ?;" % (
+            ", ".join(LISTING_COLUMNS), distance, self.table_name, near, where)
+        rows = self._run('near_lines:%s:%s' % (",".join(lines), ",".join(used)), sql, near_params + params + (limit,))
+        return [dict(zip(LISTING_COLUMNS + ['distance'], r)) for r in rows]
+
+    def count(self, **filters):
+        """Return the number of listings matching the filters of listings()."""
+        used, where, params = self._where(filters)
+        sql = "SELECT COUNT(*) FROM %s WHERE %s;" % (self.table_name, where)
+        return self._run('count:' + ",".join(used), sql, params, lambda c: c.fetchone()[0])
+
+    def median_price(self, neighborhood, beds):
+        """Return (median price, number of listings) for one neighborhood and bedroom count,
+        or (None, 0) if there are none.
+        """
+        sql = "SELECT price FROM %s WHERE neighborhood_id = ? AND beds = ? ORDER BY price;" % (self.table_name)
+        params = (self._dimension('neighborhood').get(neighborhood), beds)
+        prices = self._run('median_price', sql, params, lambda c: [r[0] for r in c])
+        return (median(prices) if prices else None), len(prices)
+
+    def median_price_by(self, group='neighborhood', borough=None):
+        """Return {(group, beds): (median price, number of listings)} over the whole table,
+        or over one borough.  group is "neighborhood" or "borough".
+        """
+        if group not in ('neighborhood', 'borough'):
+            raise ValueError("group must be 'neighborhood' or 'borough', not %r" % (group))
+        if borough is not None:
+            where, params = "WHERE borough_id = ?", (self._dimension('borough').get(borough),)
+        else:
+            where, params = "", ()
+        # the covering index returns the rows grouped and sorted by price without a sort step
+        sql = "SELECT %s_id, beds, price FROM %s %s ORDER BY %s_id, beds, price;" % (group, self.table_name, where, group)
+        names = self._dimension(group, reverse=True)
+
+        def reduce(cursor):
+            result = {}
+            for (key, beds), rows in itertools.groupby(cursor, lambda r: (r[0], r[1])):
+                prices = [r[2] for r in rows]
+                result[(names.get(key, key), beds)] = (median(prices), len(prices))
+            return result
+        return dict(self._run('median_price_by:%s:%s' % (group, borough is not None), sql, params, reduce))
+
+    def close(self):
+        self.con.close()
+
+if __name__ == '__main__':
+    #path to database
+    db_name = '../data/db/rentnyc_db'
+    q = ListingQueries(db_name)
+    create_indexes(q.con, q.table_name)
+    for (nhood, beds), (price, n) in sorted(q.median_price_by().items())[:20]:
+        print "%-30s %2s beds  median $%7.0f  (%d listings)" % (nhood, beds, price, n)
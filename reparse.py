@@ -0,0 +1,85 @@
+"""
+Rebuild the daily .csv files from the raw page archive (see html_archive.py) without any
+network access.  Use this after changing the extraction logic in streeteasy_scrape_public.py.
+Listings are parsed in parallel across a process pool.
+"""
+import os
+import sys
+import datetime
+import multiprocessing
+from html_archive import HTMLArchive
+from streeteasy_scrape_public import COL_LIST, COL_DTYPES, RecordBuffer, new_record, parse_listing, print_err
+import snapshot
+
+
+def parse_chunk(args):
+    """Parse a chunk of archived detail pages.  Runs in a worker process.
+
+    Parameters
+    ----------
+      args: tuple (archive_dir, date, entries)
+        - archive directory, scrape date and a list of html_archive.Entry.
+
+    Returns a list of listing dicts, in the order of entries.  Listings carried forward from a
+    snapshot are returned as they were archived.  Listings that fail to parse are reported and
+    left out, as in streeteasy_scrape_public.main.
+    """
+    archive_dir, date, entries = args
+    records = []
+    for entry, html in HTMLArchive(archive_dir).iter_pages(date, entries):
+        try:
+            if entry.kind == 'carried':
+                records.append(snapshot.loads(html))
+                continue
+            records.append(parse_listing(html, new_record(entry.data_id, entry.url, date)))
+        except:
+            print "Error parsing data_id %s from %s" % (entry.data_id, date)
+            print_err()
+    return records
+
+
+def main(archive_dir, out_dir, dates=None, processes=None, chunk_size=200):
+    """Parse every archived detail page and write one csv per scrape date, with the carried
+    listings in their place, in the same format as streeteasy_scrape_public.main.
+
+    Parameters
+    ----------
+      archive_dir: str
+        - directory of the page archive.
+      out_dir: str
+        - directory in which to write the <date>.csv files.  Created if it does not exist.
+      dates: list of str, default None
+        - scrape dates to rebuild.  Defaults to every date in the archive.
+      processes: int, default None
+        - number of worker processes.  Defaults to the number of CPUs.
+      chunk_size: int, default 200
+        - number of listings sent to a worker at a time.
+    """
+    archive = HTMLArchive(archive_dir)
+    if dates is None:
+        dates = archive.dates()
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        for date in dates:
+            start = datetime.datetime.now()
+            entries = [e for e in archive.entries(date) if e.kind in ('detail', 'carried')]
+            chunks = [(archive_dir, date, entries[i:i + chunk_size]) for i in range(0, len(entries), chunk_size)]
+            # imap keeps the chunks in archive order
+            df_temp = RecordBuffer(COL_LIST, COL_DTYPES)
+            for records in pool.imap(parse_chunk, chunks):
+                for d in records:
+                    df_temp.append(d)
+            df_temp.to_frame().to_csv(os.path.join(out_dir, date + '.csv'))
+            seconds = (datetime.datetime.now() - start).total_seconds()
+            print "%s: %d/%d listings parsed in %.1f s (%.0f listings/s)" % (
+                date, len(df_temp), len(entries), seconds, len(df_temp) / max(seconds, 1e-6))
+    finally:
+        pool.close()
+        pool.join()
+
+if __name__ == '__main__':
+    #rebuild all archived days, or the dates given on the command line
+    main('archive', 'reparsed', dates=sys.argv[1:] or None)
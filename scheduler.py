@@ -0,0 +1,260 @@
+"""
+Per-host request scheduler for the HTTP client.
+
+Every request to a host goes through Scheduler.call, which
+
+    - waits for a token from the host's token bucket (at most `rate` requests per second),
+    - waits for a free slot under the host's concurrency limit,
+    - retries throttled (429), unavailable (5xx) and failed requests after a jittered
+      exponential backoff, or after the server's Retry-After,
+    - stops with BudgetExhausted once max_requests requests have been sent.
+
+With adaptive=True the concurrency limit and the rate follow AIMD, as TCP congestion
+control does: every fast, successful response raises them a little (the limit by 1/limit,
+so by about one per round of requests), while a 429, a 5xx, a network error or a slow
+response multiplies them by `decrease`, at most once per second (or round trip, if longer).
+Without a rate limit, the first decrease sets one below the rate requests were being sent
+at.  A response is slow if it takes more than slow_factor times the fastest response seen
+from the host, and at least min_slow seconds.  The crawl settles just under the rate at
+which the server starts to push back.
+"""
+import httplib
+import threading
+import collections
+import random
+import time
+
+
+# statuses that mean the server is overloaded or throttling us
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class BudgetExhausted(Exception):
+    """Raised by Scheduler.call when the request budget of the run is used up."""
+    pass
+
+
+class _Host(object):
+    """Limits and measurements of one host."""
+
+    def __init__(self, rate, limit, burst):
+        self.rate = rate
+        self.limit = float(limit)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.refilled = time.time()
+        self.in_flight = 0
+        self.paused_until = 0
+        self.min_latency = None
+        self.latency = None  #moving average
+        self.last_decrease = 0
+        self.sent = collections.deque(maxlen=50)  #send times of the last requests
+
+    def sent_rate(self, now):
+        """Requests per second over the last requests sent."""
+        if len(self.sent) < 2 or now <= self.sent[0]:
+            return None
+        return len(self.sent) / (now - self.sent[0])
+
+    def refill(self, now):
+        if self.rate is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+
+
+class Scheduler(object):
+    """Thread-safe per-host token bucket, adaptive concurrency limit, retries and request
+    budget.
+
+    Parameters
+    ----------
+      rate: float, default None
+        - maximum requests per second to each host.  None for no rate limit.
+      max_concurrency: int, default 8
+        - maximum requests in flight to each host.
+      initial_concurrency: int, default 2
+        - concurrency limit at the start of the run, when adaptive is true.
+      adaptive: logical, default True
+        - adjust the concurrency limit and rate with AIMD.  If false, they stay at
+          max_concurrency and rate.
+      burst: int, default 2
+        - size of the token bucket: requests that can be sent at once after an idle period.
+      retries: int, default 3
+        - number of times a throttled or failed request is retried.  After the last retry
+          the error response is returned or the network error raised.
+      backoff: float, default 0.5
+        - first retry delay in seconds, doubled at each retry, with full jitter.
+      max_backoff: float, default 30
+        - maximum retry delay in seconds.
+      max_requests: int, default None
+        - request budget of the run, retries included.  None for no budget.
+      decrease: float, default 0.7
+        - factor applied to the concurrency limit and rate on congestion.
+      slow_factor: float, default 4
+        - a response slower than slow_factor times the fastest one counts as congestion.
+      min_slow: float, default 0.25
+        - responses faster than this many seconds never count as slow.
+    """
+
+    def __init__(self, rate=None, max_concurrency=8, initial_concurrency=2, adaptive=True, burst=2,
+                 retries=3, backoff=0.5, max_backoff=30, max_requests=None, decrease=0.7,
+                 slow_factor=4, min_slow=0.25):
+        self.rate = rate
+        self.max_concurrency = max_concurrency
+        self.initial_concurrency = min(initial_concurrency, max_concurrency) if adaptive else max_concurrency
+        self.adaptive = adaptive
+        self.burst = burst
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_requests = max_requests
+        self.decrease = decrease
+        self.slow_factor = slow_factor
+        self.min_slow = min_slow
+        self.min_rate = 0.1 if rate is None else min(0.1, rate)
+        self._hosts = {}
+        self._cond = threading.Condition()
+        self.stats = {'requests': 0, 'retries': 0, 'throttled': 0, 'errors': 0, 'slow': 0, 'decreases': 0,
+                      'wait_seconds': 0.}
+
+    #########
+    #Limits
+    #########
+
+    def _host(self, host):
+        if host not in self._hosts:
+            self._hosts[host] = _Host(self.rate, self.initial_concurrency, self.burst)
+        return self._hosts[host]
+
+    def _acquire(self, host):
+        """Wait for a token and a concurrency slot.  Raises BudgetExhausted."""
+        start = time.time()
+        with self._cond:
+            h = self._host(host)
+            while True:
+                if self.max_requests is not None and self.stats['requests'] >= self.max_requests:
+                    raise BudgetExhausted("request budget of %d used up" % (self.max_requests))
+                now = time.time()
+                h.refill(now)
+                if now < h.paused_until:
+                    wait = h.paused_until - now
+                elif h.in_flight >= int(h.limit):
+                    wait = None  #until a request finishes
+                elif h.rate is not None and h.tokens < 1:
+                    wait = (1 - h.tokens) / h.rate
+                else:
+                    if h.rate is not None:
+                        h.tokens -= 1
+                    h.in_flight += 1
+                    h.sent.append(now)
+                    self.stats['requests'] += 1
+                    self.stats['wait_seconds'] += now - start
+                    return
+                self._cond.wait(wait)
+
+    def _release(self, host, latency, outcome, retry_after=None):
+        """Free the slot of a finished request and adjust the host's limits.  outcome is
+        "ok", "throttled" or "error".
+        """
+        with self._cond:
+            h = self._host(host)
+            h.in_flight -= 1
+            now = time.time()
+            if outcome == 'ok':
+                h.min_latency = latency if h.min_latency is None else min(h.min_latency, latency)
+                h.latency = latency if h.latency is None else 0.8 * h.latency + 0.2 * latency
+                if latency > max(self.slow_factor * h.min_latency, self.min_slow):
+                    outcome = 'slow'
+            if outcome != 'ok':
+                self.stats[{'slow': 'slow', 'error': 'errors', 'throttled': 'throttled'}[outcome]] += 1
+            if retry_after:
+                h.paused_until = max(h.paused_until, now + retry_after)
+            if self.adaptive:
+                if outcome == 'ok':
+                    #additive increase
+                    h.limit = min(self.max_concurrency, h.limit + 1. / h.limit)
+                    if h.rate is not None:
+                        h.rate = h.rate + 1. / h.rate
+                        if self.rate is not None:
+                            h.rate = min(self.rate, h.rate)
+                elif now - h.last_decrease > max(1., h.latency or 0):
+                    #multiplicative decrease, once per round trip at most: the other requests in
+                    #flight were sent under the old limit and say nothing about the new one
+                    h.limit = max(1., h.limit * self.decrease)
+                    rate = h.rate if h.rate is not None else h.sent_rate(now)
+                    if rate is not None:
+                        if h.rate is None:
+                            h.tokens, h.refilled = 1., now
+                        h.rate = max(self.min_rate, rate * self.decrease)
+                    h.last_decrease = now
+                    self.stats['decreases'] += 1
+            self._cond.notify_all()
+
+    def _delay(self, attempt, retry_after):
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        return max(delay, retry_after or 0)
+
+    #########
+    #Public interface
+    #########
+
+    def call(self, host, func):
+        """Send a request to host through the limits, retrying as needed.
+
+        Parameters
+        ----------
+          host: str
+            - host the request goes to, e.g. "streeteasy.com".
+          func: callable
+            - sends the request and returns a tuple (status, headers, ...), headers being a
+              dict with lower-case keys.  Network errors are raised (IOError or
+              httplib.HTTPException).
+
+        Returns the result of func.
+        """
+        for attempt in range(self.retries + 1):
+            if attempt:
+                with self._cond:
+                    self.stats['retries'] += 1
+            self._acquire(host)
+            start = time.time()
+            try:
+                result = func()
+            except (IOError, httplib.HTTPException):
+                self._release(host, time.time() - start, 'error')
+                if attempt == self.retries:
+                    raise
+                time.sleep(self._delay(attempt, None))
+                continue
+            status, headers = result[0], result[1]
+            if status not in RETRY_STATUSES:
+                self._release(host, time.time() - start, 'ok')
+                return result
+            retry_after = parse_retry_after(headers.get('retry-after'))
+            self._release(host, time.time() - start, 'throttled', retry_after)
+            if attempt == self.retries:
+                return result
+            time.sleep(self._delay(attempt, retry_after))
+
+    def limits(self):
+        """Return {host: (concurrency limit, rate)}."""
+        with self._cond:
+            return dict((host, (h.limit, h.rate)) for host, h in self._hosts.items())
+
+    def report(self):
+        """Print request, retry and throttle counts and the current limits."""
+        s = self.stats
+        print "Scheduler: %d requests, %d retries, %d throttled, %d errors, %d slow, %.1f s waiting" % (
+            s['requests'], s['retries'], s['throttled'], s['errors'], s['slow'], s['wait_seconds'])
+        for host, (limit, rate) in sorted(self.limits().items()):
+            print "  %s: concurrency %.1f, %s" % (host, limit, 'no rate limit' if rate is None else '%.1f requests/s' % (rate))
+
+
+def parse_retry_after(value):
+    """Return the seconds of a Retry-After header given in seconds, or None.  HTTP dates are
+    ignored.
+    """
+    try:
+        return max(0., float(value))
+    except (TypeError, ValueError):
+        return None
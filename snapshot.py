@@ -0,0 +1,179 @@
+"""
+Change detection against the previous snapshot of the listings.
+
+Most listings are the same from one day to the next.  The listing cards of the index pages
+already give the data_id, the link and usually the price of each listing, so the scraper
+compares them with the previous snapshot and downloads only the detail pages of listings
+that are new or whose card changed.  The other listings are carried forward: the snapshot
+row is copied with today's scrape_date, and days_on_streeteasy is advanced by the days
+since it was scraped.
+
+The snapshot is the previous daily csv (from_csv, or latest_csv to find it) or the merged
+table of mergeSQL.py (from_sql), whose columns are mapped back to those of the scraper.
+Changes that do not show on the cards (amenities, realtor, ...) are picked up by
+downloading every listing again every refresh_days days.  The day of each listing is set by
+its data_id, so the refreshes are spread evenly over the days.
+"""
+import os
+import re
+import json
+import sqlite3
+import datetime
+import urlparse
+import numpy as np
+import pandas as pd
+import amenities
+import transit
+
+
+# daily csv files written by the scraper
+CSV_RE = re.compile(r'^(\d{4}-\d{2}-\d{2})\.csv$')
+
+# columns added by csv2sql that the scraper does not write
+SQL_ONLY = ["borough"] + transit.FEATURE_COLUMNS
+
+
+def latest_csv(directory='.', before=None):
+    """Return the path of the newest daily csv (<yyyy-mm-dd>.csv) in directory dated before
+    the given date string (default today), or None if there is none.
+    """
+    before = before or str(datetime.date.today())
+    dates = [m.group(1) for m in (CSV_RE.match(f) for f in os.listdir(directory)) if m and m.group(1) < before]
+    return os.path.join(directory, max(dates) + '.csv') if dates else None
+
+
+def from_csv(csv_file, refresh_days=30):
+    """Return the Snapshot of a daily csv written by the scraper."""
+    return Snapshot(pd.read_csv(csv_file, index_col=0), refresh_days)
+
+
+def from_sql(db_name, table_name='all_data', refresh_days=30):
+    """Return the Snapshot of a merged table.  The text columns are read from the view
+    v_<table_name>, the columns renamed by csv2sql get their scraper names back, and the -1
+    missing code (0 for a line that is not listed) becomes NaN again.
+    """
+    con = sqlite3.connect(db_name)
+    try:
+        df = pd.read_sql_query("SELECT * FROM v_%s;" % (table_name), con)
+    finally:
+        con.close()
+    df = df.drop([c for c in df.columns if c.endswith('_id') and c != 'data_id'] +
+                 [c for c in SQL_ONLY if c in df.columns], axis=1)
+    df = df.rename(columns=dict(zip(amenities.COLUMNS, amenities.AMENITIES)))
+    df = df.rename(columns=dict(zip(transit.COLUMNS, transit.LINES)))
+    lines = [l for l in transit.LINES if l in df.columns]
+    df[lines] = df[lines].where(df[lines] > 0)
+    df = df.where(~df.isin([-1, '-1']))
+    return Snapshot(df, refresh_days)
+
+
+def load(csv_file=None, db_name=None, table_name='all_data', refresh_days=30):
+    """Return the Snapshot of csv_file, or of the newest daily csv in the working directory
+    if csv_file is "latest", else of the merged table table_name in db_name.  Returns None
+    if neither is given or no daily csv was found.
+    """
+    if csv_file == 'latest':
+        csv_file = latest_csv()
+        if csv_file is None:
+            print "No previous daily csv found, downloading every listing."
+    if csv_file:
+        snap = from_csv(csv_file, refresh_days)
+    elif db_name:
+        snap = from_sql(db_name, table_name, refresh_days)
+    else:
+        return None
+    print "Comparing the listing cards with %d listings of %s." % (len(snap), csv_file or table_name)
+    return snap
+
+
+def dumps(row):
+    """Return a carried listing dict as JSON, the form in which it is kept in the page
+    archive (see html_archive.py)."""
+    return json.dumps(row, default=lambda v: v.item())
+
+
+def loads(text):
+    """Return the listing dict of dumps."""
+    return json.loads(text)
+
+
+def link_path(link):
+    """Return the path of a listing link, so that links compare equal across hosts and
+    schemes."""
+    return urlparse.urlsplit(str(link)).path
+
+
+def as_price(price):
+    """Return a price as a float, or None if it is missing or not a number (e.g. "Last
+    listed at ...").
+    """
+    try:
+        price = float(price)
+    except (TypeError, ValueError):
+        return None
+    return None if np.isnan(price) else price
+
+
+class Snapshot(object):
+    """Listings of a previous scrape, keyed by data_id.
+
+    Parameters
+    ----------
+      df: DataFrame
+        - listings with the columns of the scraper's csv.  Of duplicate data_ids the last
+          row is kept.  Missing amenity flags are read as 0, line columns the csv lacks are
+          added as NaN (line not listed) and amenity_mask is computed again from the flags,
+          so a carried row has the types of a parsed one also for csvs written before
+          amenity_mask existed.
+      refresh_days: int, default 30
+        - download every listing again once in this many days, even if its card did not
+          change.  0 or None turns this off.
+    """
+
+    def __init__(self, df, refresh_days=30):
+        self.refresh_days = refresh_days
+        df = df.copy()
+        for a in amenities.AMENITIES:
+            df[a] = df[a].fillna(0) if a in df else 0
+        for l in transit.LINES:
+            if l not in df:
+                df[l] = np.nan
+        df['amenity_mask'] = amenities.pack(df, amenities.AMENITIES)
+        self.rows = {}
+        for row in df.to_dict('records'):
+            self.rows[int(row['data_id'])] = row
+
+    def __len__(self):
+        return len(self.rows)
+
+    def due(self, data_id, day):
+        """Return True if the listing is to be downloaded again on day (a datetime.date)."""
+        return bool(self.refresh_days) and (data_id + day.toordinal()) % self.refresh_days == 0
+
+    def unchanged(self, data_id, link, price, day):
+        """Return True if the listing can be carried forward on day: it is in the snapshot
+        with the same link path and, if the card shows one, the same price, and it is not
+        due for a refresh.
+        """
+        row = self.rows.get(data_id)
+        if row is None or link_path(row['link']) != link_path(link):
+            return False
+        if price is not None and as_price(row['price']) != price:
+            return False
+        return not self.due(data_id, day)
+
+    def carry(self, data_id, link, scrape_date):
+        """Return the listing dict of data_id for scrape_date (a "yyyy-mm-dd" string), with
+        the link of today's card.
+        """
+        d = dict(self.rows[data_id])
+        d['link'] = link
+        try:
+            days = (datetime.datetime.strptime(scrape_date, '%Y-%m-%d') -
+                    datetime.datetime.strptime(str(d['scrape_date'])[:10], '%Y-%m-%d')).days
+        except ValueError:
+            days = 0
+        if days > 0 and not pd.isnull(d.get('days_on_streeteasy')):
+            d['days_on_streeteasy'] = d['days_on_streeteasy'] + days
+        d['scrape_date'] = scrape_date
+        return d
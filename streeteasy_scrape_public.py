@@ -1,18 +1,82 @@
 """Scrape rental data from streeteasy.com. Verified 2/6/2017.
 """
-from bs4 import BeautifulSoup
-import urllib
+from bs4 import BeautifulSoup, SoupStrainer
 import pandas as pd
 import numpy as np
 import datetime
 import re
 import sys
 import os
+import itertools
+import functools
+from http_client import HTTPClient
+from scheduler import Scheduler, BudgetExhausted
+from html_archive import HTMLArchive
+from checkpoint import PartialSaver
+from multiprocessing.pool import ThreadPool
+from collections import OrderedDict
+from amenities import AMENITIES, mask_of
+from transit import LINES
+import snapshot
+import metrics
+from metrics import log, DEBUG, INFO, ERROR
+
+
+# columns of the scraped data set
+BASIC = ["data_id", "scrape_date", "link", "address", "price", "sq_ft", "per_sq_ft",
+         "rooms", "beds", "baths", "unit_type","neighborhood", "days_on_streeteasy", "realtor"]
+# transit lines, see transit.py
+TRANSPORT = LINES
+# amenity_mask packs the amenity flags into one integer, see amenities.py
+COL_LIST = BASIC + AMENITIES + TRANSPORT + ["amenity_mask"]
+
+# typed columns. amenity flags are 0/1, transit distances are miles (NaN if absent).
+# numeric listing details are float so that missing values can be NaN.  Columns not
+# listed here (text, and price which may be "Last listed at ...") are left to pandas.
+COL_DTYPES = {"data_id": np.int64, "sq_ft": np.float64, "per_sq_ft": np.float64, "rooms": np.float64,
+              "beds": np.float64, "baths": np.float64, "days_on_streeteasy": np.float64}
+COL_DTYPES.update((a, np.int8) for a in AMENITIES)
+COL_DTYPES.update((l, np.float64) for l in TRANSPORT)
+COL_DTYPES["amenity_mask"] = np.int64
+
+# amenities are found with one case-insensitive pass over the amenities block.  The pattern
+# is a zero-width lookahead so matches may overlap, and longer names are tried first.  A match
+# also implies every amenity contained in it, e.g. "full-time doorman" implies "doorman".
+AMENITY_RE = re.compile('(?=(%s))' % '|'.join(re.escape(a) for a in sorted(AMENITIES, key=len, reverse=True)),
+                        re.IGNORECASE)
+AMENITY_IMPLIES = dict((a.lower(), [b for b in AMENITIES if b.lower() in a.lower()]) for a in AMENITIES)
+
+# transportation block patterns
+LINE_RE = re.compile(r'"sub_icon line_([^"]+)"')
+DISTANCE_RE = re.compile(r'<b>(.+)</b>')
+NUMBER_RE = re.compile(r'([0-9]+.[0-9]+|[0-9]+)')
+FEET_RE = re.compile(r'feet')
+MILES_PER_FOOT = 0.000189394
+
+# parts of the pages that are read.  BeautifulSoup builds a tree only for matching elements
+# (and everything inside them) and skips the rest of the page.
+INDEX_CLASSES = frozenset(["item", "error-message"])
+DETAIL_CLASSES = frozenset(["incognito", "price", "details_info", "nobreak", "vitals", "amenities",
+                            "transportation"])
+
+
+def _has_class(attrs, classes):
+    """True if the class attribute in attrs, given as a string or a list, shares a name with classes."""
+    value = attrs.get("class") or ""
+    if isinstance(value, basestring):
+        value = value.split()
+    return not classes.isdisjoint(value)
+
+
+INDEX_STRAINER = SoupStrainer(lambda name, attrs: _has_class(attrs, INDEX_CLASSES))
+DETAIL_STRAINER = SoupStrainer(lambda name, attrs: attrs.get("id") == "agent-promo" or
+                               _has_class(attrs, DETAIL_CLASSES))
 
 
 def print_err():
-    """Print information about an error"""
+    """Print information about an error and count it by type in the run metrics."""
     exc_type, exc_value, exc_traceback = sys.exc_info()
+    metrics.count('errors', type=exc_type.__name__)
     traceback_details = {
                         'filename': exc_traceback.tb_frame.f_code.co_filename,
                         'lineno': exc_traceback.tb_lineno,
@@ -22,7 +86,320 @@ def print_err():
                         }
     del (exc_type, exc_value, exc_traceback)
     for key, val in traceback_details.items():
-        print key, val
+        log(ERROR, "%s %s", key, val)
+
+
+class RecordBuffer(object):
+    """Accumulate scraped listings column by column and convert them to a DataFrame in a
+    single step.  Appending a listing is O(1), unlike DataFrame.append which copies the whole
+    frame every time.
+
+    Parameters
+    ----------
+      columns: list of str
+        - column names, in output order.
+      dtypes: dict, default None
+        - maps column name to a numpy dtype.  Columns without an entry are inferred by pandas.
+    """
+
+    def __init__(self, columns, dtypes=None):
+        self.columns = list(columns)
+        self.dtypes = dtypes or {}
+        self.clear()
+
+    def __len__(self):
+        return self._n
+
+    def clear(self):
+        """Drop all buffered listings."""
+        self._data = dict((c, []) for c in self.columns)
+        self._n = 0
+
+    def append(self, d):
+        """Add one listing dict.  Missing keys are stored as NaN."""
+        for c in self.columns:
+            self._data[c].append(d.get(c, np.nan))
+        self._n += 1
+
+    def to_frame(self):
+        """Return the buffered listings as a DataFrame with typed columns."""
+        data = OrderedDict()
+        for c in self.columns:
+            if c in self.dtypes:
+                data[c] = np.array(self._data[c], dtype=self.dtypes[c])
+            else:
+                data[c] = self._data[c]
+        return pd.DataFrame(data, columns=self.columns)
+
+
+def parse_amenities(amenities_str):
+    """Return a dict mapping each name in AMENITIES to 1 if it appears in amenities_str
+    (case-insensitive), else 0.
+    """
+    found = set()
+    for match in AMENITY_RE.finditer(amenities_str):
+        found.update(AMENITY_IMPLIES[match.group(1).lower()])
+    return dict((a, int(a in found)) for a in AMENITIES)
+
+
+def parse_transport(sub):
+    """Return a dict mapping each line in TRANSPORT listed in the transportation element to
+    its shortest distance in miles.  Lines that are not listed are left out.  Each child of
+    the element is serialized once and scanned once for all of its line icons.
+    """
+    lines = set(TRANSPORT)
+    dist = {}
+    for s in sub:
+        s = str(s)
+        found = [l for l in LINE_RE.findall(s) if l in lines]
+        if not found:
+            continue
+        distance = DISTANCE_RE.search(s).group(1)                 # text describing the distance to stop
+        dist_num = float(NUMBER_RE.search(distance).group(1))     # get the numeric distance value
+        if FEET_RE.search(distance):                              # if in feet, convert to miles
+            dist_num = dist_num * MILES_PER_FOOT
+        # only save the shortest distance
+        for l in found:
+            if l not in dist or dist_num < dist[l]:
+                dist[l] = dist_num
+    return dist
+
+
+def index_url(prefix, page):
+    """Return the url of a listings page."""
+    return prefix + "/for-rent/nyc?page=%d" % (page)
+
+
+def parse_index(html, prefix, prices=False):
+    """Parse a listings page.  Returns None if the page is the error page shown past the last
+    listings page.  Otherwise returns a list of (data_id, link) for the listings on the page,
+    or (data_id, link, price) if prices is true.  price is the price shown on the card as an
+    int, or None if the card has none.  A listing card that cannot be read is reported and
+    skipped.
+    """
+    # parse with bs4, keeping only the listing cards and the error message
+    soup = BeautifulSoup(html, "lxml", parse_only=INDEX_STRAINER)
+
+    # check for error message.
+    if soup.find(class_="error-message"):
+        return None
+
+    # grab the listing number and link from each listing on this page
+    cards = []
+    for element in soup.find_all("div", class_="item"):
+        try:
+            # the data-id is usually on the card itself, else on an element inside it
+            data_id = element.get("data-id")
+            if data_id is None:
+                data_id = element.find(attrs={"data-id": True})["data-id"]
+            card = (int(data_id), prefix + element.a["href"])
+            if prices:
+                price = element.find(class_="price")
+                price = NUMBER_RE.search(price.get_text().replace(',', '')) if price else None
+                card += (int(float(price.group(1))) if price else None,)
+            cards.append(card)
+        except:
+            log(ERROR, "Error reading a listing card")
+            print_err()
+    return cards
+
+
+def new_record(data_id, link, scrape_date):
+    """Return a listing dict with every column in COL_LIST set to NaN except the given
+    data_id, link and scrape_date.
+    """
+    d = dict((v, np.nan) for v in COL_LIST)
+    d['data_id'] = data_id
+    d['link'] = link
+    d['scrape_date'] = scrape_date
+    return d
+
+
+def parse_listing(html, d):
+    """Parse a listing detail page and fill in the listing dict d, which is returned.
+    Raises an exception if a required part of the page is missing.
+
+    Parameters
+    ----------
+      html: str
+        - the detail page.
+      d: dict
+        - listing record keyed by the names in COL_LIST.
+
+    Each value that is parsed is logged at the DEBUG level.
+    """
+    # parse only the parts of the page that we read
+    soup = BeautifulSoup(html, "lxml", parse_only=DETAIL_STRAINER)
+
+    # get the address
+    d['address'] = soup.find(class_="incognito").getText()
+
+    # check the price for this listing. The price string will come "bundled" with the
+    # price arrow and secondary_text, we will first check for those.  If found, we will
+    # strip them to keep only the price.  There is probably a more elegant way to do this.
+    d['price'] = soup.find(class_="price").get_text(strip=True, separator='\t')
+    # check for a price arrow, if found, strip it
+    price_arrow = soup.find(class_="price").find(class_="price_arrow")
+    if price_arrow:
+        price_arrow = price_arrow.get_text()
+        d['price'] = d['price'].replace(price_arrow, '')
+        # check for secondary text, if found, strip it
+    secondary_text = soup.find(class_="price").find(class_="secondary_text")
+    if secondary_text:
+        secondary_text = secondary_text.get_text()
+        d['price'] = d['price'].replace(secondary_text, '')
+        # now strip the price, convert to int
+        d['price'] = int(d['price'].replace("$", '').replace(',', '').strip())
+    log(DEBUG, "price = %s", d['price'])
+
+    # now get everything from the detail cells, assign to variable based on the
+    # text that is found.
+    detail_cell = soup.find(class_="details_info").find_all(class_="detail_cell")
+    for i in detail_cell:
+        temp = str(i.get_text())
+        if temp.find('bed') != -1:
+            d['beds'] = float(re.search(r'[\d.\d]+', temp).group())  # drop non-numeric and convert to float
+            log(DEBUG, "beds = %2.1f", d['beds'])
+        elif temp.find('per ft') != -1:
+            d['per_sq_ft'] = int(temp.replace('$', '').replace(' per ft&sup2', ''))
+            log(DEBUG, "per_sq_ft = %d", d['per_sq_ft'])
+        elif temp.find('ft') != -1 and temp.find('per') == -1:
+            d['sq_ft'] = int(temp.replace(',', '').replace('ft&sup2', ''))
+            log(DEBUG, "sq_ft = %d", d['sq_ft'])
+        elif temp.find('room') != -1:
+            d['rooms'] = float(re.search(r'[\d.\d]+', temp).group())
+            log(DEBUG, "rooms = %2.1f", d['rooms'])
+        elif temp.find('bath') != -1:
+            d['baths'] = float(re.search(r'[\d.\d]+', temp).group())
+            log(DEBUG, "baths = %2.1f", d['baths'])
+
+    # get the unit type and neighboor hood from the nobreak cell.
+    nobreak = soup.find_all(class_="nobreak")
+    d['unit_type'] = nobreak[0].getText()
+    log(DEBUG, "unit_type = %s", d['unit_type'])
+
+    d['neighborhood'] = nobreak[1].getText().replace('in ', '')
+    log(DEBUG, "neighborhood = %s", d['neighborhood'])
+
+    # days on market
+    vitals = str(soup.find(class_="vitals top_spacer"))
+    days_on_streeteasy_temp = re.search(r'([\d.\d]+) days on StreetEasy', vitals)
+    if days_on_streeteasy_temp:
+        d['days_on_streeteasy'] = int(days_on_streeteasy_temp.group(1))
+
+    log(DEBUG, "days_on_streeteasy = %s", d['days_on_streeteasy'])
+
+    # realtor company and agent
+    try:
+        d['realtor'] = soup.find(id="agent-promo").a
+        if d['realtor']:
+            d['realtor'] = d['realtor'].getText()
+            log(DEBUG, "realtor = %s", d['realtor'])
+    except:
+        log(DEBUG, "***Realtor not found, skipping.")
+
+    # now check for amenities
+    amenities_str = str(soup.findAll(class_="amenities big_separator"))
+    flags = parse_amenities(amenities_str)
+    d.update(flags)
+    d['amenity_mask'] = mask_of(flags)
+
+    # now check for transport
+    d.update(parse_transport(soup.find(class_="transportation")))
+
+    return d
+
+
+def fetch_page(client, url):
+    """Download a single page with an HTTPClient.  Safe to call from worker threads.
+
+    Returns a tuple (html, exc_info).  On success exc_info is None.  On failure html is None
+    and exc_info holds sys.exc_info() so the error can be re-raised and reported for that
+    listing only.
+    """
+    try:
+        with metrics.timed('detail_fetch'):
+            return client.get(url).body, None
+    except:
+        return None, sys.exc_info()
+
+
+def plan_cards(cards, snap, scrape_date, seen=()):
+    """Return the listings of the cards of one listings page, in page order, as
+    (data_id, link, row) tuples.  Cards of data_ids in seen are skipped.  row is the listing
+    carried forward from the Snapshot snap if its card did not change (see snapshot.py),
+    else None: the detail page has to be downloaded.
+    """
+    day = datetime.datetime.strptime(scrape_date, '%Y-%m-%d').date()
+    listings = []
+    for data_id, link, price in cards:
+        if data_id in seen:
+            continue
+        if snap and snap.unchanged(data_id, link, price, day):
+            log(DEBUG, "data_id: %d  unchanged", data_id)
+            listings.append((data_id, link, snap.carry(data_id, link, scrape_date)))
+            metrics.count('listings_carried')
+        else:
+            listings.append((data_id, link, None))
+    return listings
+
+
+def scrape_page(cards, page, buf, fetch_all, fetch, scrape_date, snap=None, seen=(), archive=None):
+    """Scrape the listings of the cards of one listings page into the RecordBuffer buf, in
+    page order.  The cards are sorted out by plan_cards, the detail pages of the other
+    listings are downloaded with fetch_all(fetch, links) and parsed.  An error on one listing
+    is reported and the others continue, except BudgetExhausted, which is raised.  The detail
+    pages and carried listings are added to the HTMLArchive archive, if given, in page order
+    so that reparse.py rebuilds the same csv.
+    """
+    listings = plan_cards(cards, snap, scrape_date, seen)
+    # download the detail pages (concurrently if fetch_all uses threads), then parse in page order
+    pages = fetch_all(fetch, [link for data_id, link, row in listings if row is None])
+    for data_id, link, row in listings:
+        if row is not None:
+            if archive:
+                archive.add(scrape_date, link, snapshot.dumps(row), 'carried', data_id=data_id, page=page)
+            with metrics.timed('accumulate'):
+                buf.append(row)
+            metrics.count('listings')
+            continue
+        html, exc_info = next(pages)
+        try:
+            #initialize dict with the listing number, link and date
+            d = new_record(data_id, link, scrape_date)
+            log(DEBUG, "data_id: %d  %s", data_id, link)
+
+            # re-raise a download error here so it is reported for this listing only.
+            # a used-up budget stops the crawl before the page is marked complete.
+            if exc_info:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            if archive:
+                archive.add(scrape_date, link, html, 'detail', data_id=data_id, page=page)
+
+            # parse the detail page
+            with metrics.timed('parse'):
+                parse_listing(html, d)
+
+            # append to DataFrame
+            with metrics.timed('accumulate'):
+                buf.append(d)
+            metrics.count('listings')
+
+        except BudgetExhausted:
+            raise
+        except:
+            log(ERROR, "Error on page %d", page)
+            print_err()
+
+
+def record_http_metrics(client):
+    """Add the request, byte, cache and retry counts of an HTTPClient to the run metrics."""
+    for name, key in [('requests', 'requests'), ('bytes', 'bytes'), ('not_modified', '304'), ('cache_hits', 'cache')]:
+        metrics.count('http_' + name, client.stats[key])
+    if client.scheduler:
+        for key in ['retries', 'throttled', 'errors', 'slow']:
+            metrics.count('http_' + key, client.scheduler.stats[key])
+        metrics.gauge('http_wait_seconds', client.scheduler.stats['wait_seconds'])
 
 
 def main(**kwargs):
@@ -43,7 +420,63 @@ def main(**kwargs):
             Program will create a subdirectory for partial saves of the scraped data every 'partial_save'
             pages.  This ensures that the entire dataset is not lost if the program is interrputed.
             Set to 0 to turn off partial saving.  Saving often is recommended and does not substantially
-            increase run time.
+            increase run time.  Each save appends only the new listings as a numbered shard in
+            partial_save/<date>/ and records it in partial_save/<date>/manifest.json.  The shards are
+            joined into <date>.csv at the end of the run.
+        workers: int, default 1
+            Number of threads used to download listing detail pages.  With workers > 1 the detail
+            pages of each listings page are fetched concurrently.  Listings are still parsed and
+            saved in the order they appear on the page, and an error fetching one listing does
+            not affect the others.
+        resume: logical, default False
+            If true, continue today's crawl from the last partial save instead of page 1.  The
+            shards already in partial_save/<date>/ are kept, the page loop restarts after the last
+            saved page, and detail pages are not fetched again for data_ids that were already
+            saved.  Requires partial_save > 0.
+        cache_dir: str, default None
+            Directory for an on-disk cache of downloaded pages.  On later runs cached pages are
+            revalidated with If-None-Match/If-Modified-Since, so unchanged pages cost a 304
+            instead of a full download.  None turns the cache off.  Connections are kept alive
+            and responses gzip-compressed either way.  Cache hit, 304 and miss rates are printed
+            at the end of the run.
+        cache_max_age: float, default 0
+            Cached pages younger than this many seconds are used without contacting the server.
+        archive_dir: str, default None
+            If given, every downloaded page is stored in a compressed, append-only archive in
+            this directory (see html_archive.py), and so is every listing carried forward from
+            the snapshot.  reparse.py rebuilds the daily csvs from the archive without network
+            access.
+        base_url: str, default "http://streeteasy.com"
+            Host to scrape.  Point this at a local server that serves recorded pages for testing.
+        rate: float, default 5
+            Maximum requests per second.  None for no rate limit.
+        adaptive: logical, default True
+            Adjust the number of concurrent requests (up to workers) and the rate to the
+            server's response times and throttling (see scheduler.py).
+        retries: int, default 3
+            Number of times a throttled (429), unavailable (5xx) or failed request is retried,
+            after a jittered exponential backoff or the server's Retry-After.
+        max_requests: int, default None
+            Request budget of the run, retries included.  The crawl stops and saves what it
+            has when it is used up.  None for no budget.
+        log_level: str, default "info" ("debug" if verbose)
+            "debug" prints a line per listing, "info" one per page, "error" only errors.
+        metrics_file: str, default "<date>_metrics"
+            At the end of the run, stage timings and counts of listings, errors, requests,
+            bytes and retries are written to <metrics_file>.json and, in the Prometheus text
+            format, <metrics_file>.prom (see metrics.py).  None turns this off.
+        snapshot: str, default None
+            Previous daily csv to compare the listing cards with, or "latest" for the newest
+            <date>.csv in the working directory.  Detail pages are downloaded only for new
+            listings and listings whose link path or card price changed.  The others are copied
+            from the snapshot with today's scrape_date (see snapshot.py).
+        snapshot_db: str, default None
+            Database holding a merged table (see mergeSQL.py) to use as the snapshot instead.
+        snapshot_table: str, default "all_data"
+            Name of the merged table in snapshot_db.
+        refresh_days: int, default 30
+            With a snapshot, download every listing again once in this many days even if its
+            card did not change, to pick up changes the cards do not show.
 
     """
 
@@ -51,226 +484,144 @@ def main(**kwargs):
     max_pages = kwargs.get("max_pages",3000)
     verbose = kwargs.get("verbose",False)
     partial_save = kwargs.get("partial_save",2)
+    workers = kwargs.get("workers",1)
+    resume = kwargs.get("resume",False)
+    cache_dir = kwargs.get("cache_dir",None)
+    cache_max_age = kwargs.get("cache_max_age",0)
+    archive_dir = kwargs.get("archive_dir",None)
+    rate = kwargs.get("rate",5)
+    adaptive = kwargs.get("adaptive",True)
+    retries = kwargs.get("retries",3)
+    max_requests = kwargs.get("max_requests",None)
+    log_level = kwargs.get("log_level","debug" if verbose else "info")
+    snapshot_file = kwargs.get("snapshot",None)
+    snapshot_db = kwargs.get("snapshot_db",None)
+    snapshot_table = kwargs.get("snapshot_table","all_data")
+    refresh_days = kwargs.get("refresh_days",30)
 
     # set up prefix for links
-    prefix = "http://streeteasy.com"
-
-    # initialize a DataFrame
-        #features
-    basic = ["data_id", "scrape_date", "link", "address", "price", "sq_ft", "per_sq_ft",
-             "rooms", "beds", "baths", "unit_type","neighborhood", "days_on_streeteasy", "realtor"]
-    amenities = ["bike room", "board approval required", "cats and dogs allowed", "central air conditioning",
-                "concierge", "cold storage", "community recreation facilities", "children's playroom",
-                "deck", "dishwasher", "doorman", "elevator", "full-time doorman", "furnished", "garage parking",
-                "green building", "gym", "garden", "guarantors accepted", "laundry in building", "live-in super",
-                "loft", "package room", "parking available", "patio", "pets allowed", "roof deck", "smoke-free",
-                "storage available", "sublet", "terrace", "virtual doorman", "washer/dryer in-unit", "waterview",
-                "waterfront"]
-    transport = ["A","C","E","B","D","F","M","G","L","J","Z",
-                 "N","Q","R","1","2","3","4","5","6","7","S",
-                 "LIRR","PATH"]
-    col_list = basic + amenities + transport
-        #initalize DataFrame
-    df = pd.DataFrame(columns=col_list) #to save all results.
-    df_temp = pd.DataFrame(columns=col_list) #for partial saves.
+    prefix = kwargs.get("base_url","http://streeteasy.com")
+
+    # listings are buffered in df_temp until the next partial save, which writes them out
+    # as a new shard.
+    today = str(datetime.date.today())
+    metrics_file = kwargs.get("metrics_file",today + "_metrics")
+    metrics.reset()
+    metrics.set_level(log_level)
+    df_temp = RecordBuffer(COL_LIST, COL_DTYPES) #for partial saves.
+    if partial_save > 0:
+        saver = PartialSaver(os.path.join('partial_save', today), COL_LIST, resume=resume)
+    else:
+        saver = None
+    last_page = 0 #last listings page that was completed
+
+    # pick up from the last checkpoint. listings can move between pages while we crawl, so
+    # skip every data_id already saved rather than relying on the page number alone.
+    seen = set()
+    if resume:
+        if saver:
+            last_page = saver.last_page
+            seen = saver.seen_ids()
+            log(INFO, "Resuming after page %d, %d listings already saved.", last_page, len(seen))
+        else:
+            log(INFO, "Nothing to resume from, partial_save is off.  Starting at page 1.")
+
+    # previous listings to compare the cards with, if any
+    snap = snapshot.load(snapshot_file, snapshot_db, snapshot_table, refresh_days)
+
+    # shared HTTP client with keep-alive connections and the optional page cache.  every
+    # request goes through the scheduler, which paces and retries them.
+    scheduler = Scheduler(rate=rate, max_concurrency=max(workers, 1), adaptive=adaptive, retries=retries,
+                          max_requests=max_requests)
+    client = HTTPClient(cache_dir=cache_dir, max_age=cache_max_age, pool_size=max(workers, 1), scheduler=scheduler)
+    fetch = functools.partial(fetch_page, client)
+    archive = HTMLArchive(archive_dir) if archive_dir else None
+
+    # thread pool for detail pages. imap returns results in submission order.
+    if workers > 1:
+        pool = ThreadPool(workers)
+        fetch_all = pool.imap
+    else:
+        pool = None
+        fetch_all = itertools.imap
 
     # iterate over pages of listings
-    for page in np.arange(1, max_pages):
+    for page in np.arange(last_page + 1, max_pages):
         try:
             # display
-            print "**********************************************"
-            print "Page %d" % (page)
-            print "**********************************************"
+            log(INFO, "Page %d", page)
 
             # load the url for this listing page
-            url = "http://streeteasy.com/for-rent/nyc?page=%d" % (page)
-            r = urllib.urlopen(url)
-
-            # parse with bs4
-            soup = BeautifulSoup(r, "lxml")
-            soup.prettify()
-
-            # check for error message. Exit if the page does not exists.
-            err_msg = soup.find(class_="error-message")
-            if err_msg:
-                print "Page does not exist.  Stopping."
+            url = index_url(prefix, page)
+            with metrics.timed('index_fetch'):
+                r = client.get(url).body
+            if archive:
+                archive.add(today, url, r, 'index', page=page)
+
+            # get the listing number and link of all listings on this search page.
+            # Exit if the page does not exists.
+            cards = parse_index(r, prefix, prices=True)
+            if cards is None:
+                log(INFO, "Page does not exist.  Stopping.")
                 break
 
-            # get all listings from this search page
-            listings = soup.find_all("div", class_="item")
-
             # run partial save if requested
-            if partial_save > 0 and page % partial_save == 0:
-                print "*****Partial save*****"
-                if not os.path.isdir('partial_save'):
-                    os.makedirs('partial_save')
+            if saver and page % partial_save == 0:
+                log(INFO, "*****Partial save*****")
                 try:
-                    #write temporary dataframe to csv
-                    df_temp.to_csv('partial_save/df_temp.csv')
-                    #if save was successful append to actual df and save
-                    df = df.append(df_temp, ignore_index=True)
-                    df.to_csv('partial_save/' + str(datetime.date.today()) + '.csv')
+                    #write the listings scraped since the last save (pages up to page-1) as a shard
+                    with metrics.timed('partial_save'):
+                        saver.save(df_temp.to_frame(), page - 1)
                 except:
                     #if save was unsuccessful. do not append
-                    print "Error saving df_temp.  Discarding recent data."
+                    log(ERROR, "Error saving df_temp.  Discarding recent data.")
                     print_err()
 
                 # reset df_temp
-                df_temp = pd.DataFrame(columns=col_list)  # for partial saves.
-
-            # begin looping over listings on this page
-            for element in listings:
-                try:
-                    # divider
-                    print "======================"
-
-                    #initialize dict
-                    d = {}
-                    for v in col_list:
-                        d[v] = np.nan
-
-                    # grab and print the listing number
-                    match = re.search(r'data-id="(\d+)', str(element))
-                    d['data_id'] = int(match.group(1))
-                    print "data_id: " + str(d['data_id'])
-
-                    # get the link for this listing
-                    d['link'] = prefix + element.a["href"]
-                    print d['link']
-
-                    #save the date
-                    d['scrape_date'] = str(datetime.date.today())
-
-                    # load the html for the listing as a new soup
-                    r = urllib.urlopen(d['link'])
-                    soup = BeautifulSoup(r, "lxml")
-
-                    # get the address
-                    d['address'] = soup.find(class_="incognito").getText()
-
-                    # check the price for this listing. The price string will come "bundled" with the
-                    # price arrow and secondary_text, we will first check for those.  If found, we will
-                    # strip them to keep only the price.  There is probably a more elegant way to do this.
-                    d['price'] = soup.find(class_="price").get_text(strip=True, separator='\t')
-                    # check for a price arrow, if found, strip it
-                    price_arrow = soup.find(class_="price").find(class_="price_arrow")
-                    if price_arrow:
-                        price_arrow = price_arrow.get_text()
-                        d['price'] = d['price'].replace(price_arrow, '')
-                        # check for secondary text, if found, strip it
-                    secondary_text = soup.find(class_="price").find(class_="secondary_text")
-                    if secondary_text:
-                        secondary_text = secondary_text.get_text()
-                        d['price'] = d['price'].replace(secondary_text, '')
-                        # now strip the price, convert to int
-                        d['price'] = int(d['price'].replace("$", '').replace(',', '').strip())
-                    if verbose:
-                        print "price = %d" % (d['price'])
-
-                    # now get everything from the detail cells, assign to variable based on the
-                    # text that is found.
-                    detail_cell = soup.find(class_="details_info").find_all(class_="detail_cell")
-                    for i in detail_cell:
-                        temp = str(i.get_text())
-                        if temp.find('bed') != -1:
-                            d['beds'] = float(re.search(r'[\d.\d]+', temp).group())  # drop non-numeric and convert to float
-                            if verbose:
-                                print "beds = %2.1f" % (d['beds'])
-                        elif temp.find('per ft') != -1:
-                            d['per_sq_ft'] = int(temp.replace('$', '').replace(' per ft&sup2', ''))
-                            if verbose:
-                                print "per_sq_ft = %d" % (d['per_sq_ft'])
-                        elif temp.find('ft') != -1 and temp.find('per') == -1:
-                            d['sq_ft'] = int(temp.replace(',', '').replace('ft&sup2', ''))
-                            if verbose:
-                                print "sq_ft = %d" % (d['sq_ft'])
-                        elif temp.find('room') != -1:
-                            d['rooms'] = float(re.search(r'[\d.\d]+', temp).group())
-                            if verbose:
-                                print "rooms = %2.1f" % (d['rooms'])
-                        elif temp.find('bath') != -1:
-                            d['baths'] = float(re.search(r'[\d.\d]+', temp).group())
-                            if verbose:
-                                print "baths = %2.1f" % (d['baths'])
-
-                    # get the unit type and neighboor hood from the nobreak cell.
-                    nobreak = soup.find_all(class_="nobreak")
-                    d['unit_type'] = nobreak[0].getText()
-                    if verbose:
-                        print "unit_type = %s" % (d['unit_type'])
-
-                    d['neighborhood'] = nobreak[1].getText().replace('in ', '')
-                    if verbose:
-                        print "neighborhood = %s" % (d['neighborhood'])
-
-                    # days on market
-                    vitals = str(soup.find(class_="vitals top_spacer"))
-                    days_on_streeteasy_temp = re.search(r'([\d.\d]+) days on StreetEasy', vitals)
-                    if days_on_streeteasy_temp:
-                        d['days_on_streeteasy'] = int(days_on_streeteasy_temp.group(1))
-
-                    if verbose:
-                        print "days_on_streeteasy = %d" % (d['days_on_streeteasy'])
-
-                    # realtor company and agent
-                    try:
-                        d['realtor'] = soup.find(id="agent-promo").a
-                        if d['realtor']:
-                            d['realtor'] = d['realtor'].getText()
-                            if verbose:
-                                print "realtor = %s" % (d['realtor'])
-                    except:
-                        print "***Realtor not found, skipping."
-
-                    # now check for amenities
-                    amenities_str = str(soup.findAll(class_="amenities big_separator"))
-                    for a in amenities:
-                        match = re.search(a, amenities_str, re.IGNORECASE)
-                        if match:
-                            d[a] = 1
-                        else:
-                            d[a] = 0
-
-                    # now check for transport
-                    sub = soup.find(class_="transportation")
-                    for s in sub:
-                        for l in transport:
-                            match = re.search('"sub_icon line_%s"' % (l), str(s))
-                            if match:
-                                distance = re.search(r'<b>(.+)</b>', str(s)).group(1)                       # text describing the distance to stop
-                                dist_num = float(re.search(r'([0-9]+.[0-9]+|[0-9]+)', distance).group(1))   # get the numeric distance value
-                                ft_check = re.search(r'feet', distance)                                     # if in feet, convert to miles
-                                if ft_check:
-                                    dist_num = dist_num * 0.000189394
-                                # only save the shortest distance
-                                if (d[l] is np.nan) or (dist_num < d[l]):
-                                    d[l] = dist_num
-
-                    # append to DataFrame
-                    df_temp = df_temp.append(d, ignore_index=True)
-
-                except:
-                    print "Error on page %d" % (page)
-                    print_err()
-                    continue
+                df_temp.clear()
+
+            # scrape the listings on this page, skipping those already saved and carrying
+            # forward those whose card matches the snapshot
+            scrape_page(cards, page, df_temp, fetch_all, fetch, today, snap, seen, archive)
+            last_page = page
+            metrics.count('pages')
+        except BudgetExhausted:
+            log(INFO, "Request budget used up.  Stopping.")
+            break
         except:
-            print "Error on page %d" % (page)
+            log(ERROR, "Error on page %d", page)
             print_err()
             continue
 
+    # shut down the fetch threads
+    if pool:
+        pool.close()
+        pool.join()
+    client.report()
+    record_http_metrics(client)
+    client.close()
+    if archive:
+        archive.close()
+
     #save final df
-    print "DONE.  Saving..."
+    log(INFO, "DONE.  Saving...")
+    df = df_temp.to_frame()
     try:
-        # write temporary dataframe to csv
-        df_temp.to_csv('partial_save/df_temp.csv')
-        # if save was successful append to actual df and save
-        df = df.append(df_temp, ignore_index=True)
-        df.to_csv(str(datetime.date.today()) + '.csv')
+        with metrics.timed('final_save'):
+            if saver:
+                # write the last shard, then join all shards into the daily csv
+                saver.save(df, last_page)
+                saver.compact(today + '.csv')
+                df = pd.read_csv(today + '.csv', index_col=0)
+            else:
+                df.to_csv(today + '.csv')
     except:
-        # if save was unsuccessful. do not append
-        print "Error saving df."
+        log(ERROR, "Error saving df.")
         print_err()
 
+    if metrics_file:
+        metrics.write(metrics_file)
+
     #exit
     return df
 
@@ -0,0 +1,75 @@
+"""
+Transit lines and the per-listing transit features derived from them.
+
+The daily and merged tables have one column per line (line_A ... line_S, LIRR, PATH) holding
+the distance in miles to the nearest stop of that line, or 0 if the line is not listed.
+csv2sql also stores, per listing:
+
+    nearest_line        the closest line, e.g. "A" (-1 if no line is listed)
+    nearest_distance    its distance in miles (-1 if no line is listed)
+    lines_within_<r>    the number of lines within r miles, for each r in RADII
+
+query.create_indexes adds one partial index per line column, holding only the listings
+near that line, so that sql_filter's "within r miles of any of these lines" is a range scan
+per line rather than a scan of every row.
+"""
+import numpy as np
+import pandas as pd
+
+
+# lines as named by streeteasy.com, and their table columns
+LINES = ["A", "C", "E", "B", "D", "F", "M", "G", "L", "J", "Z",
+         "N", "Q", "R", "1", "2", "3", "4", "5", "6", "7", "S",
+         "LIRR", "PATH"]
+COLUMNS = [l if l in ("LIRR", "PATH") else "line_" + l for l in LINES]
+COLUMN = dict(zip(LINES, COLUMNS))
+COLUMN.update(zip(COLUMNS, COLUMNS))
+
+# radii in miles of the lines_within_<r> counts
+RADII = [0.25, 0.5, 1.0]
+COUNT_COLUMNS = ["lines_within_%s" % (('%g' % r).replace('.', '_')) for r in RADII]
+FEATURE_COLUMNS = ["nearest_line", "nearest_distance"] + COUNT_COLUMNS
+
+
+def column(line):
+    """Return the table column of a line, given as "A" or "line_A"."""
+    if line not in COLUMN:
+        raise KeyError("unknown line: %r" % (line))
+    return COLUMN[line]
+
+
+def features(df):
+    """Return the transit features of a DataFrame with one distance column per line, as a
+    DataFrame with the columns in FEATURE_COLUMNS and the index of df.  Distances of 0 or
+    less mean the line is absent.
+    """
+    distances = np.column_stack([pd.to_numeric(df[c], errors='coerce').fillna(0).values.astype(np.float64)
+                                 if c in df else np.zeros(len(df)) for c in COLUMNS])
+    distances[distances <= 0] = np.inf
+    nearest = distances.argmin(axis=1) if len(df) else np.zeros(0, dtype=int)
+    nearest_distance = distances.min(axis=1) if len(df) else np.zeros(0)
+    none = np.isinf(nearest_distance)
+    out = pd.DataFrame(index=df.index)
+    out['nearest_line'] = np.where(none, -1, np.array(LINES, dtype=object)[nearest])
+    out['nearest_distance'] = np.where(none, -1., nearest_distance)
+    for r, col in zip(RADII, COUNT_COLUMNS):
+        out[col] = (distances <= r).sum(axis=1)
+    return out
+
+
+def indexes():
+    """Return the partial indexes on the line columns as (name, columns, where) tuples, in
+    the format of query.INDEXES.
+    """
+    return [(c, [c], "%s > 0" % (c)) for c in COLUMNS]
+
+
+def sql_filter(lines, radius):
+    """Return (clause, params) selecting the listings within radius miles of any of the
+    given lines.  Each term repeats the "> 0" condition of its partial index so the index
+    can be used.
+    """
+    if not lines:
+        raise ValueError("no lines given")
+    terms = ["(%s > 0 AND %s <= ?)" % (column(l), column(l)) for l in lines]
+    return "(%s)" % (" OR ".join(terms)), tuple(radius for l in lines)
@@ -0,0 +1,446 @@
+"""
+Sharded crawl: several worker processes or hosts share the listings pages through a work
+queue in a SQLite database.
+
+The pages of a run (the scrape date) are split into tasks of pages_per_task consecutive
+pages, one row per task in the crawl_tasks table:
+
+    run, first_page, last_page   the task
+    state                        pending, leased, done, skipped (past the last page) or
+                                 failed (given back, or its lease expired, after
+                                 max_attempts leases)
+    worker, lease_expires        who holds the lease, and until when
+    attempts, shard, n_listings  leases handed out, output file and listings of a done task
+
+A worker leases the first pending task, or a leased one whose lease has expired, so the
+pages of a crashed worker are picked up by another one.  While it crawls it renews the
+lease (heartbeat) from a background thread; if the lease was lost it drops the task.  The
+listings of each task are written to a shard file of their own, and merge() joins the
+shards of a finished run, in page order, into the daily csv.
+
+Start N local workers and merge with main(), or run on each host
+
+    python work_queue.py worker <db_name> <worker_id>
+
+against a database all hosts can reach, then "python work_queue.py merge <db_name>".
+The database uses the rollback journal rather than WAL, which needs memory shared by all
+processes and so only works on one host.  It relies on the file locks of the file system
+holding it, which are broken on some network file systems: check that yours supports
+them (e.g. NFSv4 with locking) before sharing the queue between hosts.  The shards are
+also read from out_dir by merge(), so out_dir must be shared as well.
+"""
+import os
+import sys
+import time
+import socket
+import datetime
+import sqlite3
+import threading
+import itertools
+import functools
+import multiprocessing
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+import pandas as pd
+from streeteasy_scrape_public import (COL_LIST, COL_DTYPES, RecordBuffer, index_url, parse_index, scrape_page,
+                                      fetch_page, print_err, record_http_metrics)
+from http_client import HTTPClient
+from scheduler import Scheduler, BudgetExhausted
+import snapshot
+import metrics
+from metrics import log, INFO, WARNING, ERROR
+
+
+class WorkQueue(object):
+    """Lease table of the listings pages of one crawl run.  Safe to use from several
+    processes or hosts; each process needs its own WorkQueue.
+
+    Parameters
+    ----------
+      db_name: str
+        - database holding the crawl_tasks table.  Created if it does not exist.
+      run: str
+        - name of the run, by default today's date.
+      lease_seconds: float, default 120
+        - a lease that is not renewed for this long expires and the task is handed out again.
+      max_attempts: int, default 3
+        - a task given back after a failure, or whose lease expired, after this many leases
+          is marked failed.
+    """
+
+    def __init__(self, db_name, run=None, lease_seconds=120, max_attempts=3):
+        self.db_name = db_name
+        self.run = run or str(datetime.date.today())
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.con = sqlite3.connect(db_name, timeout=60, check_same_thread=False)
+        self.con.isolation_level = None  #transactions are managed explicitly
+        self._lock = threading.Lock()  #the heartbeat thread shares the connection
+        #not WAL, which does not work across hosts (see the module docstring)
+        self.con.execute("PRAGMA journal_mode = DELETE;")
+        self.con.execute("""
+        CREATE TABLE IF NOT EXISTS crawl_tasks (
+            run TEXT, first_page INTEGER, last_page INTEGER, state TEXT, worker TEXT,
+            lease_expires REAL, attempts INTEGER, shard TEXT, n_listings INTEGER, end_page INTEGER,
+            PRIMARY KEY (run, first_page));
+        """)
+
+    @contextmanager
+    def _transaction(self):
+        """Write transaction.  BEGIN IMMEDIATE takes the write lock at the start, so two
+        workers cannot read the same pending task and both lease it.
+        """
+        with self._lock:
+            self.con.execute("BEGIN IMMEDIATE;")
+            try:
+                yield self.con
+            except:
+                self.con.execute("ROLLBACK;")
+                raise
+            self.con.execute("COMMIT;")
+
+    def _write(self, sql, params=()):
+        """Run one statement in its own write transaction.  Returns the rowcount."""
+        with self._transaction() as con:
+            return con.execute(sql, params).rowcount
+
+    def create(self, max_pages, pages_per_task=10):
+        """Add the tasks of pages 1..max_pages-1 to the run, unless the run already has
+        tasks, so that every worker can call this and the first one sets the task grid.
+        Returns True if the tasks were created.
+        """
+        tasks = [(self.run, first, min(first + pages_per_task - 1, max_pages - 1))
+                 for first in range(1, max_pages, pages_per_task)]
+        with self._transaction() as con:
+            if con.execute("SELECT 1 FROM crawl_tasks WHERE run = ? LIMIT 1;", (self.run,)).fetchone():
+                return False
+            con.executemany("INSERT INTO crawl_tasks (run, first_page, last_page, state, attempts) "
+                            "VALUES (?, ?, ?, 'pending', 0);", tasks)
+        return True
+
+    def lease(self, worker):
+        """Lease the first pending or expired task.  Returns (first_page, last_page), or None
+        if no task is left to hand out.  An expired task that was already leased max_attempts
+        times is marked failed instead, so a page that kills its worker is not retried forever.
+        """
+        now = time.time()
+        with self._transaction() as con:
+            con.execute("""
+            UPDATE crawl_tasks SET state = 'failed', worker = NULL, lease_expires = NULL
+            WHERE run = ? AND state = 'leased' AND lease_expires < ? AND attempts >= ?;
+            """, (self.run, now, self.max_attempts))
+            row = con.execute("""
+            SELECT first_page, last_page FROM crawl_tasks
+            WHERE run = ? AND (state = 'pending' OR (state = 'leased' AND lease_expires < ?))
+            ORDER BY first_page LIMIT 1;
+            """, (self.run, now)).fetchone()
+            if row:
+                con.execute("""
+                UPDATE crawl_tasks SET state = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1
+                WHERE run = ? AND first_page = ?;
+                """, (worker, now + self.lease_seconds, self.run, row[0]))
+        return tuple(row) if row else None
+
+    def heartbeat(self, worker, first_page):
+        """Renew a lease.  Returns False if the worker no longer holds it."""
+        return self._write("""
+        UPDATE crawl_tasks SET lease_expires = ? WHERE run = ? AND first_page = ? AND worker = ? AND state = 'leased';
+        """, (time.time() + self.lease_seconds, self.run, first_page, worker)) == 1
+
+    def complete(self, worker, first_page, shard, n_listings, end_page=None):
+        """Mark a task done.  end_page is the first page past the last listings page, if the
+        task reached it; the pending tasks after it are skipped.  Returns False, and changes
+        nothing, if the task was handed to another worker in the meantime.
+        """
+        with self._transaction() as con:
+            n = con.execute("""
+            UPDATE crawl_tasks SET state = 'done', shard = ?, n_listings = ?, end_page = ?
+            WHERE run = ? AND first_page = ? AND worker = ? AND state = 'leased';
+            """, (shard, n_listings, end_page, self.run, first_page, worker)).rowcount
+            if n and end_page is not None:
+                con.execute("""
+                UPDATE crawl_tasks SET state = 'skipped' WHERE run = ? AND first_page > ? AND state = 'pending';
+                """, (self.run, end_page))
+        return n == 1
+
+    def release(self, worker, first_page):
+        """Give a task back after a failure, so another worker can take it at once, or mark
+        it failed after max_attempts leases.
+        """
+        self._write("""
+        UPDATE crawl_tasks SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,
+            worker = NULL, lease_expires = NULL
+        WHERE run = ? AND first_page = ? AND worker = ? AND state = 'leased';
+        """, (self.max_attempts, self.run, first_page, worker))
+
+    def status(self):
+        """Return {state: number of tasks} for the run."""
+        with self._lock:
+            return dict(self.con.execute("SELECT state, COUNT(*) FROM crawl_tasks WHERE run = ? GROUP BY state;",
+                                         (self.run,)).fetchall())
+
+    def done_tasks(self):
+        """Return (first_page, last_page, shard, end_page) of the done tasks, in page order."""
+        with self._lock:
+            return self.con.execute("""
+            SELECT first_page, last_page, shard, end_page FROM crawl_tasks WHERE run = ? AND state = 'done'
+            ORDER BY first_page;
+            """, (self.run,)).fetchall()
+
+    def close(self):
+        self.con.close()
+
+
+class _Heartbeat(object):
+    """Renew the lease of a task every interval seconds in a background thread.  lost is
+    set if the lease was taken over by another worker.
+    """
+
+    def __init__(self, queue, worker, first_page, interval):
+        self.lost = threading.Event()
+        self._stop = threading.Event()
+        self._args = (queue, worker, first_page, interval)
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        queue, worker, first_page, interval = self._args
+        while not self._stop.wait(interval):
+            try:
+                if not queue.heartbeat(worker, first_page):
+                    self.lost.set()
+                    return
+            except sqlite3.OperationalError:
+                pass  #database busy: try again at the next beat, the lease has some slack
+
+    def stop(self):
+        self._stop.set()
+        self.thread.join()
+
+
+def crawl_pages(client, prefix, first_page, last_page, fetch_all, scrape_date, lost=None, snap=None):
+    """Crawl listings pages first_page..last_page as streeteasy_scrape_public.main does.
+    Listings whose card matches the Snapshot snap, if given, are carried forward.
+
+    Returns (DataFrame of the listings, end_page), where end_page is the first page past the
+    last listings page if it was reached, else None.  Stops early, returning None for the
+    DataFrame, if the event lost is set.
+    """
+    buf = RecordBuffer(COL_LIST, COL_DTYPES)
+    fetch = functools.partial(fetch_page, client)
+    for page in range(first_page, last_page + 1):
+        if lost is not None and lost.is_set():
+            return None, None
+        log(INFO, "Page %d", page)
+        with metrics.timed('index_fetch'):
+            html = client.get(index_url(prefix, page)).body
+        cards = parse_index(html, prefix, prices=True)
+        if cards is None:
+            return buf.to_frame(), page
+        scrape_page(cards, page, buf, fetch_all, fetch, scrape_date, snap)
+        metrics.count('pages')
+    return buf.to_frame(), None
+
+
+def shard_dir(out_dir, run):
+    return os.path.join(out_dir, run)
+
+
+def worker(db_name, worker_id=None, **kwargs):
+    """Take tasks from the work queue until none is left, writing the listings of each to
+    a shard in <out_dir>/<run>/.
+
+    Parameters
+    ----------
+      db_name: str
+        - database holding the work queue.
+      worker_id: str, default None
+        - name of the worker, unique across hosts.  Defaults to <host>-<pid>.
+
+    Keyword arguments:
+        run: str, default today's date
+            Name of the run.
+        out_dir: str, default "shards"
+            Directory for the shards.  Must be shared by all workers of the run.
+        max_pages, pages_per_task
+            Tasks to create if the run has none yet (see WorkQueue.create).  Defaults 3000 and
+            10.  Ignored if the run already has tasks.
+        lease_seconds: float, default 120
+            See WorkQueue.
+        workers: int, default 4
+            Number of threads downloading the detail pages of a listings page.
+        base_url, rate, adaptive, retries, max_requests, cache_dir, cache_max_age, log_level,
+        snapshot, snapshot_db, snapshot_table, refresh_days
+            As in streeteasy_scrape_public.main.  rate is the rate of this worker.
+        metrics_file: str, default "<out_dir>/<run>/<worker_id>_metrics"
+            See streeteasy_scrape_public.main.
+
+    Returns the number of tasks completed.
+    """
+    worker_id = worker_id or '%s-%d' % (socket.gethostname(), os.getpid())
+    run = kwargs.get("run", None) or str(datetime.date.today())
+    out_dir = shard_dir(kwargs.get("out_dir", "shards"), run)
+    lease_seconds = kwargs.get("lease_seconds", 120)
+    threads = kwargs.get("workers", 4)
+    prefix = kwargs.get("base_url", "http://streeteasy.com")
+    metrics_file = kwargs.get("metrics_file", os.path.join(out_dir, worker_id + '_metrics'))
+    metrics.reset()
+    metrics.set_level(kwargs.get("log_level", "info"))
+    if not os.path.isdir(out_dir):
+        try:
+            os.makedirs(out_dir)
+        except OSError:
+            pass  #created by another worker
+
+    queue = WorkQueue(db_name, run, lease_seconds)
+    queue.create(kwargs.get("max_pages", 3000), kwargs.get("pages_per_task", 10))
+    scheduler = Scheduler(rate=kwargs.get("rate", 5), max_concurrency=max(threads, 1),
+                          adaptive=kwargs.get("adaptive", True), retries=kwargs.get("retries", 3),
+                          max_requests=kwargs.get("max_requests", None))
+    client = HTTPClient(cache_dir=kwargs.get("cache_dir", None), max_age=kwargs.get("cache_max_age", 0),
+                        pool_size=max(threads, 1), scheduler=scheduler)
+    snap = snapshot.load(kwargs.get("snapshot", None), kwargs.get("snapshot_db", None),
+                         kwargs.get("snapshot_table", "all_data"), kwargs.get("refresh_days", 30))
+    pool = ThreadPool(threads) if threads > 1 else None
+    fetch_all = pool.imap if pool else itertools.imap
+    completed = 0
+    try:
+        while True:
+            task = queue.lease(worker_id)
+            if task is None:
+                break
+            first_page, last_page = task
+            log(INFO, "%s: pages %d-%d", worker_id, first_page, last_page)
+            beat = _Heartbeat(queue, worker_id, first_page, lease_seconds / 4.)
+            try:
+                df, end_page = crawl_pages(client, prefix, first_page, last_page, fetch_all,
+                                           str(datetime.date.today()), beat.lost, snap)
+            except BudgetExhausted:
+                log(INFO, "Request budget used up.  Stopping.")
+                beat.stop()
+                queue.release(worker_id, first_page)
+                break
+            except:
+                log(ERROR, "Error on pages %d-%d, giving them back", first_page, last_page)
+                print_err()
+                beat.stop()
+                queue.release(worker_id, first_page)
+                continue
+            beat.stop()
+            if df is None:
+                log(INFO, "%s: lease of pages %d-%d lost, dropping them", worker_id, first_page, last_page)
+                metrics.count('leases_lost')
+                continue
+            #the shard name includes the worker, so a worker that lost its lease never
+            #overwrites the shard of the one that took the task over
+            shard = 'pages_%05d-%05d.%s.csv' % (first_page, last_page, worker_id)
+            path = os.path.join(out_dir, shard)
+            with metrics.timed('shard_save'):
+                df.to_csv(path + '.tmp')
+                os.rename(path + '.tmp', path)
+            if queue.complete(worker_id, first_page, shard, len(df), end_page):
+                completed += 1
+                metrics.count('tasks')
+            else:
+                os.remove(path)
+                metrics.count('leases_lost')
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+        record_http_metrics(client)
+        client.close()
+        queue.close()
+        if metrics_file:
+            metrics.write(metrics_file)
+    log(INFO, "%s: %d tasks done.", worker_id, completed)
+    return completed
+
+
+def merge(db_name, csv_file=None, run=None, out_dir='shards'):
+    """Join the shards of a finished run into the daily csv, in page order.  A listing
+    that moved between pages during the crawl can be in two shards; the first is kept.
+
+    Parameters
+    ----------
+      db_name: str
+        - database holding the work queue.
+      csv_file: str, default "<run>.csv"
+        - output file.
+      run: str, default today's date
+        - name of the run.
+      out_dir: str, default "shards"
+        - directory the workers wrote the shards to.
+
+    Returns the DataFrame, as read back from csv_file.  Raises ValueError if tasks of the
+    run are still pending or leased.  Failed tasks are reported and left out.
+    """
+    queue = WorkQueue(db_name, run)
+    try:
+        status = queue.status()
+        unfinished = status.get('pending', 0) + status.get('leased', 0)
+        if unfinished:
+            raise ValueError("run %s has %d unfinished tasks" % (queue.run, unfinished))
+        if status.get('failed'):
+            log(WARNING, "Warning: %d tasks failed, their pages are missing.", status['failed'])
+        tasks = queue.done_tasks()
+    finally:
+        queue.close()
+    csv_file = csv_file or queue.run + '.csv'
+    end = min([t[3] for t in tasks if t[3] is not None] or [None])
+    frames = [pd.read_csv(os.path.join(shard_dir(out_dir, queue.run), shard), index_col=0)
+              for first_page, last_page, shard, end_page in tasks if end is None or first_page <= end]
+    df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=COL_LIST)
+    df = df.drop_duplicates('data_id').reset_index(drop=True)
+    df.to_csv(csv_file + '.tmp')
+    if os.path.isfile(csv_file):
+        os.remove(csv_file)
+    os.rename(csv_file + '.tmp', csv_file)
+    log(INFO, "%s: %d listings from %d shards.", csv_file, len(df), len(frames))
+    return pd.read_csv(csv_file, index_col=0)
+
+
+def _worker_process(args):
+    db_name, worker_id, kwargs = args
+    return worker(db_name, worker_id, **kwargs)
+
+
+def main(db_name, n_workers=4, **kwargs):
+    """Crawl with n_workers local worker processes, then merge the shards into the daily csv.
+
+    Parameters
+    ----------
+      db_name: str
+        - database for the work queue.
+      n_workers: int, default 4
+        - number of worker processes.
+
+    Keyword arguments are passed to worker(), except rate, which is the total for all
+    workers and is split evenly between them, and csv_file, passed to merge().
+    """
+    kwargs = dict(kwargs)
+    csv_file = kwargs.pop("csv_file", None)
+    rate = kwargs.get("rate", 5)
+    kwargs["rate"] = rate / float(n_workers) if rate is not None else None
+    # create the tasks once, before the workers race for them
+    queue = WorkQueue(db_name, kwargs.get("run"))
+    queue.create(kwargs.get("max_pages", 3000), kwargs.get("pages_per_task", 10))
+    queue.close()
+    pool = multiprocessing.Pool(n_workers)
+    try:
+        done = pool.map(_worker_process, [(db_name, '%s-worker-%d' % (socket.gethostname(), i), kwargs)
+                                          for i in range(n_workers)])
+    finally:
+        pool.close()
+        pool.join()
+    log(INFO, "%d tasks done by %d workers.", sum(done), n_workers)
+    return merge(db_name, csv_file, kwargs.get("run"), kwargs.get("out_dir", "shards"))
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'worker':
+        worker(sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else None)
+    elif len(sys.argv) > 1 and sys.argv[1] == 'merge':
+        merge(sys.argv[2])
+    else:
+        main('crawl_queue.db', int(sys.argv[1]) if len(sys.argv) > 1 else 4)